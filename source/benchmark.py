@@ -0,0 +1,195 @@
+"""
+Title: Benchmark
+Author: Paulo Lacerda
+Description: Benchmark the table parsing stages on synthetic documents (no Azure calls, completions are stubbed),
+             reporting time and peak memory per stage and size tier, and comparing them to a stored baseline.
+
+"""
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+import logging
+import openai_utils
+import parse_tables_utils
+from document_utils import Document
+from synthetic_utils import generate_result
+from general_utils import logger
+
+# size tiers: synthetic document parameters (see synthetic_utils.generate_result)
+TIERS = {
+    'small': {'pages': 5, 'lines': 20, 'tables': 5, 'rows': 40, 'columns': 4, 'depth': 3, 'styles': 10},
+    'medium': {'pages': 20, 'lines': 40, 'tables': 20, 'rows': 200, 'columns': 5, 'depth': 4, 'styles': 50},
+    'large': {'pages': 50, 'lines': 60, 'tables': 50, 'rows': 400, 'columns': 6, 'depth': 5, 'styles': 200},
+}
+BASELINE_FILE = "benchmarks/baseline.json"
+TIME_TOLERANCE = 0.5 # Max relative time increase over the baseline.
+MIN_TIME_DIFFERENCE = 0.05 # Time differences (seconds) below this are noise.
+SCALING_TOLERANCE = 0.3 # Max increase of the scaling exponent (time growth relative to size growth between tiers).
+IMPORT_TIME_BUDGET = 0.5 # Max seconds to import parse_tables (startup cost of every short lived run).
+LAZY_MODULES = ['pandas', 'openai', 'tiktoken', 'azure.ai.formrecognizer', 'requests', 'aiohttp'] # Only imported at their first use, never at startup.
+
+''' stub the completions (and token counting) so the benchmark runs offline '''
+def stub_completions():
+    # the stubbed answers must not reach the completion cache
+    openai_utils.AZURE_OPENAI_CACHE_FILE = ""
+    openai_utils.completion_cache = None
+    def complete_all(prompt, variables_list, **kwargs):
+        answers = []
+        for variables in variables_list:
+            if 'items' in variables:
+                answers.append("\n".join(f"{number+1}: valid" for number in range(variables['items'].count("\n") + 1)))
+            else:
+                answers.append("valid")
+        return answers
+    def complete(prompt, variables, **kwargs):
+        if 'column_names' in variables:
+            return "\n".join(f"{column}: Inferred {column}" for column in variables['column_names'].splitlines())
+        return complete_all(prompt, [variables])[0]
+    openai_utils.complete_all = complete_all
+    openai_utils.complete = complete
+    # ~4 characters per token, avoids loading the tokenizer files
+    openai_utils.count_tokens = lambda text, deployment="davinci": len(text) // 4 + 1
+
+''' document size, used to compute the scaling exponent between tiers '''
+def get_size(result):
+    return sum(len(table['cells']) for table in result['tables']) + sum(len(page['lines']) for page in result['pages'])
+
+''' pipeline stages, each one is a function of the synthetic result '''
+def get_stages(result):
+    trees = parse_tables_utils.parse_json_result(result)
+    line_index = parse_tables_utils.get_line_index(result['pages'])
+    tables = parse_tables_utils.load_tables(result['tables'], result['pages'])
+    return {
+        'document_model': lambda: Document.from_dict(result),
+        'line_index': lambda: parse_tables_utils.get_line_index(result['pages']),
+        # line lookups (get_x) of every column 0 cell, constant time whatever the number of pages and lines
+        'indents': lambda: [parse_tables_utils.get_indents(line_index, table) for table in tables],
+        'load_tables': lambda: parse_tables_utils.load_tables(result['tables'], result['pages']),
+        'parse_json_result': lambda: parse_tables_utils.parse_json_result(result),
+        'get_dataframe': lambda: [parse_tables_utils.get_dataframe(tree) for tree in trees],
+    }
+
+''' run a stage, returns its best time (seconds) and its peak traced memory (MB) '''
+def measure(function, repeat=1):
+    best_time = math.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best_time = min(best_time, time.perf_counter() - start)
+    # memory is traced in a separate run, tracing slows down the stage
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best_time, peak / 1024 / 1024
+
+def run(tiers, repeat=1, seed=0):
+    # modules imported at their first use are loaded before timing the stages
+    import pandas
+    report = {}
+    for tier in tiers:
+        result = generate_result(**TIERS[tier], seed=seed)
+        # the tier tables must stay apart, otherwise the stages time a few large stitched tables
+        tables = len(parse_tables_utils.load_tables(result['tables'], result['pages']))
+        report[tier] = {'size': get_size(result), 'tables': tables, 'stages': {}}
+        print(f"{tier:<8} {'tables':<18} {tables:>9} of {len(result['tables'])}")
+        for stage, function in get_stages(result).items():
+            seconds, peak_mb = measure(function, repeat)
+            report[tier]['stages'][stage] = {'seconds': seconds, 'peak_mb': peak_mb}
+            print(f"{tier:<8} {stage:<18} {seconds:>9.3f} s {peak_mb:>9.1f} MB")
+    return report
+
+''' time growth exponent of each stage between consecutive tiers (1 is linear, 2 is quadratic) '''
+def get_scaling(report):
+    scaling = {}
+    tiers = [tier for tier in TIERS if tier in report]
+    for small, large in zip(tiers, tiers[1:]):
+        size_ratio = report[large]['size'] / report[small]['size']
+        for stage, values in report[large]['stages'].items():
+            small_seconds = report[small]['stages'][stage]['seconds']
+            if small_seconds > 0 and values['seconds'] > 0 and size_ratio > 1:
+                scaling[f"{stage} {small}-{large}"] = math.log(values['seconds'] / small_seconds) / math.log(size_ratio)
+    return scaling
+
+''' compare a report to the baseline, returns the regressions found '''
+def compare(report, baseline):
+    regressions = []
+    for tier, values in report.items():
+        for stage, current in values['stages'].items():
+            previous = baseline.get(tier, {}).get('stages', {}).get(stage)
+            if previous is None:
+                continue
+            difference = current['seconds'] - previous['seconds']
+            if difference > MIN_TIME_DIFFERENCE and current['seconds'] > previous['seconds'] * (1 + TIME_TOLERANCE):
+                regressions.append(f"{tier} {stage}: {current['seconds']:.3f}s (baseline {previous['seconds']:.3f}s)")
+    baseline_scaling = get_scaling(baseline)
+    for key, exponent in get_scaling(report).items():
+        if key in baseline_scaling and exponent > baseline_scaling[key] + SCALING_TOLERANCE:
+            regressions.append(f"{key} scaling: n^{exponent:.2f} (baseline n^{baseline_scaling[key]:.2f})")
+    return regressions
+
+''' import a module in a new interpreter, returns its best import time (seconds) and the lazy modules imported with it '''
+def measure_import(module="parse_tables", repeat=3):
+    code = f"import sys, time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start); print(','.join(name for name in {LAZY_MODULES!r} if name in sys.modules))"
+    best_time = math.inf
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", code], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.splitlines()
+        best_time = min(best_time, float(output[0]))
+    return best_time, [name for name in output[1].split(",") if name != ""]
+
+''' check the startup import time budget, returns the regressions found '''
+def check_import(module="parse_tables"):
+    seconds, modules = measure_import(module)
+    print(f"import   {module:<18} {seconds:>9.3f} s (budget {IMPORT_TIME_BUDGET:.3f} s)")
+    regressions = []
+    if seconds > IMPORT_TIME_BUDGET:
+        regressions.append(f"import {module}: {seconds:.3f}s (budget {IMPORT_TIME_BUDGET:.3f}s)")
+    if len(modules) > 0:
+        regressions.append(f"import {module} loads {', '.join(modules)} at startup")
+    return regressions
+
+def main(tiers, repeat=1, baseline_file=BASELINE_FILE, save_baseline=False, output=None):
+    import_regressions = check_import()
+    stub_completions()
+    report = run(tiers, repeat)
+    for key, exponent in get_scaling(report).items():
+        print(f"scaling {key:<36} n^{exponent:.2f}")
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    if save_baseline:
+        folder = os.path.dirname(baseline_file)
+        if folder != '':
+            os.makedirs(folder, exist_ok=True)
+        with open(baseline_file, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline saved to {baseline_file}")
+        regressions = []
+    elif not os.path.exists(baseline_file):
+        print(f"No baseline found ({baseline_file}), use --save-baseline to create one")
+        regressions = []
+    else:
+        with open(baseline_file) as f:
+            regressions = compare(report, json.load(f))
+    regressions = import_regressions + regressions
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"DONE ({len(regressions)} regressions)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the table parsing on synthetic documents')
+    parser.add_argument('--tiers', nargs='+', choices=list(TIERS), default=['small', 'medium'], help='size tiers to run')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each stage (the best time is reported)')
+    parser.add_argument('--baseline', type=str, default=BASELINE_FILE, help='baseline report file')
+    parser.add_argument('--save-baseline', action='store_true', help='save this run as the baseline')
+    parser.add_argument('--output', type=str, default=None, help='save this run report (json)')
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+    regressions = main(args.tiers, args.repeat, args.baseline, args.save_baseline, args.output)
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,97 @@
+"""
+Title: Cache Utils
+Author: Paulo Lacerda
+Description: Persistent key-value cache stored in a local SQLite file, with size-bounded LRU eviction
+
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+''' create a cache key hashing a list of json serializable values '''
+def get_key(*values):
+    return hashlib.sha256(json.dumps(values, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+class Cache:
+    def __init__(self, path, max_bytes) -> None:
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+        self.size = 0
+
+    ''' open the cache file (a new connection is needed after forking a process) '''
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            folder = os.path.dirname(self.path)
+            if folder != '':
+                os.makedirs(folder, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, size INTEGER, last_access REAL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access)")
+            self.connection.commit()
+            self.size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            self.pid = os.getpid()
+        return self.connection
+
+    ''' return the cached value or None when the key is not in the cache '''
+    def get(self, key):
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            connection.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            connection.commit()
+            return row[0]
+
+    ''' add a value (str or bytes) to the cache, evicting the least recently used entries when it is full '''
+    def set(self, key, value):
+        # the size limit is in bytes, str values are stored as utf-8
+        size = len(value.encode("utf-8")) if isinstance(value, str) else len(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            connection = self.connect()
+            row = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO entries (key, value, size, last_access) VALUES (?, ?, ?, ?)", (key, value, size, time.time()))
+            self.size += size - (row[0] if row is not None else 0)
+            if self.size > self.max_bytes:
+                self.evict(connection)
+            connection.commit()
+
+    ''' remove least recently used entries until the cache fits its maximum size '''
+    def evict(self, connection):
+        # other processes may share the file, so the size is refreshed before evicting
+        self.size = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        keys = []
+        for key, size in connection.execute("SELECT key, size FROM entries ORDER BY last_access"):
+            if self.size <= self.max_bytes:
+                break
+            keys.append((key,))
+            self.size -= size
+        connection.executemany("DELETE FROM entries WHERE key = ?", keys)
+
+    ''' remove all entries '''
+    def clear(self):
+        with self.lock:
+            connection = self.connect()
+            connection.execute("DELETE FROM entries")
+            connection.commit()
+            self.size = 0
+
+    ''' return cache usage counters '''
+    def stats(self):
+        with self.lock:
+            connection = self.connect()
+            entries = connection.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': self.size}
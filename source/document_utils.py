@@ -0,0 +1,380 @@
+"""
+Title: Document Utils
+Author: Paulo Lacerda
+Description: Compact (columnar) model of Form Recognizer analysis results.
+             Lines are stored in a few arrays (one text buffer, NumPy polygons and offsets) and tables in __slots__ records,
+             with a dict compatible view (data['pages'][0]['lines'][0]['content'], ...) so parse_tables_utils keeps working.
+
+"""
+from array import array
+import base64
+from collections.abc import Mapping, MutableMapping, Sequence
+import numpy as np
+
+# document style attributes (rest api name: sdk name)
+STYLE_ATTRIBUTES = {
+    'isHandwritten': 'is_handwritten',
+    'similarFontFamily': 'similar_font_family',
+    'fontStyle': 'font_style',
+    'fontWeight': 'font_weight',
+    'color': 'color',
+    'backgroundColor': 'background_color',
+    'confidence': 'confidence'
+}
+
+''' convert a document value (records, views, arrays) to plain python values '''
+def to_plain(value):
+    if isinstance(value, Mapping):
+        return {key: to_plain(value[key]) for key in value}
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple, Sequence)) and not isinstance(value, str):
+        return [to_plain(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+''' flat list of 8 coordinates from a polygon of 4 points (sdk) or a flat list (rest) '''
+def get_polygon(polygon):
+    if len(polygon) > 0 and not isinstance(polygon[0], (int, float)):
+        return tuple(coordinate for point in polygon for coordinate in (point[0], point[1]))
+    return tuple(polygon)
+
+### Records ###
+
+class Record(MutableMapping):
+    ''' dict compatible object storing its keys in __slots__ (missing keys are unset slots) '''
+    __slots__ = ()
+
+    def __init__(self, **values) -> None:
+        for key, value in values.items():
+            if value is not None:
+                setattr(self, key, value)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __delitem__(self, key):
+        try:
+            delattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def __iter__(self):
+        return (key for key in self.__slots__ if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __contains__(self, key):
+        return isinstance(key, str) and key in self.__slots__ and hasattr(self, key)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)})"
+
+    def copy(self):
+        record = type(self).__new__(type(self))
+        for key in self:
+            setattr(record, key, getattr(self, key))
+        return record
+
+    def to_dict(self):
+        return to_plain(self)
+
+class Span(Record):
+    __slots__ = ('offset', 'length')
+
+class BoundingRegion(Record):
+    __slots__ = ('pageNumber', 'polygon')
+
+class Cell(Record):
+    __slots__ = ('rowIndex', 'columnIndex', 'rowSpan', 'columnSpan', 'content', 'kind', 'spans', 'boundingRegions')
+
+class Table(Record):
+    __slots__ = ('rowCount', 'columnCount', 'cells', 'boundingRegions', 'spans')
+
+### Lines and pages views ###
+
+class Line(Mapping):
+    ''' dict compatible view of a document line '''
+    __slots__ = ('document', 'index')
+    KEYS = ('content', 'spans', 'polygon')
+
+    def __init__(self, document, index) -> None:
+        self.document = document
+        self.index = index
+
+    def __getitem__(self, key):
+        document, index = self.document, self.index
+        if key == 'content':
+            return document.text[document.line_start[index]:document.line_start[index+1]]
+        if key == 'spans':
+            start, end = document.line_spans[index], document.line_spans[index+1]
+            return [Span(offset=int(offset), length=int(length)) for offset, length in zip(document.span_offsets[start:end], document.span_lengths[start:end])]
+        if key == 'polygon':
+            return document.line_polygons[index]
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+class Lines(Sequence):
+    ''' list compatible view of the lines of a page '''
+    __slots__ = ('document', 'start', 'stop')
+
+    def __init__(self, document, start, stop) -> None:
+        self.document = document
+        self.start = start
+        self.stop = stop
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return Line(self.document, self.start + index)
+
+    def __len__(self):
+        return self.stop - self.start
+
+class Page(Mapping):
+    ''' dict compatible view of a document page '''
+    __slots__ = ('document', 'index')
+    KEYS = ('pageNumber', 'lines')
+
+    def __init__(self, document, index) -> None:
+        self.document = document
+        self.index = index
+
+    def __getitem__(self, key):
+        if key == 'pageNumber':
+            return int(self.document.page_numbers[self.index])
+        if key == 'lines':
+            return Lines(self.document, int(self.document.page_lines[self.index]), int(self.document.page_lines[self.index+1]))
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+class Pages(Sequence):
+    ''' list compatible view of the document pages '''
+    __slots__ = ('document',)
+
+    def __init__(self, document) -> None:
+        self.document = document
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return Page(self.document, index)
+
+    def __len__(self):
+        return len(self.document.page_numbers)
+
+    ''' (first span offset, content, polygon x) of the lines with spans, without creating line views '''
+    def first_spans(self):
+        document = self.document
+        indexes = np.flatnonzero(document.line_spans[1:] > document.line_spans[:-1])
+        offsets = document.span_offsets[document.line_spans[indexes]].tolist()
+        xs = document.line_polygons[indexes, 0].tolist()
+        line_start = document.line_start.tolist()
+        text = document.text
+        for index, offset, x in zip(indexes.tolist(), offsets, xs):
+            yield offset, text[line_start[index]:line_start[index+1]], x
+
+    ''' vertical extent (top, bottom) of the text lines of each page, by page number '''
+    def text_extents(self):
+        document = self.document
+        extents = {}
+        for index, page_number in enumerate(document.page_numbers.tolist()):
+            start, stop = document.page_lines[index], document.page_lines[index+1]
+            if stop > start:
+                polygons = document.line_polygons[start:stop]
+                extents[page_number] = (float(polygons[:, 1].min()), float(polygons[:, 5].max()))
+        return extents
+
+### Document ###
+
+class Document(Mapping):
+    ''' analysis result with 'pages', 'tables' and 'styles' keys, read like the result dictionaries (see to_dict) '''
+    __slots__ = ('text', 'line_start', 'line_polygons', 'line_spans', 'span_offsets', 'span_lengths', 'page_numbers', 'page_lines', 'tables', 'styles')
+    ARRAYS = ('line_start', 'line_polygons', 'line_spans', 'span_offsets', 'span_lengths', 'page_numbers', 'page_lines')
+
+    def __getitem__(self, key):
+        if key == 'pages':
+            return Pages(self)
+        if key == 'tables':
+            return self.tables
+        if key == 'styles' and self.styles is not None:
+            return self.styles
+        raise KeyError(key)
+
+    def __iter__(self):
+        keys = ['pages', 'tables']
+        if self.styles is not None:
+            keys.append('styles')
+        return iter(keys)
+
+    def __len__(self):
+        return 3 if self.styles is not None else 2
+
+    def to_dict(self):
+        return to_plain(self)
+
+    ''' json serializable columnar form (arrays as base64), much smaller than to_dict '''
+    def to_columns(self):
+        return {
+            'text': self.text,
+            'arrays': {name: base64.b64encode(np.ascontiguousarray(getattr(self, name)).tobytes()).decode("ascii") for name in self.ARRAYS},
+            'tables': to_plain(self.tables),
+            'styles': to_plain(self.styles)
+        }
+
+    ''' create a document from its columnar form '''
+    @classmethod
+    def from_columns(cls, columns):
+        document = cls.__new__(cls)
+        document.text = columns['text']
+        for name in cls.ARRAYS:
+            setattr(document, name, np.frombuffer(base64.b64decode(columns['arrays'][name]), dtype=np.float64 if name == 'line_polygons' else np.int64))
+        document.line_polygons = document.line_polygons.reshape(-1, 8)
+        document.tables = [get_table(table) for table in columns['tables']]
+        document.styles = [get_style(style) for style in columns['styles']] if columns['styles'] is not None else None
+        return document
+
+    ''' create a document from a dictionary (to_dict output or rest api analyzeResult) '''
+    @classmethod
+    def from_dict(cls, data):
+        builder = DocumentBuilder()
+        for page in data['pages']:
+            builder.add_page(page['pageNumber'])
+            for line in page['lines']:
+                builder.add_line(line['content'], line['polygon'], [(span['offset'], span['length']) for span in line['spans']])
+        tables = [get_table(table) for table in data.get('tables', [])]
+        styles = [get_style(style) for style in data['styles']] if 'styles' in data else None
+        return builder.build(tables, styles)
+
+    ''' create a document from a form recognizer sdk AnalyzeResult (without intermediate dictionaries) '''
+    @classmethod
+    def from_sdk_result(cls, result):
+        builder = DocumentBuilder()
+        for _page in result.pages:
+            builder.add_page(_page.page_number)
+            for _line in _page.lines:
+                builder.add_line(_line.content, _line.polygon, [(_span.offset, _span.length) for _span in _line.spans])
+        tables = []
+        for _table in result.tables:
+            tables.append(Table(
+                rowCount=_table.row_count,
+                columnCount=_table.column_count,
+                boundingRegions=[BoundingRegion(pageNumber=_region.page_number, polygon=get_polygon(_region.polygon)) for _region in _table.bounding_regions],
+                spans=[Span(offset=_span.offset, length=_span.length) for _span in _table.spans],
+                cells=[Cell(
+                    rowIndex=_cell.row_index,
+                    columnIndex=_cell.column_index,
+                    rowSpan=_cell.row_span,
+                    columnSpan=_cell.column_span,
+                    content=_cell.content,
+                    kind=_cell.kind,
+                    spans=[Span(offset=_span.offset, length=_span.length) for _span in _cell.spans],
+                    boundingRegions=[BoundingRegion(pageNumber=_region.page_number, polygon=get_polygon(_region.polygon)) for _region in (_cell.bounding_regions or [])]
+                ) for _cell in _table.cells]
+            ))
+        styles = []
+        for _style in (getattr(result, 'styles', None) or []):
+            style = {key: getattr(_style, attribute) for key, attribute in STYLE_ATTRIBUTES.items() if getattr(_style, attribute, None) is not None}
+            style['spans'] = [Span(offset=_span.offset, length=_span.length) for _span in _style.spans]
+            styles.append(style)
+        return builder.build(tables, styles)
+
+''' table record from a table dictionary '''
+def get_table(table):
+    cells = []
+    for cell in table['cells']:
+        cells.append(Cell(
+            rowIndex=cell['rowIndex'],
+            columnIndex=cell['columnIndex'],
+            rowSpan=cell.get('rowSpan'),
+            columnSpan=cell.get('columnSpan'),
+            content=cell['content'],
+            kind=cell.get('kind'),
+            spans=[Span(offset=span['offset'], length=span['length']) for span in cell['spans']],
+            boundingRegions=[BoundingRegion(pageNumber=region['pageNumber'], polygon=get_polygon(region['polygon'])) for region in cell['boundingRegions']] if 'boundingRegions' in cell else None
+        ))
+    return Table(
+        rowCount=table['rowCount'],
+        columnCount=table['columnCount'],
+        cells=cells,
+        boundingRegions=[BoundingRegion(pageNumber=region['pageNumber'], polygon=get_polygon(region['polygon'])) for region in table['boundingRegions']],
+        spans=[Span(offset=span['offset'], length=span['length']) for span in table['spans']] if 'spans' in table else None
+    )
+
+''' style dictionary with compact spans '''
+def get_style(style):
+    style = dict(style)
+    style['spans'] = [Span(offset=span['offset'], length=span['length']) for span in style.get('spans', [])]
+    return style
+
+class DocumentBuilder:
+    ''' collect pages and lines in flat arrays, then build the document '''
+    def __init__(self) -> None:
+        self.contents = []
+        self.line_start = array('q', [0])
+        self.line_polygons = array('d')
+        self.line_spans = array('q', [0])
+        self.span_offsets = array('q')
+        self.span_lengths = array('q')
+        self.page_numbers = array('q')
+        self.page_lines = array('q', [0])
+        self.text_length = 0
+
+    def add_page(self, page_number):
+        self.page_numbers.append(page_number)
+        self.page_lines.append(self.page_lines[-1])
+
+    def add_line(self, content, polygon, spans):
+        self.contents.append(content)
+        self.text_length += len(content)
+        self.line_start.append(self.text_length)
+        polygon = get_polygon(polygon)
+        self.line_polygons.extend(polygon if len(polygon) == 8 else (polygon + (0.0,) * 8)[:8])
+        for offset, length in spans:
+            self.span_offsets.append(offset)
+            self.span_lengths.append(length)
+        self.line_spans.append(len(self.span_offsets))
+        self.page_lines[-1] += 1
+
+    def build(self, tables, styles):
+        document = Document.__new__(Document)
+        document.text = "".join(self.contents)
+        document.line_start = np.frombuffer(self.line_start, dtype=np.int64)
+        document.line_polygons = np.frombuffer(self.line_polygons, dtype=np.float64).reshape(-1, 8)
+        document.line_spans = np.frombuffer(self.line_spans, dtype=np.int64)
+        document.span_offsets = np.frombuffer(self.span_offsets, dtype=np.int64)
+        document.span_lengths = np.frombuffer(self.span_lengths, dtype=np.int64)
+        document.page_numbers = np.frombuffer(self.page_numbers, dtype=np.int64)
+        document.page_lines = np.frombuffer(self.page_lines, dtype=np.int64)
+        document.tables = tables
+        document.styles = styles
+        return document
@@ -6,146 +6,308 @@ Description: Module to analyze documents using Form Recognizer using its REST AP
 """
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.formrecognizer import DocumentAnalysisClient
 import os
-import requests
+import asyncio
 import json
 import time
-import base64
+import mimetypes
+import hashlib
+import zlib
+import metrics_utils
+from cache_utils import Cache, get_key
+from document_utils import Document
+from general_utils import logger
 
 endpoint =  os.getenv("FORM_RECOGNIZER_ENDPOINT")
 api_key =  os.getenv("FORM_RECOGNIZER_KEY")
 
-''' this function creates a base64EncodedContent from a file path '''
-def get_base64_encoded_content(filepath):
+## ANALYSIS RESULTS CACHE ##
+
+FORM_RECOGNIZER_CACHE_FILE = os.getenv("FORM_RECOGNIZER_CACHE_FILE", ".cache/analysis.sqlite") # empty value disables the analysis cache
+FORM_RECOGNIZER_CACHE_MAX_BYTES = int(os.getenv("FORM_RECOGNIZER_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+analysis_cache = None
+
+''' get the persistent analysis results cache (None when it is disabled) '''
+def get_analysis_cache():
+    global analysis_cache
+    if analysis_cache is None and FORM_RECOGNIZER_CACHE_FILE:
+        analysis_cache = Cache(FORM_RECOGNIZER_CACHE_FILE, FORM_RECOGNIZER_CACHE_MAX_BYTES)
+    return analysis_cache
+
+''' sha256 of a file content '''
+def get_file_hash(filepath):
+    file_hash = hashlib.sha256()
     with open(filepath, "rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
 
-def analyze_document_rest(filepath, model, features=[]):
-    base64EncodedContent = get_base64_encoded_content(filepath)
+''' analysis cache key: file content hash, model id, features and api (rest and sdk results have different formats) '''
+def get_analysis_key(filepath, model, features, api):
+    return get_key(get_file_hash(filepath), model, sorted(features), api)
 
-    # Request headers
-    headers = {
-        "Content-Type": "application/json",
-        "Ocp-Apim-Subscription-Key": api_key
-    }
+''' return the cached analysis result or None when it is not cached '''
+def get_cached_analysis(key):
+    cache = get_analysis_cache()
+    value = cache.get(key) if cache is not None else None
+    if cache is not None:
+        metrics_utils.increment("cache_hits" if value is not None else "cache_misses", cache="analysis")
+    if value is None:
+        return None
+    return json.loads(zlib.decompress(value).decode("utf-8"))
 
-    # Request body
-    body = {
-        "base64Source": base64EncodedContent
-    }
+''' store an analysis result in the cache (compressed json) '''
+def set_cached_analysis(key, result):
+    cache = get_analysis_cache()
+    if cache is not None and len(result) > 0:
+        cache.set(key, zlib.compress(json.dumps(result).encode("utf-8")))
+
+## REST API ##
+
+API_VERSION = "2023-02-28-preview"
+POLL_INTERVAL = 1.0 # First wait (seconds) before polling an analysis result.
+POLL_BACKOFF = 1.5 # Poll interval growth factor while the analysis is running.
+POLL_MAX_INTERVAL = 10.0 # Max wait (seconds) between polls.
+MAX_RETRIES = 10 # Max retries of a rate limited (429) request.
+ANALYSIS_TIMEOUT = 30 * 60 # Max time (seconds) waiting for an analysis result.
+SESSION_POOL_SIZE = 32 # Max pooled connections to the service.
+
+class FormRecognizerError(Exception):
+    pass
+
+class AnalysisRequestError(FormRecognizerError):
+    def __init__(self, status_code, message) -> None:
+        super().__init__(f"request failed with status {status_code}: {message}")
+        self.status_code = status_code
+
+class AnalysisFailedError(FormRecognizerError):
+    pass
+
+class AnalysisTimeoutError(FormRecognizerError):
+    pass
 
-    # if user wants to get features
+session = None
+
+''' get the http session shared by all rest requests (pooled connections) '''
+def get_session():
+    global session
+    if session is None:
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=SESSION_POOL_SIZE, pool_maxsize=SESSION_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+    return session
+
+''' analyze request url and query parameters '''
+def get_analyze_request(model, features=[]):
+    url = f"{endpoint}formrecognizer/documentModels/{model}:analyze"
     if len(features) > 0:
-        features_str = ",".join(features) # TODO: review if this is the proper way to add a list of features to the parameters   
-        request_endpoint = f"{endpoint}formrecognizer/documentModels/{model}:analyze?features={features_str}&api-version=2023-02-28-preview"
-    else:
-        request_endpoint = f"{endpoint}formrecognizer/documentModels/{model}:analyze?api-version=2023-02-28-preview&locale=en-US"
-    
-    # Send request
-    response = requests.post(request_endpoint, headers=headers, json=body)
-
-    # Parse response
-    if response.status_code == 202:
-        # Request accepted, get operation ID
-        operation_id = response.headers["Operation-Location"].split("/")[-1]
-        # print("Operation ID:", operation_id)
+        params = {'api-version': API_VERSION, 'features': ",".join(features)}
     else:
-        # Request failed
-        print("Error request: ", response.text)
-        exit()
-
-    # Poll for result
-    result_endpoint = f"{endpoint}formrecognizer/documentModels/prebuilt-layout/analyzeResults/{operation_id}"
-    result_headers = headers.copy()
-    result_headers["Content-Type"] = "application/json-patch+json"
-    result = {}
-
-    while True:
-        result_response = requests.get(result_endpoint, headers=result_headers)
-        result_json = json.loads(result_response.text)
-
-        if result_response.status_code != 200 or result_json["status"] == "failed":
-            # Request failed
-            print("Error result: ", result_response.text)
-            break
+        params = {'api-version': API_VERSION, 'locale': 'en-US'}
+    return url, params
+
+''' content type of the document file (sent as raw bytes) '''
+def get_content_type(filepath):
+    content_type, _ = mimetypes.guess_type(filepath)
+    return content_type or "application/octet-stream"
+
+''' seconds to wait before the next request, at least the Retry-After sent by the service '''
+def get_retry_after(headers, default):
+    try:
+        return max(default, float(headers.get("Retry-After", 0)))
+    except ValueError:
+        return default
+
+''' headers of the analyze request (the file content is sent as raw bytes) and of the result requests '''
+def get_analyze_headers(filepath):
+    return {
+        "Content-Type": get_content_type(filepath),
+        "Ocp-Apim-Subscription-Key": api_key
+    }
+
+def get_result_headers():
+    return {"Ocp-Apim-Subscription-Key": api_key}
+
+''' check an analyze request response, returns the seconds to wait before sending it again (rate limited) or None when it was accepted '''
+def check_analyze_response(filepath, status_code, headers, text, attempt):
+    if status_code == 429 and attempt < MAX_RETRIES:
+        wait = get_retry_after(headers, POLL_INTERVAL * 2 ** attempt)
+        logger.debug(f"Analyze request of {filepath} rate limited, retrying in {wait:.1f} sec")
+        metrics_utils.increment("retries", service="analysis")
+        return wait
+    if status_code != 202:
+        raise AnalysisRequestError(status_code, text)
+    return None
+
+class AnalysisPoll:
+    ''' polling state of a submitted analysis: waits longer while the analysis is running, raises the typed errors of the service responses '''
+    def __init__(self, filepath, headers) -> None:
+        self.filepath = filepath
+        self.operation_location = headers["Operation-Location"]
+        self.interval = POLL_INTERVAL
+        self.started = time.monotonic()
+        self.deadline = self.started + ANALYSIS_TIMEOUT
+        self.wait = get_retry_after(headers, self.interval) # before the first poll
 
+    def check_timeout(self):
+        if time.monotonic() > self.deadline:
+            raise AnalysisTimeoutError(f"analysis of {self.filepath} did not finish in {ANALYSIS_TIMEOUT} sec")
+
+    ''' check a result response, returns the analysis result or None (poll again after self.wait seconds) '''
+    def check(self, status_code, headers, text):
+        metrics_utils.increment("polls", service="analysis")
+        if status_code == 429:
+            metrics_utils.increment("retries", service="analysis")
+            self.wait = get_retry_after(headers, self.interval)
+            return None
+        if status_code != 200:
+            raise AnalysisRequestError(status_code, text)
+
+        result_json = json.loads(text)
+        if result_json["status"] == "failed":
+            raise AnalysisFailedError(f"analysis of {self.filepath} failed: {json.dumps(result_json.get('error', {}))}")
         if result_json["status"] == "succeeded":
-            # Request succeeded, print result
-            # print("Result:", json.dumps(json.dumps(result_json['analyzeResult']), indent=4))
-            result = result_json['analyzeResult']
-            break
+            metrics_utils.increment("calls", service="analysis")
+            metrics_utils.observe("stage_seconds", time.monotonic() - self.started, stage="analysis_poll")
+            return result_json['analyzeResult']
 
         # Request still processing, wait and try again
-        time.sleep(1)
+        self.interval = min(self.interval * POLL_BACKOFF, POLL_MAX_INTERVAL)
+        self.wait = get_retry_after(headers, self.interval)
+        return None
+
+def analyze_document_rest(filepath, model, features=[], refresh=False):
+    cache_key = get_analysis_key(filepath, model, features, "rest")
+    if not refresh:
+        result = get_cached_analysis(cache_key)
+        if result is not None:
+            logger.debug(f"Using cached analysis of {filepath}")
+            return result
+
+    http = get_session()
+    headers = get_analyze_headers(filepath)
+    request_endpoint, params = get_analyze_request(model, features)
+
+    # send the file content as a stream (no base64 copy in memory)
+    for attempt in range(MAX_RETRIES + 1):
+        with open(filepath, "rb") as f, metrics_utils.span("analysis_submit"):
+            response = http.post(request_endpoint, params=params, headers=headers, data=f)
+        wait = check_analyze_response(filepath, response.status_code, response.headers, response.text, attempt)
+        if wait is None:
+            break
+        time.sleep(wait)
+
+    # poll for result, waiting longer while the analysis is running
+    poll = AnalysisPoll(filepath, response.headers)
+    result = None
+    while result is None:
+        time.sleep(poll.wait)
+        poll.check_timeout()
+        result_response = http.get(poll.operation_location, headers=get_result_headers())
+        result = poll.check(result_response.status_code, result_response.headers, result_response.text)
+
+    set_cached_analysis(cache_key, result)
+
+    return result
+
+''' asyncio version of analyze_document_rest, using an aiohttp session '''
+async def analyze_document_rest_async(http, filepath, model, features=[], refresh=False):
+    loop = asyncio.get_running_loop()
+    # file hashing and cache access run in threads to keep polling other analyses
+    cache_key = await loop.run_in_executor(None, get_analysis_key, filepath, model, features, "rest")
+    if not refresh:
+        result = await loop.run_in_executor(None, get_cached_analysis, cache_key)
+        if result is not None:
+            logger.debug(f"Using cached analysis of {filepath}")
+            return result
+
+    headers = get_analyze_headers(filepath)
+    request_endpoint, params = get_analyze_request(model, features)
+
+    # send the file content as a stream (no base64 copy in memory)
+    for attempt in range(MAX_RETRIES + 1):
+        with open(filepath, "rb") as f, metrics_utils.span("analysis_submit"):
+            async with http.post(request_endpoint, params=params, headers=headers, data=f) as response:
+                response_headers, response_text = response.headers, await response.text()
+        wait = check_analyze_response(filepath, response.status, response_headers, response_text, attempt)
+        if wait is None:
+            break
+        await asyncio.sleep(wait)
+
+    # poll for result, waiting longer while the analysis is running
+    poll = AnalysisPoll(filepath, response_headers)
+    result = None
+    while result is None:
+        await asyncio.sleep(poll.wait)
+        poll.check_timeout()
+        async with http.get(poll.operation_location, headers=get_result_headers()) as result_response:
+            result = poll.check(result_response.status, result_response.headers, await result_response.text())
+
+    await loop.run_in_executor(None, set_cached_analysis, cache_key, result)
 
     return result
 
-def convert_to_dict(object):
-    data = {}
-    data['pages'] = []
-    for _page in object.pages:
-        page = {'pageNumber': _page.page_number, 'lines': []}
-        for _line in _page.lines:
-            line = {'content': _line.content, 'spans': []}
-            line['polygon'] = [ _line.polygon[0][0],
-                                _line.polygon[0][1],
-                                _line.polygon[1][0],
-                                _line.polygon[1][1],
-                                _line.polygon[2][0],
-                                _line.polygon[2][1],
-                                _line.polygon[3][0],
-                                _line.polygon[3][1]]
-            for _span in _line.spans:
-                span = {'offset': _span.offset, 'length': _span.length}
-                line['spans'].append(span)
-            page['lines'].append(line)
-        data['pages'].append(page)
-    data['tables'] = []
-    for _table in object.tables:
-        table = {'cells': [], 'boundingRegions': [], 'columnCount': _table.column_count, 'rowCount': _table.row_count}
-        for _boundingRegion in _table.bounding_regions:
-            boundingRegion = {'pageNumber': _boundingRegion.page_number, 'polygon': [_boundingRegion.polygon[0][0],
-                                                                                    _boundingRegion.polygon[0][1],
-                                                                                    _boundingRegion.polygon[1][0],
-                                                                                    _boundingRegion.polygon[1][1],
-                                                                                    _boundingRegion.polygon[2][0],
-                                                                                    _boundingRegion.polygon[2][1],
-                                                                                    _boundingRegion.polygon[3][0],
-                                                                                    _boundingRegion.polygon[3][1]]}
-            table['boundingRegions'].append(boundingRegion)
-        for _cell in _table.cells:
-            cell = {}
-            cell = {
-                'rowIndex': _cell.row_index,
-                'columnIndex': _cell.column_index,
-                'rowSpan': _cell.row_span,
-                'columnSpan': _cell.column_span,
-                'content': _cell.content,
-                'kind': _cell.kind,                
-                'spans': []
-            }
-            for _span in _cell.spans:
-                span = {'offset': _span.offset, 'length': _span.length}
-                cell['spans'].append(span)
-            table['cells'].append(cell)
-        data['tables'].append(table)
-    return data
-
-def analyze_document_sdk(filepath, model):
-    # connect to service
-    document_analysis_client = DocumentAnalysisClient(
-        endpoint=endpoint, credential=AzureKeyCredential(api_key)
-    )
+''' analyze many documents from one event loop keeping up to max_in_flight analyses running.
+    yields (filepath, result, error) as each analysis completes, error is None when it succeeds '''
+async def analyze_documents_rest(filepaths, model, features=[], max_in_flight=16, refresh=False):
+    import aiohttp
+    semaphore = asyncio.Semaphore(max_in_flight)
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+    async with aiohttp.ClientSession(connector=connector) as http:
+        async def analyze(filepath):
+            async with semaphore:
+                try:
+                    return filepath, await analyze_document_rest_async(http, filepath, model, features, refresh), None
+                except Exception as e:
+                    logger.error(f"Error analyzing {filepath}: {e}")
+                    return filepath, None, e
+        tasks = [asyncio.ensure_future(analyze(filepath)) for filepath in filepaths]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+
+document_analysis_client = None
+
+''' get the document analysis client, shared by all analyses (the client is thread safe) '''
+def get_client():
+    global document_analysis_client
+    if document_analysis_client is None:
+        # the sdk is only imported when a document is analyzed (not for cached results)
+        from azure.core.credentials import AzureKeyCredential
+        from azure.ai.formrecognizer import DocumentAnalysisClient
+        document_analysis_client = DocumentAnalysisClient(
+            endpoint=endpoint, credential=AzureKeyCredential(api_key)
+        )
+    return document_analysis_client
+
+''' analyze a document with the sdk, returns a compact Document (dict compatible, see document_utils) '''
+def analyze_document_sdk(filepath, model, refresh=False):
+    cache_key = get_analysis_key(filepath, model, [], "sdk-document")
+    if not refresh:
+        result = get_cached_analysis(cache_key)
+        if result is not None:
+            logger.debug(f"Using cached analysis of {filepath}")
+            return Document.from_columns(result)
 
     # analyze document file
-    with open(filepath, "rb") as f:
-        poller = document_analysis_client.begin_analyze_document(
+    with metrics_utils.span("analysis_submit"), open(filepath, "rb") as f:
+        poller = get_client().begin_analyze_document(
             model, document=f
         )
-    result = poller.result()
-    
-    result = convert_to_dict(result)
+    with metrics_utils.span("analysis_poll"):
+        result = poller.result()
+    metrics_utils.increment("calls", service="analysis")
+
+    with metrics_utils.span("convert"):
+        document = Document.from_sdk_result(result)
+    del result
+
+    set_cached_analysis(cache_key, document.to_columns())
 
-    return result
\ No newline at end of file
+    return document
\ No newline at end of file
@@ -0,0 +1,153 @@
+"""
+Title: Manifest Utils
+Author: Paulo Lacerda
+Description: Per document manifest for incremental reprocessing: the input hash, the fingerprints of the analyze, parse and write stages
+             and the output files produced. A rerun skips the documents whose stages are current and only runs the stages downstream of a change.
+
+"""
+import hashlib
+import json
+import os
+import pickle
+import time
+import zlib
+import openai_utils
+import parse_tables_utils
+import formrec_utils as fr
+from cache_utils import Cache, get_key
+from general_utils import logger
+
+PARSER_VERSION = 1 # Increase when a parsing code change modifies the parsed tables, so every document is parsed again.
+STAGES = ['analyze', 'parse', 'write']
+# parse_tables_utils parameters that change the parsed tables (and the prompts, by their content)
+PARSING_PARAMETERS = ['PARENT_INDENT_THRESHOLD', 'MERGE_TABLES_THRESHOLD', 'MERGE_PAGES', 'COLUMN_ALIGN_THRESHOLD', 'PAGE_EDGE_THRESHOLD', 'IGNORE_ITEMS_LIST', 'MUST_HAVE_COLUMNS',
+                      'VALIDATION_BATCH_SIZE', 'VALIDATION_ANSWER_TOKENS', 'VALIDATION_MAX_CHARS', 'COLUMN_NAME_ANSWER_TOKENS', 'TABLE_SAMPLE_ROWS']
+PROMPTS = ['VALIDATE_ATTRIBUTE_PROMPT', 'VALIDATE_ATTRIBUTES_PROMPT', 'INFER_COLUMN_NAMES_PROMPT']
+
+## PARSED TABLES CACHE ##
+
+TABLES_CACHE_FILE = os.getenv("TABLES_CACHE_FILE", ".cache/tables.sqlite") # empty value disables the parsed tables cache
+TABLES_CACHE_MAX_BYTES = int(os.getenv("TABLES_CACHE_MAX_BYTES", 1024 * 1024 * 1024))
+
+tables_cache = None
+
+''' get the persistent parsed tables cache (None when it is disabled) '''
+def get_tables_cache():
+    global tables_cache
+    if tables_cache is None and TABLES_CACHE_FILE:
+        tables_cache = Cache(TABLES_CACHE_FILE, TABLES_CACHE_MAX_BYTES)
+    return tables_cache
+
+''' return the parsed tables (dataframes) of a parse fingerprint or None when they are not cached '''
+def get_cached_tables(fingerprint):
+    cache = get_tables_cache()
+    value = cache.get(fingerprint) if cache is not None else None
+    if value is None:
+        return None
+    return pickle.loads(zlib.decompress(value))
+
+def set_cached_tables(fingerprint, dataframes):
+    cache = get_tables_cache()
+    if cache is not None:
+        cache.set(fingerprint, zlib.compress(pickle.dumps(list(dataframes))))
+
+## FINGERPRINTS ##
+
+''' parsing parameters (prompts by their content hash) '''
+def get_parameters():
+    parameters = {name: getattr(parse_tables_utils, name) for name in PARSING_PARAMETERS}
+    for name in PROMPTS:
+        prompt = parse_tables_utils.get_prompt(getattr(parse_tables_utils, name))
+        parameters[name] = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    parameters['deployment_model'] = dict(openai_utils.deployment_model)
+    parameters['PARSER_VERSION'] = PARSER_VERSION
+    return parameters
+
+''' fingerprint of each stage, a stage fingerprint changes when its inputs or any upstream stage fingerprint change
+    (sharded analyses are stitched from the shard results, and the output path is only set for consolidated batch outputs) '''
+def get_fingerprints(input_hash, model, pages_per_shard, parameters, sink):
+    analyze = get_key(input_hash, model, pages_per_shard)
+    parse = get_key(analyze, parameters)
+    write = get_key(parse, sink.extension, sink.scope, sink.output if sink.scope == 'batch' else None)
+    return {'analyze': analyze, 'parse': parse, 'write': write}
+
+''' manifest file of a document, saved next to its output files (example: data/Sample 4.manifest.json) '''
+def get_manifest_path(file):
+    return f"{os.path.splitext(file)[0]}.manifest.json"
+
+class Manifest:
+    def __init__(self, file, model, sink, pages_per_shard=None) -> None:
+        self.file = file
+        self.sink = sink
+        self.path = get_manifest_path(file)
+        self.parameters = get_parameters()
+        self.input_hash = fr.get_file_hash(file)
+        self.fingerprints = get_fingerprints(self.input_hash, model, pages_per_shard, self.parameters, sink)
+        self.previous = self.load()
+        self.stages = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not read the manifest of {self.file}, processing it again: {e}")
+            return {}
+
+    ''' the stage ran with the current inputs (the write stage also needs its output files, and consolidated batch files are always written) '''
+    def is_current(self, stage):
+        previous = self.previous.get('stages', {}).get(stage)
+        if previous is None or previous['fingerprint'] != self.fingerprints[stage]:
+            return False
+        if stage == 'write':
+            return self.sink.scope != 'batch' and all(os.path.exists(path) for path in previous['outputs'])
+        return True
+
+    ''' the first stage that has to run (None when the document is up to date) and why '''
+    def get_first_stage(self):
+        for stage in STAGES:
+            if not self.is_current(stage):
+                return stage, self.get_reason(stage)
+        return None, "up to date"
+
+    def get_reason(self, stage):
+        if len(self.previous) == 0:
+            return "no manifest"
+        if self.previous.get('input_hash') != self.input_hash:
+            return "file changed"
+        if stage == 'parse':
+            changed = [name for name, value in self.parameters.items() if self.previous.get('parameters', {}).get(name) != value]
+            return f"parameters changed: {', '.join(changed)}" if len(changed) > 0 else "parse fingerprint changed"
+        if stage == 'analyze':
+            return "model or pages per shard changed"
+        if stage == 'write':
+            return "consolidated batch output" if self.sink.scope == 'batch' else "output format changed or output files missing"
+        return f"{stage} fingerprint changed"
+
+    ''' the parsed tables, when the parse stage is current and its tables are still cached '''
+    def get_tables(self):
+        if not self.is_current('parse'):
+            return None
+        return get_cached_tables(self.fingerprints['parse'])
+
+    def set_tables(self, dataframes):
+        set_cached_tables(self.fingerprints['parse'], dataframes)
+        self.stages['analyze'] = {'fingerprint': self.fingerprints['analyze'], 'finished': time.time()}
+        self.stages['parse'] = {'fingerprint': self.fingerprints['parse'], 'tables': len(dataframes), 'finished': time.time()}
+
+    def set_outputs(self, outputs):
+        self.stages['write'] = {'fingerprint': self.fingerprints['write'], 'outputs': outputs, 'finished': time.time()}
+
+    ''' save the manifest (the stages that did not run keep their previous record) '''
+    def save(self):
+        stages = dict(self.previous.get('stages', {}))
+        stages.update(self.stages)
+        manifest = {'file': self.file, 'input_hash': self.input_hash, 'parameters': self.parameters, 'stages': stages}
+        temp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(manifest, f, indent=2, default=str)
+        os.replace(temp_path, self.path)
+        self.previous = manifest
+        self.stages = {}
@@ -0,0 +1,240 @@
+"""
+Title: Metrics Utils
+Author: Paulo Lacerda
+Description: Lightweight run instrumentation: stage spans (latency histograms) and counters (calls, tokens, retries, cache hits),
+             saved as a json run report or a Prometheus textfile. Disabled by default, recording is a no-op until enable() is called.
+
+"""
+import bisect
+import contextlib
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+METRICS_PREFIX = "formrec" # Prometheus metric names prefix.
+# latency histogram buckets (seconds), from cached lookups to long running analyses
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+enabled = False
+lock = threading.Lock()
+counters = {} # (name, labels) -> value
+histograms = {} # (name, labels) -> Histogram
+started = time.time()
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one counts the values above the last bucket
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, values):
+        self.counts = [count + other for count, other in zip(self.counts, values['counts'])]
+        self.count += values['count']
+        self.sum += values['sum']
+        self.min = min(self.min, values['min'])
+        self.max = max(self.max, values['max'])
+
+    ''' estimate a quantile from the buckets (upper bound of the bucket containing it, capped by the max value) '''
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return min(bucket, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {'buckets': list(self.buckets), 'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+''' start recording metrics '''
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+''' metric key, labels are kept as sorted (name, value) pairs '''
+def get_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+''' add value to a counter '''
+def increment(name, value=1, **labels):
+    if not enabled:
+        return
+    key = get_key(name, labels)
+    with lock:
+        counters[key] = counters.get(key, 0) + value
+
+''' add a value to a histogram '''
+def observe(name, value, **labels):
+    if not enabled:
+        return
+    key = get_key(name, labels)
+    with lock:
+        if key not in histograms:
+            histograms[key] = Histogram()
+        histograms[key].observe(value)
+
+@contextlib.contextmanager
+def recording_span(stage, labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("stage_seconds", time.perf_counter() - start, stage=stage, **labels)
+
+null_span = contextlib.nullcontext()
+
+''' time a block as a pipeline stage (spans of nested stages overlap) '''
+def span(stage, **labels):
+    if not enabled:
+        return null_span
+    return recording_span(stage, labels)
+
+''' decorator version of span '''
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with recording_span(stage, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+''' time the production of each item of an iterator (generators doing their work between yields) '''
+def timed_iter(stage, iterable):
+    iterator = iter(iterable)
+    while True:
+        with span(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+''' snapshot of the recorded metrics (picklable, to send them from worker processes) '''
+def snapshot():
+    with lock:
+        return {
+            'counters': [(name, labels, value) for (name, labels), value in counters.items()],
+            'histograms': [(name, labels, histogram.to_dict()) for (name, labels), histogram in histograms.items()]
+        }
+
+''' snapshot of the recorded metrics, clearing them (a worker process sends each task metrics once) '''
+def collect():
+    values = snapshot()
+    reset()
+    return values
+
+''' add the metrics of a snapshot (e.g. recorded by a worker process) '''
+def merge(values):
+    if not enabled or values is None:
+        return
+    with lock:
+        for name, labels, value in values['counters']:
+            key = (name, tuple(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, histogram_values in values['histograms']:
+            key = (name, tuple(labels))
+            if key not in histograms:
+                histograms[key] = Histogram(tuple(histogram_values['buckets']))
+            histograms[key].merge(histogram_values)
+
+def reset():
+    global started
+    with lock:
+        counters.clear()
+        histograms.clear()
+        started = time.time()
+
+def format_labels(labels):
+    return ",".join(f"{name}={value}" for name, value in labels)
+
+''' run report: counters and histogram summaries (count, sum, mean, min, max and estimated p50, p95, p99) '''
+def get_report():
+    with lock:
+        report = {'started': started, 'duration_seconds': time.time() - started, 'counters': {}, 'histograms': {}}
+        for (name, labels), value in sorted(counters.items()):
+            report['counters'].setdefault(name, {})[format_labels(labels)] = value
+        for (name, labels), histogram in sorted(histograms.items()):
+            report['histograms'].setdefault(name, {})[format_labels(labels)] = {
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'mean': histogram.sum / histogram.count,
+                'min': histogram.min,
+                'max': histogram.max,
+                'p50': histogram.quantile(0.5),
+                'p95': histogram.quantile(0.95),
+                'p99': histogram.quantile(0.99)
+            }
+    return report
+
+''' write a file atomically (textfile collectors may read it while it is written) '''
+def write_file(path, content):
+    folder = os.path.dirname(path)
+    if folder != '':
+        os.makedirs(folder, exist_ok=True)
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+def write_report(path):
+    write_file(path, json.dumps(get_report(), indent=2))
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_prometheus_labels(labels, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(labels) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if len(pairs) > 0 else ""
+
+''' metrics in the Prometheus text format (counters as <prefix>_<name>_total, histograms with cumulative buckets) '''
+def get_prometheus_text():
+    lines = []
+    with lock:
+        names = sorted(set(name for name, _ in counters))
+        for name in names:
+            metric = f"{METRICS_PREFIX}_{name}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (counter_name, labels), value in sorted(counters.items()):
+                if counter_name == name:
+                    lines.append(f"{metric}{format_prometheus_labels(labels)} {value}")
+        names = sorted(set(name for name, _ in histograms))
+        for name in names:
+            metric = f"{METRICS_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (histogram_name, labels), histogram in sorted(histograms.items()):
+                if histogram_name != name:
+                    continue
+                total = 0
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append(f"{metric}_bucket{format_prometheus_labels(labels, [('le', bucket)])} {total}")
+                lines.append(f"{metric}_bucket{format_prometheus_labels(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{metric}_sum{format_prometheus_labels(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{format_prometheus_labels(labels)} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path):
+    write_file(path, get_prometheus_text())
@@ -0,0 +1,287 @@
+"""
+Title: Mock Services
+Author: Paulo Lacerda
+Description: Local stand-in servers for Form Recognizer (analyze submit/poll protocol) and Azure OpenAI (completions endpoint),
+             serving recorded or synthetic results with configurable latency, rate limiting (429) and failures, for offline load tests.
+             Point the clients to it with FORM_RECOGNIZER_ENDPOINT and AZURE_OPENAI_ENDPOINT (printed when the server starts).
+
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+from synthetic_utils import generate_result
+from general_utils import logger
+
+API_VERSION = "2023-02-28-preview"
+ANALYZE_PATH = re.compile(r"^/formrecognizer/documentModels/([^/:]+):analyze$")
+RESULT_PATH = re.compile(r"^/formrecognizer/documentModels/([^/:]+)/analyzeResults/([^/]+)$")
+COMPLETIONS_PATH = re.compile(r"^/openai/deployments/([^/]+)/completions$")
+# synthetic results parameters (see synthetic_utils.generate_result)
+SYNTHETIC_RESULT = {'pages': 5, 'lines': 20, 'tables': 3, 'rows': 30, 'columns': 4, 'depth': 3, 'styles': 10}
+
+''' save an analysis result (rest api format) to be served for a file, results are found by the file content hash '''
+def record_result(filepath, result, folder):
+    with open(filepath, "rb") as f:
+        content_hash = hashlib.sha256(f.read()).hexdigest()
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, f"{content_hash}.json"), "w") as f:
+        json.dump(result, f)
+
+''' complete a synthetic result (Document.to_dict format) with the rest api result fields '''
+def to_rest_result(result, model):
+    lines = [line for page in result['pages'] for line in page['lines']]
+    # synthetic lines are consecutive in the content, separated by line breaks
+    content = "\n".join(line['content'] for line in lines)
+    pages = []
+    for page in result['pages']:
+        offset = page['lines'][0]['spans'][0]['offset'] if len(page['lines']) > 0 else 0
+        end = page['lines'][-1]['spans'][0]['offset'] + page['lines'][-1]['spans'][0]['length'] if len(page['lines']) > 0 else 0
+        pages.append({'pageNumber': page['pageNumber'], 'angle': 0, 'width': 8.5, 'height': 11, 'unit': 'inch',
+                      'words': [], 'lines': page['lines'], 'spans': [{'offset': offset, 'length': end - offset}]})
+    return {'apiVersion': API_VERSION, 'modelId': model, 'stringIndexType': 'textElements', 'content': content,
+            'pages': pages, 'tables': result['tables'], 'styles': result['styles'], 'paragraphs': [], 'keyValuePairs': []}
+
+''' answer of a mocked completion: every validated item is valid and every column name is inferred '''
+def get_completion_answer(prompt):
+    prompt = prompt.split("###")[-1]
+    if "Old column names:" in prompt:
+        columns = prompt.split("Old column names:")[-1].split("New column names:")[0].strip().splitlines()
+        return "\n".join(f"{column}: Inferred {column}" for column in columns if column.strip() != "")
+    if "items:" in prompt:
+        items = re.findall(r"^\s*(\d+)\. column name:", prompt, re.MULTILINE)
+        return "\n".join(f"{number}: valid" for number in items)
+    return "valid"
+
+class MockServices:
+    def __init__(self, results_folder=None, analysis_latency=2.0, completion_latency=0.2, jitter=0.5, rate_limit_rate=0.0,
+                 failure_rate=0.0, retry_after=1, poll_interval=1, seed=None) -> None:
+        self.results_folder = results_folder # recorded results (<file sha256>.json), synthetic results for other files
+        self.analysis_latency = analysis_latency # seconds until an analysis succeeds
+        self.completion_latency = completion_latency # seconds to answer a completion
+        self.jitter = jitter # random latency variation (fraction of the latency)
+        self.rate_limit_rate = rate_limit_rate # fraction of the requests rejected with 429
+        self.failure_rate = failure_rate # fraction of the analyses and completions that fail
+        self.retry_after = retry_after # Retry-After (seconds) of the rate limited requests
+        self.poll_interval = poll_interval # Retry-After (seconds) of the running analyses
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.operations = {}
+        self.results = {} # synthetic results by content hash
+        self.stats = {'analyze_requests': 0, 'polls': 0, 'completions': 0, 'rate_limited': 0, 'failures': 0,
+                      'running_analyses': 0, 'max_running_analyses': 0, 'running_completions': 0, 'max_running_completions': 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+            if key.startswith('running_'):
+                self.stats[f"max_{key}"] = max(self.stats[f"max_{key}"], self.stats[key])
+
+    def chance(self, rate):
+        with self.lock:
+            return self.random.random() < rate
+
+    def get_latency(self, latency):
+        with self.lock:
+            return max(0.0, latency * (1 + self.random.uniform(-self.jitter, self.jitter)))
+
+    ''' recorded result of a file content or a synthetic one (the same content always gets the same result) '''
+    def get_result(self, content, model):
+        content_hash = hashlib.sha256(content).hexdigest()
+        if self.results_folder is not None:
+            path = os.path.join(self.results_folder, f"{content_hash}.json")
+            if os.path.exists(path):
+                with open(path) as f:
+                    return json.load(f)
+        with self.lock:
+            if content_hash not in self.results:
+                seed = int(content_hash[:8], 16)
+                self.results[content_hash] = to_rest_result(generate_result(**SYNTHETIC_RESULT, seed=seed), model)
+            return self.results[content_hash]
+
+    ''' analyze request: returns the operation id '''
+    def submit(self, model, content):
+        operation_id = str(uuid.uuid4())
+        operation = {
+            'model': model,
+            'result': self.get_result(content, model),
+            'ready': time.monotonic() + self.get_latency(self.analysis_latency),
+            'failed': self.chance(self.failure_rate),
+            'created': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        }
+        with self.lock:
+            self.operations[operation_id] = operation
+        self.count('running_analyses')
+        return operation_id
+
+    ''' analysis operation status, None when the operation does not exist '''
+    def poll(self, operation_id):
+        with self.lock:
+            operation = self.operations.get(operation_id)
+        if operation is None:
+            return None
+        status = {'createdDateTime': operation['created'], 'lastUpdatedDateTime': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        if time.monotonic() < operation['ready']:
+            return dict(status, status='running')
+        with self.lock:
+            finished = self.operations.pop(operation_id, None) is not None
+        if finished:
+            self.count('running_analyses', -1)
+            if operation['failed']:
+                self.count('failures')
+        if operation['failed']:
+            return dict(status, status='failed', error={'code': 'InternalServerError', 'message': 'Injected analysis failure.'})
+        return dict(status, status='succeeded', analyzeResult=operation['result'])
+
+    ''' completions response (openai format) '''
+    def complete(self, deployment, request):
+        self.count('running_completions')
+        try:
+            time.sleep(self.get_latency(self.completion_latency))
+        finally:
+            self.count('running_completions', -1)
+        prompt = request.get('prompt', '')
+        prompt = prompt[0] if isinstance(prompt, list) else prompt
+        answer = get_completion_answer(prompt)
+        return {
+            'id': f"cmpl-{uuid.uuid4().hex}",
+            'object': 'text_completion',
+            'created': int(time.time()),
+            'model': deployment,
+            'choices': [{'text': answer, 'index': 0, 'finish_reason': 'stop', 'logprobs': None}],
+            # ~4 characters per token
+            'usage': {'prompt_tokens': len(prompt) // 4 + 1, 'completion_tokens': len(answer) // 4 + 1, 'total_tokens': (len(prompt) + len(answer)) // 4 + 2}
+        }
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug(f"mock services: {format % args}")
+
+    def send_json(self, status, body, headers={}):
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_rate_limited(self):
+        services = self.server.services
+        services.count('rate_limited')
+        self.send_json(429, {'error': {'code': '429', 'message': 'Injected rate limit, retry later.'}}, {'Retry-After': str(services.retry_after)})
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def get_base_url(self):
+        return f"http://{self.headers.get('Host') or '%s:%d' % self.server.server_address[:2]}"
+
+    def do_POST(self):
+        services = self.server.services
+        path = urlparse(self.path).path
+        body = self.read_body()
+        match = ANALYZE_PATH.match(path)
+        if match:
+            services.count('analyze_requests')
+            if services.chance(services.rate_limit_rate):
+                return self.send_rate_limited()
+            operation_id = services.submit(match.group(1), body)
+            location = f"{self.get_base_url()}/formrecognizer/documentModels/{match.group(1)}/analyzeResults/{operation_id}?api-version={API_VERSION}"
+            self.send_response(202)
+            self.send_header("Operation-Location", location)
+            self.send_header("Retry-After", str(services.poll_interval))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        match = COMPLETIONS_PATH.match(path)
+        if match:
+            services.count('completions')
+            if services.chance(services.rate_limit_rate):
+                return self.send_rate_limited()
+            if services.chance(services.failure_rate):
+                services.count('failures')
+                return self.send_json(500, {'error': {'code': 'InternalServerError', 'message': 'Injected completion failure.'}})
+            return self.send_json(200, services.complete(match.group(1), json.loads(body or b"{}")))
+        self.send_json(404, {'error': {'code': 'NotFound', 'message': f"{path} not found"}})
+
+    def do_GET(self):
+        services = self.server.services
+        path = urlparse(self.path).path
+        match = RESULT_PATH.match(path)
+        if match:
+            services.count('polls')
+            if services.chance(services.rate_limit_rate):
+                return self.send_rate_limited()
+            status = services.poll(match.group(2))
+            if status is None:
+                return self.send_json(404, {'error': {'code': 'NotFound', 'message': f"operation {match.group(2)} not found"}})
+            headers = {'Retry-After': str(services.poll_interval)} if status['status'] == 'running' else {}
+            return self.send_json(200, status, headers)
+        if path == "/stats":
+            with services.lock:
+                return self.send_json(200, dict(services.stats))
+        self.send_json(404, {'error': {'code': 'NotFound', 'message': f"{path} not found"}})
+
+''' create the mock services server (port 0 picks a free port), serve it with serve_forever or start '''
+def create_server(services, host="127.0.0.1", port=0):
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.services = services
+    server.url = f"http://{host}:{server.server_address[1]}/"
+    return server
+
+''' start the mock services in a background thread, call server.shutdown() to stop them '''
+def start(services=None, host="127.0.0.1", port=0):
+    server = create_server(services or MockServices(), host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+''' environment variables that point the clients to the mock services '''
+def get_environment(url):
+    return {
+        'FORM_RECOGNIZER_ENDPOINT': url,
+        'FORM_RECOGNIZER_KEY': 'mock',
+        'AZURE_OPENAI_ENDPOINT': url.rstrip("/"),
+        'AZURE_OPENAI_KEY': 'mock',
+        # local latencies do not need the persistent caches
+        'FORM_RECOGNIZER_CACHE_FILE': '',
+        'AZURE_OPENAI_CACHE_FILE': ''
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Mock Form Recognizer and Azure OpenAI services')
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--results', type=str, default=None, help='folder with recorded analysis results (<file sha256>.json), synthetic results are served for other files')
+    parser.add_argument('--analysis-latency', type=float, default=2.0, help='seconds until an analysis succeeds')
+    parser.add_argument('--completion-latency', type=float, default=0.2, help='seconds to answer a completion')
+    parser.add_argument('--jitter', type=float, default=0.5, help='random latency variation (fraction of the latency)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='fraction of the requests rejected with 429')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of the analyses and completions that fail')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After (seconds) of the rate limited requests')
+    parser.add_argument('--poll-interval', type=int, default=1, help='Retry-After (seconds) of the running analyses')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the injected rate limits and failures')
+    args = parser.parse_args()
+    services = MockServices(args.results, args.analysis_latency, args.completion_latency, args.jitter, args.rate_limit_rate,
+                            args.failure_rate, args.retry_after, args.poll_interval, args.seed)
+    server = create_server(services, args.host, args.port)
+    print(f"Mock services listening on {server.url}, point the clients to them with:")
+    for key, value in get_environment(server.url).items():
+        print(f"export {key}={value}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -4,24 +4,44 @@ Author: Paulo Lacerda
 Description: Utility functions to use Azure OpenAI API
 
 """
-import openai
-import tiktoken
+import asyncio
+import bisect
+import functools
+import hashlib
+import itertools
+import random
+import threading
 import time
 import os
+import metrics_utils
+from cache_utils import Cache, get_key
 from general_utils import logger
 
 ## Global variables ##
 
 AZURE_OPENAI_SERVICE = os.environ.get("AZURE_OPENAI_SERVICE")
+AZURE_OPENAI_ENDPOINT = os.environ.get("AZURE_OPENAI_ENDPOINT") or f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com" # set to use another endpoint (e.g. mock_services)
 AZURE_OPENAI_KEY = os.environ.get("AZURE_OPENAI_KEY")
 AZURE_OPENAI_GPT_DEPLOYMENT = os.environ.get("AZURE_OPENAI_GPT_DEPLOYMENT")
+AZURE_OPENAI_CACHE_FILE = os.environ.get("AZURE_OPENAI_CACHE_FILE", ".cache/completions.sqlite") # empty value disables the completion cache
+AZURE_OPENAI_CACHE_MAX_BYTES = int(os.environ.get("AZURE_OPENAI_CACHE_MAX_BYTES", 64 * 1024 * 1024))
 
 ## AOAI CONFIGURATION ##
 
-openai.api_type = "azure"
-openai.api_base = f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com"
-openai.api_version = "2023-03-15-preview" 
-openai.api_key = AZURE_OPENAI_KEY
+API_VERSION = "2023-03-15-preview"
+openai_module = None
+
+''' import and configure the openai module at its first use (it is slow to import and runs with cached completions do not need it) '''
+def get_openai():
+    global openai_module
+    if openai_module is None:
+        import openai
+        openai.api_type = "azure"
+        openai.api_base = AZURE_OPENAI_ENDPOINT
+        openai.api_version = API_VERSION
+        openai.api_key = AZURE_OPENAI_KEY
+        openai_module = openai
+    return openai_module
 
 ## AOAI MODELS AND ITS LIMITS ##
 
@@ -38,47 +58,311 @@ requests_per_minute = {
 }
 # tokens per minute per model
 tokens_per_minute = { 
-    "text-davinci-003": 120
+    "text-davinci-003": 120000
 }
 
-def complete(prompt, variables, deployment="davinci", max_tokens=500, temperature=0.0, top_p=1, frequency_penalty=0, presence_penalty=0, best_of=1, stop=None):
-    result = ""
+## AOAI RETRIES AND CONCURRENCY ##
+
+MAX_RETRIES = 10 # Max retries of a rate limited completion.
+RETRY_BASE_DELAY = 1.0 # Backoff delay (seconds) of the first retry, doubled at each retry.
+RETRY_MAX_DELAY = 60.0 # Max backoff delay (seconds).
+MAX_CONCURRENT_COMPLETIONS = 8 # Max completions running at the same time in complete_many.
+
+class TokenBucket:
+    def __init__(self, per_minute) -> None:
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    ''' take tokens from the bucket, returns the seconds to wait (and try again) when there are not enough tokens '''
+    def take(self, amount):
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate
+
+    def wait(self, amount):
+        delay = self.take(amount)
+        waited = 0
+        while delay > 0:
+            time.sleep(delay)
+            waited += delay
+            delay = self.take(amount)
+        if waited > 0:
+            metrics_utils.observe("rate_limit_wait_seconds", waited)
+
+    async def acquire(self, amount):
+        delay = self.take(amount)
+        waited = 0
+        while delay > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+            delay = self.take(amount)
+        if waited > 0:
+            metrics_utils.observe("rate_limit_wait_seconds", waited)
+
+rate_limiters = {}
+
+''' get the (requests, tokens) per minute buckets of a deployment model '''
+def get_rate_limiters(deployment):
+    model = deployment_model[deployment]
+    if model not in rate_limiters:
+        rate_limiters[model] = (TokenBucket(requests_per_minute[model]), TokenBucket(tokens_per_minute[model]))
+    return rate_limiters[model]
+
+''' seconds to wait before retrying a rate limited completion: exponential backoff with jitter, honoring Retry-After '''
+def get_retry_delay(attempt, error=None):
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+    headers = getattr(error, 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms') is not None:
+            delay = max(delay, float(headers.get('retry-after-ms')) / 1000)
+        elif headers.get('Retry-After') is not None or headers.get('retry-after') is not None:
+            delay = max(delay, float(headers.get('Retry-After') or headers.get('retry-after')))
+    except ValueError:
+        pass # Retry-After as http date is not used by the service
+    return delay
+
+## COMPLETION CACHE ##
+
+completion_cache = None
+
+''' get the persistent completion cache (None when it is disabled) '''
+def get_completion_cache():
+    global completion_cache
+    if completion_cache is None and AZURE_OPENAI_CACHE_FILE:
+        completion_cache = Cache(AZURE_OPENAI_CACHE_FILE, AZURE_OPENAI_CACHE_MAX_BYTES)
+    return completion_cache
+
+''' completion cache key: prompt template hash, deployment, sampling parameters, variables and prompt truncation mode '''
+def get_completion_key(prompt, variables, deployment, parameters, truncate="head"):
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    return get_key(prompt_hash, deployment, parameters, variables, truncate)
+
+''' sampling parameters of a completion (part of the completion cache key) '''
+def get_parameters(max_tokens=500, temperature=0.0, top_p=1, frequency_penalty=0, presence_penalty=0, best_of=1, stop=None):
+    return {'max_tokens': max_tokens, 'temperature': temperature, 'top_p': top_p, 'frequency_penalty': frequency_penalty, 'presence_penalty': presence_penalty, 'best_of': best_of, 'stop': stop}
+
+''' return the cached completion of a prompt or None when it is not cached '''
+def get_cached_completion(prompt, variables, deployment="davinci", parameters=None, truncate="head"):
+    cache = get_completion_cache()
+    if cache is None:
+        return None
+    parameters = get_parameters() if parameters is None else parameters
+    result = cache.get(get_completion_key(prompt, variables, deployment, parameters, truncate))
+    metrics_utils.increment("cache_hits" if result is not None else "cache_misses", cache="completion")
+    return result
+
+''' store the completion of a prompt in the cache '''
+def set_cached_completion(prompt, variables, result, deployment="davinci", parameters=None, truncate="head"):
+    cache = get_completion_cache()
+    if cache is None or result in ("", "error"):
+        return
+    parameters = get_parameters() if parameters is None else parameters
+    cache.set(get_completion_key(prompt, variables, deployment, parameters, truncate), result)
+
+## TOKENS ##
+
+''' maximum number of tokens (prompt and completion) of the deployment model '''
+def get_prompt_limit(deployment="davinci"):
+    return prompt_limit[deployment_model[deployment]]
+
+''' get the tokenizer of a model (encoders are created once per model) '''
+@functools.lru_cache(maxsize=None)
+def get_encoder(model):
+    import tiktoken
+    return tiktoken.encoding_for_model(model)
+
+''' count the tokens of a text with the deployment model encoder '''
+def count_tokens(text, deployment="davinci"):
+    return len(get_encoder(deployment_model[deployment]).encode(text))
+
+''' reduce a prompt removing whole lines from its head (or its middle) until it fits max_length tokens, returns the prompt and its tokens count '''
+def truncate_prompt(prompt, encoder, max_length, truncate="head"):
+    lines = prompt.split("\n")
+    # tokens per line (with its line break) and their prefix sum estimate the tokens left after removing any block of lines
+    line_tokens = [len(tokens) for tokens in encoder.encode_batch([line + "\n" for line in lines])]
+    prefix = list(itertools.accumulate(line_tokens, initial=0))
+    total = prefix[-1]
 
+    # block of lines removed from the prompt
+    def get_block(size):
+        if truncate == "middle":
+            start = max(0, min(len(lines) - size, len(lines) // 2 - size // 2))
+            return start, start + size
+        return 0, size
+
+    if truncate == "middle":
+        # remove the smallest block of lines centered in the middle of the prompt (e.g. table rows)
+        low, high = 0, len(lines)
+        while low < high:
+            middle = (low + high) // 2
+            start, end = get_block(middle)
+            if total - (prefix[end] - prefix[start]) <= max_length:
+                high = middle
+            else:
+                low = middle + 1
+        size = low
+    else:
+        # remove the smallest number of lines from the head
+        size = bisect.bisect_left(prefix, total - max_length)
+
+    def remove_block(size):
+        start, end = get_block(size)
+        truncated_prompt = "\n".join(lines[:start] + lines[end:])
+        return truncated_prompt, len(encoder.encode(truncated_prompt))
+
+    # the estimate may be a few tokens off where tokens merge across line breaks, adjust the cut one line at a time
+    truncated_prompt, num_tokens = remove_block(size)
+    while num_tokens > max_length and size < len(lines):
+        size += 1
+        truncated_prompt, num_tokens = remove_block(size)
+    while size > 0:
+        previous_prompt, previous_tokens = remove_block(size - 1)
+        if previous_tokens > max_length:
+            break
+        size -= 1
+        truncated_prompt, num_tokens = previous_prompt, previous_tokens
+    return truncated_prompt, num_tokens
+
+''' replace the prompt variables and reduce it to fit the model prompt limit, returns the prompt and its tokens count '''
+def prepare_prompt(prompt, variables, deployment, max_tokens, truncate="head"):
     # replace variables
     for key, value in variables.items():
         prompt = prompt.replace(f"{{{key}}}", value)
 
     # check prompt length
     max_length = prompt_limit[deployment_model[deployment]] - max_tokens
-    encoder = tiktoken.encoding_for_model(deployment_model[deployment])
+    encoder = get_encoder(deployment_model[deployment])
     num_tokens = len(encoder.encode(prompt))
     if num_tokens > max_length:
         logger.error(f"prompt too long ({num_tokens}) for {deployment_model[deployment]} reducing to {max_length} - prompt: {prompt}")
-        while(num_tokens > max_length):
-            prompt = prompt[prompt.find("\n")+1:] #TODO: improve this
-            num_tokens = len(encoder.encode(prompt))
+        prompt, num_tokens = truncate_prompt(prompt, encoder, max_length, truncate)
+    return prompt, num_tokens
+
+''' count a completion and its tokens (prompt tokens are counted locally when the response has no usage) '''
+def record_usage(response, num_tokens):
+    if not metrics_utils.enabled:
+        return
+    usage = response.get("usage") if hasattr(response, "get") else None
+    metrics_utils.increment("calls", service="completion")
+    metrics_utils.increment("prompt_tokens", usage["prompt_tokens"] if usage else num_tokens)
+    if usage and "completion_tokens" in usage:
+        metrics_utils.increment("completion_tokens", usage["completion_tokens"])
+
+''' cached result of a completion, or None with the prompt to send (variables replaced and truncated) and its tokens count '''
+def prepare_completion(template, variables, deployment, parameters, truncate="head"):
+    cached_result = get_cached_completion(template, variables, deployment, parameters, truncate)
+    if cached_result is not None:
+        return cached_result, None, 0
+    prompt, num_tokens = prepare_prompt(template, variables, deployment, parameters['max_tokens'], truncate)
+    return None, prompt, num_tokens
+
+''' text of a completion response (its usage is recorded) '''
+def get_completion_result(response, num_tokens):
+    result = response.choices[0].text
+    record_usage(response, num_tokens)
+    return result
+
+''' handle a failed completion attempt, returns (None, seconds to wait) to retry it or (result, None) to give up:
+    rate limited completions are retried up to MAX_RETRIES times (empty result), other errors are not retried ("error" result) '''
+def get_completion_retry(openai, error, attempt, prompt):
+    if not isinstance(error, openai.error.RateLimitError):
+        logger.error(f"aoai completion error: {error} - prompt: {prompt}")
+        metrics_utils.increment("errors", service="completion")
+        return "error", None
+    if attempt == MAX_RETRIES:
+        logger.error(f"reached aoai completion rate limit, giving up after {MAX_RETRIES} retries - prompt: {prompt}")
+        return "", None
+    sleep_time = get_retry_delay(attempt, error)
+    logger.error(f"reached aoai completion rate limit retrying for the {attempt+1} time waiting {sleep_time:.1f} sec - prompt: {prompt}")
+    metrics_utils.increment("retries", service="completion")
+    metrics_utils.observe("rate_limit_wait_seconds", sleep_time)
+    return None, sleep_time
+
+def complete(prompt, variables, deployment="davinci", max_tokens=500, temperature=0.0, top_p=1, frequency_penalty=0, presence_penalty=0, best_of=1, stop=None, truncate="head"):
+    template = prompt
+
+    # check the completion cache before calling the service
+    parameters = get_parameters(max_tokens, temperature, top_p, frequency_penalty, presence_penalty, best_of, stop)
+    result, prompt, num_tokens = prepare_completion(template, variables, deployment, parameters, truncate)
+    if result is not None:
+        return result
 
     # do the completion
-    try:
-        prompt = openai.Completion.create(engine=deployment,prompt=prompt,temperature=temperature,max_tokens=max_tokens,top_p=top_p,frequency_penalty=frequency_penalty,presence_penalty=presence_penalty,best_of=best_of,stop=stop)
-        result = prompt.choices[0].text
-    except openai.error.RateLimitError  as e:
-        count = 1
-        while count < 11:
-            try:
-                sleep_time = 60
-                logger.error(f"reached aoai completion rate limit retrying for the {count} time waiting {sleep_time} sec - prompt: {prompt}")
-                time.sleep(sleep_time)
-                prompt = openai.Completion.create(engine=deployment,prompt=prompt,temperature=temperature,max_tokens=max_tokens,top_p=top_p,frequency_penalty=frequency_penalty,presence_penalty=presence_penalty,best_of=best_of,stop=stop)
-                result = prompt.choices[0].text
+    openai = get_openai()
+    requests_limiter, tokens_limiter = get_rate_limiters(deployment)
+    for attempt in range(MAX_RETRIES + 1):
+        requests_limiter.wait(1)
+        tokens_limiter.wait(num_tokens + max_tokens)
+        try:
+            with metrics_utils.span("completion"):
+                response = openai.Completion.create(engine=deployment, prompt=prompt, **parameters)
+            result = get_completion_result(response, num_tokens)
+            break
+        except Exception as e:
+            result, sleep_time = get_completion_retry(openai, e, attempt, prompt)
+            if sleep_time is None:
                 break
-            except openai.error.RateLimitError  as e:
-                count += 1
-            except Exception as e:
-                result = "error"
-                logger.error(f"aoai completion error: {e} - prompt: {prompt}")                
-    except Exception as e:
-        result = "error"
-        logger.error(f"aoai completion error: {e} - prompt: {prompt}")
+            time.sleep(sleep_time)
+
+    set_cached_completion(template, variables, result, deployment, parameters, truncate)
+
+    return result
+
+''' asyncio version of complete '''
+async def acomplete(prompt, variables, deployment="davinci", max_tokens=500, temperature=0.0, top_p=1, frequency_penalty=0, presence_penalty=0, best_of=1, stop=None, truncate="head"):
+    template = prompt
+
+    # check the completion cache before calling the service
+    parameters = get_parameters(max_tokens, temperature, top_p, frequency_penalty, presence_penalty, best_of, stop)
+    result, prompt, num_tokens = prepare_completion(template, variables, deployment, parameters, truncate)
+    if result is not None:
+        return result
+
+    # do the completion
+    openai = get_openai()
+    requests_limiter, tokens_limiter = get_rate_limiters(deployment)
+    for attempt in range(MAX_RETRIES + 1):
+        await requests_limiter.acquire(1)
+        await tokens_limiter.acquire(num_tokens + max_tokens)
+        try:
+            with metrics_utils.span("completion"):
+                response = await openai.Completion.acreate(engine=deployment, prompt=prompt, **parameters)
+            result = get_completion_result(response, num_tokens)
+            break
+        except Exception as e:
+            result, sleep_time = get_completion_retry(openai, e, attempt, prompt)
+            if sleep_time is None:
+                break
+            await asyncio.sleep(sleep_time)
+
+    set_cached_completion(template, variables, result, deployment, parameters, truncate)
 
     return result
+
+''' complete the prompt for each variables dictionary concurrently, returns the results in the same order '''
+async def complete_many(prompt, variables_list, concurrency=None, **kwargs):
+    semaphore = asyncio.Semaphore(concurrency or MAX_CONCURRENT_COMPLETIONS)
+    async def complete_one(variables):
+        async with semaphore:
+            return await acomplete(prompt, variables, **kwargs)
+    return await asyncio.gather(*[complete_one(variables) for variables in variables_list])
+
+''' blocking version of complete_many (completes one by one, blocking the loop, when called from a running event loop) '''
+def complete_all(prompt, variables_list, concurrency=None, **kwargs):
+    if len(variables_list) == 0:
+        return []
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(complete_many(prompt, variables_list, concurrency, **kwargs))
+    logger.warning(f"complete_all called from a running event loop, completing {len(variables_list)} prompts one by one (await complete_many instead)")
+    return [complete(prompt, variables, **kwargs) for variables in variables_list]
@@ -0,0 +1,174 @@
+"""
+Title: Output Utils
+Author: Paulo Lacerda
+Description: Output sinks to save the parsed tables as CSV, JSON Lines or Parquet files,
+             one file per table, a consolidated file per document or a single file per batch.
+
+"""
+import abc
+import json
+import os
+import numpy as np
+from general_utils import logger
+
+SCOPES = ['table', 'document', 'batch'] # one file per table, per document or a single file
+
+# consolidated csv and parquet files use a long format (one row per table cell), so tables with different columns share the same schema
+LONG_COLUMNS = ['source_file', 'table_index', 'row_index', 'column_index', 'column_name', 'value']
+
+''' get the output file path of a table (example: data/Sample 4 001.csv) '''
+def get_table_path(file, table_index, extension):
+    return f"{os.path.splitext(file)[0]} {str(table_index).zfill(3)}.{extension}"
+
+''' get the output file path of a document (example: data/Sample 4.csv) '''
+def get_document_path(file, extension):
+    return f"{os.path.splitext(file)[0]}.{extension}"
+
+''' table values as python strings, missing values as None '''
+def get_values(df):
+    return df.astype(object).where(df.notna(), None)
+
+''' convert a table to the long format (one row per cell) '''
+def get_long_frame(file, table_index, df):
+    import pandas as pd
+    rows, columns = df.shape
+    return pd.DataFrame({
+        'source_file': [file] * (rows * columns),
+        'table_index': np.full(rows * columns, table_index, dtype=np.int32),
+        'row_index': np.repeat(np.arange(rows, dtype=np.int32), columns),
+        'column_index': np.tile(np.arange(columns, dtype=np.int32), rows),
+        'column_name': np.tile(np.array([str(column) for column in df.columns], dtype=object), rows),
+        'value': get_values(df).to_numpy().ravel()
+    }, columns=LONG_COLUMNS)
+
+class Sink(abc.ABC):
+    ''' base output sink, tables are written as soon as they are parsed '''
+    extension = None
+
+    def __init__(self, scope='table', output=None) -> None:
+        if scope not in SCOPES:
+            raise ValueError(f"invalid output scope '{scope}', expected one of {SCOPES}")
+        self.scope = scope
+        self.output = output or f"tables.{self.extension}" # batch output file
+        self.writers = {} # open consolidated files by path
+
+    ''' write a parsed table of a source file (table_index starts at 1) '''
+    def write(self, file, table_index, df):
+        if self.scope == 'table':
+            self.write_table(get_table_path(file, table_index, self.extension), df)
+            return
+        path = get_document_path(file, self.extension) if self.scope == 'document' else self.output
+        if path not in self.writers:
+            self.writers[path] = self.open(path)
+        self.append(self.writers[path], file, table_index, df)
+
+    ''' all tables of a source file were written '''
+    def end_document(self, file):
+        if self.scope == 'document':
+            path = get_document_path(file, self.extension)
+            if path in self.writers:
+                self.close_writer(self.writers.pop(path))
+
+    ''' output files of the tables written for a source file '''
+    def get_outputs(self, file, tables):
+        if self.scope == 'table':
+            return [get_table_path(file, table_index, self.extension) for table_index in range(1, tables + 1)]
+        return [get_document_path(file, self.extension) if self.scope == 'document' else self.output]
+
+    def close(self):
+        for writer in self.writers.values():
+            self.close_writer(writer)
+        self.writers = {}
+
+    ''' write a table to its own file '''
+    @abc.abstractmethod
+    def write_table(self, path, df):
+        pass
+
+    ''' open a consolidated file, returns its writer '''
+    @abc.abstractmethod
+    def open(self, path):
+        pass
+
+    ''' append a table to a consolidated file '''
+    @abc.abstractmethod
+    def append(self, writer, file, table_index, df):
+        pass
+
+    def close_writer(self, writer):
+        writer.close()
+
+class CsvSink(Sink):
+    extension = 'csv'
+
+    def write_table(self, path, df):
+        df.to_csv(path, index=False, header=True)
+
+    def open(self, path):
+        writer = open(path, "w", newline="", encoding="utf-8")
+        writer.write(",".join(LONG_COLUMNS) + "\n")
+        return writer
+
+    def append(self, writer, file, table_index, df):
+        get_long_frame(file, table_index, df).to_csv(writer, index=False, header=False)
+        writer.flush()
+
+class JsonLinesSink(Sink):
+    ''' one json object per table row, consolidated files add the source_file and table_index fields '''
+    extension = 'jsonl'
+
+    def write_table(self, path, df):
+        with open(path, "w", encoding="utf-8") as f:
+            self.write_rows(f, get_values(df).to_dict(orient='records'))
+
+    def open(self, path):
+        return open(path, "w", encoding="utf-8")
+
+    def append(self, writer, file, table_index, df):
+        self.write_rows(writer, ({'source_file': file, 'table_index': table_index, **row} for row in get_values(df).to_dict(orient='records')))
+        writer.flush()
+
+    def write_rows(self, f, rows):
+        for row in rows:
+            f.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+class ParquetSink(Sink):
+    ''' per table files keep the table columns (as strings), consolidated files use the long format schema '''
+    extension = 'parquet'
+
+    def __init__(self, scope='table', output=None) -> None:
+        super().__init__(scope, output)
+        # pyarrow is only needed for parquet outputs
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.schema = pyarrow.schema([
+            ('source_file', pyarrow.string()),
+            ('table_index', pyarrow.int32()),
+            ('row_index', pyarrow.int32()),
+            ('column_index', pyarrow.int32()),
+            ('column_name', pyarrow.string()),
+            ('value', pyarrow.string())
+        ])
+
+    def write_table(self, path, df):
+        values = get_values(df)
+        arrays = [self.pa.array(values.iloc[:, idx].tolist(), type=self.pa.string()) for idx in range(len(values.columns))]
+        self.pq.write_table(self.pa.Table.from_arrays(arrays, names=[str(column) for column in df.columns]), path)
+
+    def open(self, path):
+        return self.pq.ParquetWriter(path, self.schema)
+
+    def append(self, writer, file, table_index, df):
+        long_frame = get_long_frame(file, table_index, df)
+        writer.write_table(self.pa.Table.from_pandas(long_frame, schema=self.schema, preserve_index=False))
+
+SINKS = {'csv': CsvSink, 'jsonl': JsonLinesSink, 'parquet': ParquetSink}
+
+''' create the output sink of a format (csv, jsonl or parquet) and scope (table, document or batch) '''
+def get_sink(format='csv', scope='table', output=None):
+    if format not in SINKS:
+        raise ValueError(f"invalid output format '{format}', expected one of {list(SINKS)}")
+    logger.debug(f"Saving tables as {format} ({scope} files)")
+    return SINKS[format](scope, output)
@@ -7,44 +7,224 @@ Description: Program to parse tables from PDFs
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 import argparse
+import multiprocessing
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 import parse_tables_utils as parse_tables_utils
 import formrec_utils as fr
+import openai_utils
+import output_utils
+import shard_utils
+import metrics_utils
+import manifest_utils
 from general_utils import logger
 
+''' parse the tables of an analysis result and yield them as dataframes, one table at a time '''
+def iter_dataframes(result):
+    # parse document's tables in a tree structure (each table is a tree)
+    for tree in metrics_utils.timed_iter("parse_table", parse_tables_utils.iter_trees(result)):
+        # format trees in dataframe format to export
+        yield parse_tables_utils.get_dataframe(tree)
+
+''' parse the tables of an analysis result and format them as dataframes (runs in a worker process in batch mode) '''
+def get_dataframes(result):
+    return list(iter_dataframes(result))
+
+''' worker process task: the dataframes of a result and the metrics recorded while parsing them '''
+def get_dataframes_and_metrics(result):
+    dataframes = get_dataframes(result)
+    return dataframes, metrics_utils.collect() if metrics_utils.enabled else None
+
+''' batch mode worker process setup, the workers share the completion rate limits '''
+def init_worker(workers, metrics_enabled=False):
+    # pandas is lazily imported by the parsing stages, the workers import it once at startup
+    import pandas
+    if metrics_enabled:
+        # workers only send their own metrics
+        metrics_utils.reset()
+        metrics_utils.enable()
+    for model in openai_utils.requests_per_minute:
+        openai_utils.requests_per_minute[model] = openai_utils.requests_per_minute[model] / workers
+    for model in openai_utils.tokens_per_minute:
+        openai_utils.tokens_per_minute[model] = openai_utils.tokens_per_minute[model] / workers
+
 class Parser:
-    def __init__(self) -> None:
+    model = 'prebuilt-document'
+
+    def __init__(self, refresh=False, sink=None, pages_per_shard=None, incremental=False) -> None:
         logger.debug('Creating an instance of Parser')
         self.api_key =  os.getenv("FORM_RECOGNIZER_KEY")
         self.endpoint =  os.getenv("FORM_RECOGNIZER_ENDPOINT")
-     
-    def parse_tables(self, file):
-        logger.info(f"PROCESSING {file}")
+        self.refresh = refresh # analyze the document again even when its result is cached
+        self.sink = sink or output_utils.get_sink() # one csv file per table (default)
+        self.pages_per_shard = pages_per_shard # split large PDFs in shards analyzed in parallel
+        self.incremental = incremental and not refresh # skip the stages that are current in the document manifest
+
+    def analyze(self, file):
         logger.info(f"Analyzing {file} with FormRec")
-        # result = fr.analyze_document_rest(file, 'prebuilt-layout', features=['ocr.font'])
-        result = fr.analyze_document_sdk(file, 'prebuilt-document')
+        # return fr.analyze_document_rest(file, 'prebuilt-layout', features=['ocr.font'], refresh=self.refresh)
+        with metrics_utils.span("analyze"):
+            if self.pages_per_shard:
+                return shard_utils.analyze_document_sharded(file, self.model, self.pages_per_shard, refresh=self.refresh)
+            return fr.analyze_document_sdk(file, self.model, refresh=self.refresh)
 
-        # parse document's tables in a tree structure (each table is a tree)
-        logger.info(f"Parsing {file} tables")
-        trees = parse_tables_utils.parse_json_result(result)
+    ''' incremental mode: get the document manifest and its parsed tables when they are still current (None when the document must be parsed) '''
+    def check(self, file):
+        manifest = manifest_utils.Manifest(file, self.model, self.sink, self.pages_per_shard)
+        stage, reason = manifest.get_first_stage()
+        dataframes = manifest.get_tables() if stage == 'write' else None
+        if stage is None:
+            logger.info(f"Skipping {file}, {reason}")
+        elif stage == 'write' and dataframes is not None:
+            logger.info(f"Writing {file} cached tables ({reason})")
+        else:
+            logger.info(f"Parsing {file} ({reason})")
+        return manifest, dataframes
 
-        # format trees in dataframe format to export as csv
+    ''' incremental mode: write the tables and record them in the manifest '''
+    def save_incremental(self, file, manifest, dataframes, parsed):
+        if parsed:
+            manifest.set_tables(dataframes)
+        tables = self.save(file, dataframes)
+        manifest.set_outputs(self.sink.get_outputs(file, tables))
+        manifest.save()
+
+    ''' write each table as soon as it is available (dataframes may be a generator), returns the number of tables written '''
+    def save(self, file, dataframes):
         count = 1
-        for tree in trees:
-            logger.info(f"Formatting {file} table {str(count).zfill(3)} to csv")
-            df = parse_tables_utils.get_dataframe(tree)
-            out_filename = f"{file[:-4]} {str(count).zfill(3)}.csv" # example Sample 4 001.csv
-            df.to_csv(out_filename, index=False, header=True)
-            count += 1
-
-def main(files):
-    for file in files:
-        parser = Parser()
-        parser.parse_tables(file)
-    print("DONE")
+        try:
+            for df in dataframes:
+                logger.info(f"Saving {file} table {str(count).zfill(3)} to {self.sink.extension}")
+                with metrics_utils.span("write", format=self.sink.extension):
+                    self.sink.write(file, count, df)
+                metrics_utils.increment("tables")
+                metrics_utils.increment("rows", len(df))
+                count += 1
+        finally:
+            self.sink.end_document(file)
+        return count - 1
+
+    def parse_tables(self, file):
+        logger.info(f"PROCESSING {file}")
+        if not self.incremental:
+            result = self.analyze(file)
+            logger.info(f"Parsing {file} tables")
+            self.save(file, iter_dataframes(result))
+            return
+        # incremental mode, the tables are kept (and cached) to skip the parse stage when only the outputs change
+        manifest, dataframes = self.check(file)
+        if manifest.is_current('write'):
+            return
+        parsed = dataframes is None
+        if parsed:
+            result = self.analyze(file)
+            logger.info(f"Parsing {file} tables")
+            dataframes = get_dataframes(result)
+        self.save_incremental(file, manifest, dataframes, parsed)
+
+    ''' batch mode analysis thread: returns the document manifest (incremental mode), its current tables and its analysis result (None when it is not needed) '''
+    def prepare(self, file):
+        if not self.incremental:
+            return None, None, self.analyze(file)
+        manifest, dataframes = self.check(file)
+        if manifest.is_current('write') or dataframes is not None:
+            return manifest, dataframes, None
+        return manifest, None, self.analyze(file)
+
+    ''' parse many files: analyses run concurrently in threads and parsing runs in worker processes, returns the errors of the failed files '''
+    def parse_batch(self, files, concurrency, workers=None):
+        workers = workers or min(concurrency, os.cpu_count() or 1)
+        failures = {}
+        # the workers are spawned, a process forked while the analysis threads hold module import locks can hang at its first import
+        with ThreadPoolExecutor(max_workers=concurrency) as analysis_pool, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=init_worker, initargs=(workers, metrics_utils.enabled)) as parsing_pool:
+            analyses = {analysis_pool.submit(self.prepare, file): file for file in files}
+            parsings = {}
+            manifests = {}
+            # a single loop waits on both stages: each file is parsed as soon as it is analyzed and written as soon as it is parsed
+            while len(analyses) > 0 or len(parsings) > 0:
+                done, _ = wait(list(analyses) + list(parsings), return_when=FIRST_COMPLETED)
+                for future in done:
+                    if future in analyses:
+                        file = analyses.pop(future)
+                        try:
+                            manifest, dataframes, result = future.result()
+                            if manifest is not None and manifest.is_current('write'):
+                                continue
+                            if dataframes is not None:
+                                self.save_incremental(file, manifest, dataframes, parsed=False)
+                                continue
+                        except Exception as e:
+                            logger.error(f"Error analyzing {file}: {e}")
+                            failures[file] = e
+                            continue
+                        logger.info(f"Parsing {file} tables")
+                        manifests[file] = manifest
+                        parsings[parsing_pool.submit(get_dataframes_and_metrics, result)] = file
+                    else:
+                        file = parsings.pop(future)
+                        try:
+                            dataframes, metrics = future.result()
+                            metrics_utils.merge(metrics)
+                            manifest = manifests.pop(file)
+                            if manifest is not None:
+                                self.save_incremental(file, manifest, dataframes, parsed=True)
+                            else:
+                                self.save(file, dataframes)
+                        except Exception as e:
+                            logger.error(f"Error parsing {file}: {e}")
+                            failures[file] = e
+        return failures
+
+def main(files, refresh=False, concurrency=1, workers=None, sink=None, pages_per_shard=None, metrics_file=None, prometheus_file=None, incremental=False):
+    if metrics_file or prometheus_file:
+        metrics_utils.enable()
+    parser = Parser(refresh, sink, pages_per_shard, incremental)
+    try:
+        if concurrency > 1:
+            failures = parser.parse_batch(files, concurrency, workers)
+        else:
+            failures = {}
+            for file in files:
+                try:
+                    parser.parse_tables(file)
+                except Exception as e:
+                    logger.error(f"Error processing {file}: {e}")
+                    failures[file] = e
+    finally:
+        parser.sink.close()
+    completion_cache = openai_utils.get_completion_cache()
+    if completion_cache is not None:
+        logger.info(f"Completion cache stats: {completion_cache.stats()}")
+    for file, error in failures.items():
+        logger.error(f"FAILED {file}: {error}")
+    metrics_utils.increment("files", len(files) - len(failures), status="parsed")
+    metrics_utils.increment("files", len(failures), status="failed")
+    if metrics_file:
+        metrics_utils.write_report(metrics_file)
+        logger.info(f"Run report saved to {metrics_file}")
+    if prometheus_file:
+        metrics_utils.write_prometheus(prometheus_file)
+    print(f"DONE ({len(files) - len(failures)} of {len(files)} files parsed)")
+    return failures
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Parse tables from PDFs')
     parser.add_argument('files', metavar='files', type=str, nargs='+', help='a list of files to parse')
+    parser.add_argument('--refresh', action='store_true', help='analyze the files again even when their results are cached')
+    parser.add_argument('--cache-max-mb', type=int, default=None, help='max size (MB) of the analysis results cache')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of files analyzed at the same time (batch mode when > 1)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes parsing the analyzed files in batch mode (default: min(concurrency, cpu count))')
+    parser.add_argument('--format', choices=list(output_utils.SINKS), default='csv', help='output file format')
+    parser.add_argument('--consolidate', choices=output_utils.SCOPES, default='table', help='write one file per table, per document or a single file for all files')
+    parser.add_argument('--output', type=str, default=None, help='output file when consolidating a batch (default: tables.<format>)')
+    parser.add_argument('--pages-per-shard', type=int, default=None, help='split PDFs with more pages in shards of this size analyzed in parallel')
+    parser.add_argument('--incremental', action='store_true', help='skip the files whose outputs are current (per file manifest) and only run the stages downstream of a change')
+    parser.add_argument('--metrics', type=str, default=None, help='save a json run report (stage latencies, completions, tokens, retries and cache hits) to this file')
+    parser.add_argument('--metrics-prom', type=str, default=None, help='save the run metrics to this Prometheus textfile')
     args = parser.parse_args()
-    main(args.files)
\ No newline at end of file
+    if args.cache_max_mb is not None:
+        fr.FORM_RECOGNIZER_CACHE_MAX_BYTES = args.cache_max_mb * 1024 * 1024
+    sink = output_utils.get_sink(args.format, args.consolidate, args.output)
+    failures = main(args.files, args.refresh, args.concurrency, args.workers, sink, args.pages_per_shard, args.metrics, args.metrics_prom, args.incremental)
+    exit(1 if len(failures) > 0 else 0)
@@ -4,24 +4,44 @@ Author: Paulo Lacerda
 Description: Utility functions to parse tables from PDFs
 
 """
+import os
 import re
-import pandas as pd
+import bisect
+import functools
+import numpy as np
 import openai_utils as openai_utils
+import metrics_utils
 from general_utils import logger
 
 ## Global variables ##
 
 PARENT_INDENT_THRESHOLD = 0.045 # Fine tune the parent-child indent size.
 MERGE_TABLES_THRESHOLD = 1.00 # Fine tune the threshold to merge tables same page.
+MERGE_PAGES = True # Merge a table with the last table of the previous page when their columns are aligned.
+COLUMN_ALIGN_THRESHOLD = 0.25 # Fine tune the max x distance (inches) between the left and right edges of aligned columns of merged tables.
+PAGE_EDGE_THRESHOLD = 1.0 # Max distance (inches) between a table merged across pages and the page text end (previous page) or start (next page), leaving room for footers and headers.
 IGNORE_ITEMS_LIST = [] # Ignore items containing these keywords when creating the tree structure. Example IGNORE_ITEMS_LIST = ["Subtotal", "Total"]
 MUST_HAVE_COLUMNS = [] # Must have these columns filled to be included in the dataframe. Example: MUST_HAVE_COLUMNS = ["Impl"]
 RESERVED_ATTRIBUTES = ['content', 'rowIndex', 'span_offset', 'span_length', 'children', 'styles']
+VALIDATION_BATCH_SIZE = 50 # Max cells validated in a single completion. Use 1 to validate each cell in its own completion.
+VALIDATION_ANSWER_TOKENS = 8 # Completion tokens reserved to each cell category in the batch validation answer.
+VALIDATION_MAX_CHARS = 200 # Column names and cell values are truncated to this length when validated.
+COLUMN_NAME_ANSWER_TOKENS = 16 # Completion tokens reserved to each inferred column name.
+TABLE_SAMPLE_ROWS = 100 # Rows tokenized to estimate the size of a table row when sampling a table for a prompt.
 
-VALIDATE_ATTRIBUTE_PROMPT = open("prompts/parse_tables_validate_attribute_prompt.txt", "r").read()
-INFER_COLUMN_NAME_PROMPT = open("prompts/parse_tables_infer_services_table_column_name.txt", "r").read()
+PROMPTS_FOLDER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prompts") # Prompt templates folder (the repository prompts folder, whatever the current directory).
+VALIDATE_ATTRIBUTE_PROMPT = "parse_tables_validate_attribute_prompt.txt"
+VALIDATE_ATTRIBUTES_PROMPT = "parse_tables_validate_attributes_prompt.txt"
+INFER_COLUMN_NAMES_PROMPT = "parse_tables_infer_services_table_column_names.txt"
 
 ## General functions ##
 
+''' read a prompt template of the prompts folder at its first use '''
+@functools.lru_cache(maxsize=None)
+def get_prompt(name):
+    with open(os.path.join(PROMPTS_FOLDER, name), "r") as f:
+        return f.read()
+
 ''' return empty string if the item is not found in a collection '''
 def get_item_value(item, column):
     try:
@@ -31,73 +51,163 @@ def get_item_value(item, column):
 
 ### Functions to create items in tree structure (sub-group hierarchy) ###
 
+class LineIndex(dict):
+    ''' document lines by their first span offset (offset -> [(content, x)]), with the sorted offsets to find the lines near a span '''
+    def __init__(self, lines) -> None:
+        super().__init__()
+        for offset, content, x in lines:
+            self.setdefault(offset, []).append((content, x))
+        self.offsets = sorted(self)
+
+    ''' x of the line starting closest to a cell span (within its length) with its content in the cell content, None when there is none '''
+    def find_x(self, content, span_offset, span_length):
+        start = bisect.bisect_left(self.offsets, span_offset - span_length)
+        end = bisect.bisect_left(self.offsets, span_offset + span_length)
+        for offset in sorted(self.offsets[start:end], key=lambda offset: abs(offset - span_offset)):
+            for line_content, line_x in self[offset]:
+                if line_content in content:
+                    return line_x
+        return None
+
+''' index the document lines by their first span offset (built once per document) '''
+@metrics_utils.timed("line_index")
+def get_line_index(pages):
+    if hasattr(pages, 'first_spans'): # compact document (document_utils), read from its arrays
+        lines = pages.first_spans()
+    else:
+        lines = ((line['spans'][0]['offset'], line['content'], line['polygon'][0]) for page in pages for line in page['lines'] if len(line['spans']) > 0)
+    return LineIndex(lines)
+
 ''' get the x coordinate of a cell '''
-def get_x(pages, content, span_offset, span_length):
-    x = 0
-    for page in pages:
-        lines = page['lines']
-        for line in lines:
-            if line['content'] in content and line['spans'][0]['offset'] == span_offset: # and line.spans[0].length == span_length:
-                x = line['polygon'][0]
-                break
+def get_x(line_index, content, span_offset, span_length):
+    x = None
+    # lines are looked up by span offset, the content containment confirms the match
+    for line_content, line_x in line_index.get(span_offset, []):
+        if line_content in content: # and line.spans[0].length == span_length:
+            x = line_x
+    if x is None:
+        # the cell span does not start a line with its content (e.g. shifted offsets), use the closest line inside the span
+        x = line_index.find_x(content, span_offset, span_length)
+    if x is None:
+        logger.warning(f"No line found for cell '{content}' (offset {span_offset}), using x 0")
+        x = 0
     return x
 
-''' get the immediate parent of a cell '''
-def get_parent(pages, table, content, rowIndex, span_offset, span_length):
-    child_x = get_x(pages, content, span_offset, span_length)
-    parent = {'content': "Has no parent", 'rowIndex': -1, 'span_offset': 0, 'span_length': 0}
+''' identify a node by its cell, used to attach children to their parents '''
+def get_node_id(content, rowIndex, span_offset, span_length):
+    return (content, rowIndex, span_offset, span_length)
+
+''' get the indent (x coordinate) of each column 0 cell of a table, in row order '''
+def get_indents(line_index, table):
+    indents = []
     for cell in table['cells']:
-        # check each cell as a candidate parent, check it to confirm.
-        kind = cell['kind'] if 'kind' in cell else 'content' # (default)
-        candidate = {
-            'content': cell['content'],
-            'rowIndex': cell['rowIndex'],
-            'columnIndex': cell['columnIndex'],
-            'kind': kind
-        }
-        if candidate['columnIndex'] == 0 and candidate['kind'] == 'content' and len(cell['spans']) > 0:
-            candidate['span_offset'] = cell['spans'][0]['offset']
-            candidate['span_length'] = cell['spans'][0]['length']          
-            candidate_x = get_x(pages, candidate['content'], candidate['span_offset'] , candidate['span_length'])
-            if child_x - candidate_x > PARENT_INDENT_THRESHOLD:
-                if rowIndex > candidate['rowIndex']:
-                    if parent['rowIndex'] < candidate['rowIndex']:
-                        parent = candidate
-    return parent
-
-''' add a node to the tree structure'''
-def add_child(items, parent, node):
-    for item in items:
-        if parent['span_offset'] == item['span_offset'] and \
-            parent['span_length'] == item['span_length'] and \
-            parent['content'] == item['content'] and \
-            parent['rowIndex'] == item['rowIndex']:
-            item['children'].append(node)
-            break
-        else:
-            add_child(item['children'], parent, node)
+        if cell['columnIndex'] == 0 and len(cell['spans']) > 0:
+            kind = cell['kind'] if 'kind' in cell else 'content' # (default)
+            span_offset = cell['spans'][0]['offset']
+            span_length = cell['spans'][0]['length']
+            indents.append({
+                'node_id': get_node_id(cell['content'], cell['rowIndex'], span_offset, span_length),
+                'rowIndex': cell['rowIndex'],
+                'kind': kind,
+                'x': get_x(line_index, cell['content'], span_offset, span_length)
+            })
+    indents.sort(key=lambda indent: indent['rowIndex'])
+    return indents
+
+''' get the immediate parent of each column 0 cell in a single pass (None for root cells) '''
+def get_parents(indents, threshold=None):
+    threshold = PARENT_INDENT_THRESHOLD if threshold is None else threshold
+    parents = {}
+    # the parent is the closest row above with an indent smaller than the child one (minus the threshold).
+    # the stack keeps the candidates that can still be the closest one, sorted by increasing x.
+    stack = []
+    pending = []
+    rowIndex = None
+    for indent in indents:
+        if indent['rowIndex'] != rowIndex:
+            # cells are only parent candidates for the rows below them
+            for candidate in pending:
+                while len(stack) > 0 and stack[-1]['x'] >= candidate['x']:
+                    stack.pop()
+                stack.append(candidate)
+            pending = []
+            rowIndex = indent['rowIndex']
+        # binary search the last stack candidate indented enough to be the parent
+        low, high = 0, len(stack)
+        while low < high:
+            middle = (low + high) // 2
+            if indent['x'] - stack[middle]['x'] > threshold:
+                low = middle + 1
+            else:
+                high = middle
+        parents[indent['node_id']] = stack[low-1]['node_id'] if low > 0 else None
+        if indent['kind'] == 'content':
+            pending.append(indent)
+    return parents
+
+''' parent candidates of each column 0 cell, to get its parents for many thresholds (see get_parents_for_thresholds).
+    returns the cells node ids, the flat candidate positions (in indents) and indent gaps (cell x - candidate x, decreasing) and the start of each cell candidates '''
+def get_parent_candidates(indents):
+    # same stack as get_parents, each cell keeps a copy of the candidates instead of searching them
+    stack = []
+    pending = []
+    rowIndex = None
+    candidates = []
+    starts = []
+    for indent in indents:
+        if indent['rowIndex'] != rowIndex:
+            for position in pending:
+                while len(stack) > 0 and indents[stack[-1]]['x'] >= indents[position]['x']:
+                    stack.pop()
+                stack.append(position)
+            pending = []
+            rowIndex = indent['rowIndex']
+        starts.append(len(candidates))
+        candidates.extend(stack)
+        if indent['kind'] == 'content':
+            pending.append(len(starts) - 1)
+    x = np.array([indent['x'] for indent in indents], dtype=np.float64)
+    positions = np.array(candidates, dtype=np.int64)
+    starts = np.array(starts + [len(candidates)], dtype=np.int64)
+    gaps = np.repeat(x, np.diff(starts)) - x[positions]
+    return [indent['node_id'] for indent in indents], positions, gaps, starts
+
+''' get_parents for many thresholds at once (vectorized), returns a parents dictionary per threshold '''
+def get_parents_for_thresholds(candidates, thresholds):
+    node_ids, positions, gaps, starts = candidates
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    # the candidates gaps decrease, so the parent is the last of the candidates with a gap above the threshold
+    above = np.zeros((len(thresholds), len(gaps) + 1), dtype=np.int64)
+    np.cumsum(gaps[None, :] > thresholds[:, None], axis=1, out=above[:, 1:])
+    counts = above[:, starts[1:]] - above[:, starts[:-1]]
+    parent_positions = np.where(counts > 0, positions[np.maximum(starts[:-1] + counts - 1, 0)] if len(positions) > 0 else -1, -1)
+    return [{node_id: node_ids[position] if position >= 0 else None for node_id, position in zip(node_ids, row.tolist())} for row in parent_positions]
 
 ''' remove line breaks from a string '''
 def remove_line_breaks(content):
     return re.sub('\n', ' ', content).strip()
 
-''' add missing headers when they are not present in the table '''
-def add_missing_headers(cells, headers, rowIndex, columnIndex):
-    _headers = headers
+''' index the table cells by row and column (built once per table) '''
+def get_cell_grid(cells):
+    grid = {}
     for cell in cells:
-        if cell['rowIndex'] == rowIndex:
-            has_header = False
-            for header in headers:
-                if header['columnIndex'] == cell['columnIndex']:
-                    has_header = True
-                    break
-            if not has_header:
-                _headers.append({
-                    'content': f"TBD {cell['columnIndex']}",
-                    'rowIndex': 0,
-                    'columnIndex': cell['columnIndex']
-                })
-    return _headers
+        grid.setdefault(cell['rowIndex'], {})[cell['columnIndex']] = cell
+    return grid
+
+''' add missing headers when they are not present in the table, returns the number of added headers '''
+def add_missing_headers(row_cells, headers):
+    header_columns = set(header['columnIndex'] for header in headers)
+    added = 0
+    for columnIndex in row_cells:
+        if columnIndex not in header_columns:
+            headers.append({
+                'content': f"TBD {columnIndex}",
+                'rowIndex': 0,
+                'columnIndex': columnIndex
+            })
+            header_columns.add(columnIndex)
+            added += 1
+    return added
 
 ''' quick fix for the case where first header row cell has and empty value'''
 def fix_header_cells(headers):
@@ -115,43 +225,42 @@ def fix_header_cells(headers):
         new_headers.append(header)
     return new_headers
 
-''' populate the node with attribute values '''
-def add_values(cells, rowIndex, headers, node):
-    # find column indexes
+''' map each header column to its header rows and attribute names (rebuilt only when the headers change) '''
+def get_header_map(headers):
+    header_map = {}
+    # set of column indexes (its iteration order is the order of the missing attributes)
     column_indexes = set([])
     for header in headers:
         column_indexes.add(header['columnIndex'])
-    column_indexes = list(column_indexes)
-    
-    # find header row by looking for the closest header above the current row for each column
-    columns = []
     for column_i in column_indexes:
-        current_distance = 1000000
-        headerRowIndex = 0
-        for header in headers:
-            rowDistance = rowIndex - header['rowIndex']
-            if column_i == header['columnIndex'] and rowDistance < current_distance and rowDistance > 0 and header['content'] != '':
-                headerRowIndex = header['rowIndex']
-                current_distance = rowDistance
-
-        # define attributes names
-        for header in headers:
-            if column_i == header['columnIndex'] and headerRowIndex == header['rowIndex'] and header['content'] != '':
-                columns.append(header)
+        header_map[column_i] = {'rows': [], 'names': {}}
+    for header in headers:
+        if header['content'] != '':
+            names = header_map[header['columnIndex']]['names']
+            names.setdefault(header['rowIndex'], []).append(remove_line_breaks(header['content']))
+    for column in header_map.values():
+        column['rows'] = sorted(column['names'])
+    return header_map
+
+''' populate the node with attribute values '''
+def add_values(row_cells, rowIndex, header_map, node):
+    # find header row by looking for the closest header above the current row for each column
+    columns = {}
+    for column_i, column in header_map.items():
+        position = bisect.bisect_left(column['rows'], rowIndex)
+        headerRowIndex = column['rows'][position-1] if position > 0 else 0
+        columns[column_i] = column['names'].get(headerRowIndex, [])
 
     # fill attribute values
-    for cell in cells:
-        if cell['rowIndex'] == rowIndex:
-            for column in columns:
-                if column['columnIndex'] == cell['columnIndex']:
-                    column_name = remove_line_breaks(column['content'])
-                    node[column_name] = cell['content']
+    for columnIndex, cell in row_cells.items():
+        for column_name in columns.get(columnIndex, []):
+            node[column_name] = cell['content']
 
     # fill missing attributes with empty values
-    for column in columns:
-        column_name = remove_line_breaks(column['content'])
-        if column_name not in node:
-            node[column_name] = ''
+    for column_names in columns.values():
+        for column_name in column_names:
+            if column_name not in node:
+                node[column_name] = ''
 
 ''' check if items in a list are substrings of a string '''
 def contains(content, list):
@@ -203,155 +312,381 @@ def truncate(string, n):
     else:
         return string[:n-3] + '...'
 
-''' validate node accordingly its attributes '''
-def is_a_valid_node(node):
-    # check each dictionary key
+''' get the (column name, value) attributes of a node that need validation '''
+def get_attributes_to_validate(node):
     ignore_values = ['n/a', '']
+    attributes = []
     for key in node:
-        # check if the key is a valid attribute
-        if key in RESERVED_ATTRIBUTES or node[key] in ignore_values:
-            continue
-        elif (key.startswith('TBD')):
+        if key in RESERVED_ATTRIBUTES or node[key] in ignore_values or key.startswith('TBD'):
             continue
-        else:
-            validation = openai_utils.complete(VALIDATE_ATTRIBUTE_PROMPT, {'column_name': key, 'value': node[key]}).strip().lower()            
-            invalid = True if validation == "invalid" else False
-            if invalid:
-                logger.debug(f"Invalid node '{truncate(node['content'],20)}'. Invalid value '{truncate(node[key],20)}' to '{truncate(key,20)}' column")
-                return False
-    return True
-
-def get_node_styles(cell, document_styles):
-    cell_styles = []
+        attributes.append((key, node[key]))
+    return attributes
+
+''' prompt variables of an attribute validation: the column name and value judged (and cached), truncated to VALIDATION_MAX_CHARS '''
+def get_validation_variables(attribute):
+    column_name, value = attribute
+    return {'column_name': truncate(column_name, VALIDATION_MAX_CHARS), 'value': truncate(value, VALIDATION_MAX_CHARS)}
+
+''' format an attribute as an item of the batch validation prompt '''
+def format_validation_item(number, attribute):
+    variables = get_validation_variables(attribute)
+    return f"{number}. column name: \"{variables['column_name']}\" cell value: \"{variables['value']}\""
+
+''' split attributes in batches that fit the batch validation prompt '''
+def get_validation_batches(attributes):
+    prompt_tokens = openai_utils.count_tokens(get_prompt(VALIDATE_ATTRIBUTES_PROMPT))
+    available_tokens = openai_utils.get_prompt_limit() - get_validation_answer_tokens()
+    batches = []
+    batch = []
+    batch_tokens = prompt_tokens
+    for attribute in attributes:
+        # item tokens plus its line break and a margin for the item number
+        item_tokens = openai_utils.count_tokens(format_validation_item(0, attribute)) + 3
+        if len(batch) > 0 and (len(batch) >= VALIDATION_BATCH_SIZE or batch_tokens + item_tokens > available_tokens):
+            batches.append(batch)
+            batch = []
+            batch_tokens = prompt_tokens
+        batch.append(attribute)
+        batch_tokens += item_tokens
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+''' completion tokens reserved to the batch validation answer '''
+def get_validation_answer_tokens():
+    return VALIDATION_BATCH_SIZE * VALIDATION_ANSWER_TOKENS
+
+''' parse the batch validation answer, returns the category of each item found (by item position) '''
+def parse_validation_answer(answer, items_count):
+    categories = {}
+    for line in answer.splitlines():
+        match = re.match(r"^\s*(\d+)\s*[:.)-]\s*(valid|invalid|dont_know)\b", line, re.IGNORECASE)
+        if match and 0 < int(match.group(1)) <= items_count:
+            categories[int(match.group(1)) - 1] = match.group(2).lower()
+    return categories
+
+''' validate (column name, value) attributes concurrently (in batches when VALIDATION_BATCH_SIZE > 1), returns the category of each attribute '''
+def validate_attributes(attributes):
+    categories = {}
+    pending = list(dict.fromkeys(attributes))
+
+    if VALIDATION_BATCH_SIZE > 1:
+        # single cell validations are cached by the completion cache, reuse them
+        uncached = []
+        for attribute in pending:
+            category = openai_utils.get_cached_completion(get_prompt(VALIDATE_ATTRIBUTE_PROMPT), get_validation_variables(attribute))
+            if category is not None:
+                categories[attribute] = category.strip().lower()
+            else:
+                uncached.append(attribute)
+
+        pending = []
+        batches = get_validation_batches(uncached)
+        batch_variables = [{'items': "\n".join([format_validation_item(idx+1, attribute) for idx, attribute in enumerate(batch)])} for batch in batches]
+        answers = openai_utils.complete_all(get_prompt(VALIDATE_ATTRIBUTES_PROMPT), batch_variables, max_tokens=get_validation_answer_tokens())
+        for batch, answer in zip(batches, answers):
+            batch_categories = parse_validation_answer(answer, len(batch))
+            if len(batch_categories) < len(batch):
+                logger.debug(f"Could not parse {len(batch)-len(batch_categories)} of {len(batch)} batch validation items, validating them one by one")
+            for idx, attribute in enumerate(batch):
+                if idx in batch_categories:
+                    categories[attribute] = batch_categories[idx]
+                    # cached as the single cell validation of the (truncated) values judged in the batch
+                    openai_utils.set_cached_completion(get_prompt(VALIDATE_ATTRIBUTE_PROMPT), get_validation_variables(attribute), batch_categories[idx])
+                else:
+                    pending.append(attribute)
+
+    # validate remaining attributes one by one
+    variables_list = [get_validation_variables(attribute) for attribute in pending]
+    answers = openai_utils.complete_all(get_prompt(VALIDATE_ATTRIBUTE_PROMPT), variables_list)
+    for attribute, answer in zip(pending, answers):
+        categories[attribute] = answer.strip().lower()
+    return categories
+
+''' validate all nodes of a table accordingly their attributes '''
+@metrics_utils.timed("validate")
+def validate_nodes(nodes):
+    attributes = [attribute for node in nodes for attribute in get_attributes_to_validate(node)]
+    categories = validate_attributes(attributes)
+    valid_nodes = []
+    for node in nodes:
+        valid_node = True
+        for key, value in get_attributes_to_validate(node):
+            if categories[(key, value)] == "invalid":
+                logger.debug(f"Invalid node '{truncate(node['content'],20)}'. Invalid value '{truncate(value,20)}' to '{truncate(key,20)}' column")
+                valid_node = False
+                break
+        valid_nodes.append(valid_node)
+    return valid_nodes
+
+''' index the document styles by offset: sorted span boundaries and the styles active from each boundary to the next '''
+@metrics_utils.timed("style_index")
+def get_style_index(document_styles):
+    starts = {}
+    ends = {}
+    for number, style in enumerate(document_styles):
+        for style_span in (style['spans'] if 'spans' in style else []):
+            starts.setdefault(style_span['offset'], []).append(number)
+            ends.setdefault(style_span['offset'] + max(style_span['length'], 1), []).append(number)
+    boundaries = sorted(starts.keys() | ends.keys())
+    active_styles = []
+    active = {} # style number: number of its spans covering the offset
+    for boundary in boundaries:
+        for number in ends.get(boundary, []):
+            active[number] -= 1
+            if active[number] == 0:
+                del active[number]
+        for number in starts.get(boundary, []):
+            active[number] = active.get(number, 0) + 1
+        active_styles.append(tuple(sorted(active)))
+    attributes = []
+    for style in document_styles:
+        attributes.append({key: value for key, value in style.items() if key != 'spans'})
+    return {'boundaries': boundaries, 'active_styles': active_styles, 'attributes': attributes}
+
+''' styles overlapping any of the cell spans (each style once, in document order) '''
+def get_node_styles(cell, style_index):
+    boundaries = style_index['boundaries']
+    numbers = set()
     for cell_span in cell['spans']:
-        for style in document_styles:
-            style_spans = style['spans'] if 'spans' in style else []
-            for style_span in style_spans:
-                if cell_span['offset'] == style_span['offset']:
-                    cell_style = style.copy()
-                    del cell_style['spans']
-                    cell_styles.append(cell_style)
-    return cell_styles
-
-''' this function returns all document tables when tables are next to each other, they are merged into a single table '''
-def load_tables(tables):
-    _tables = []
-    for table in tables:
-        if len(_tables) == 0:
-            _tables.append(table)
-        else:
-            last_table = _tables[-1]
-            # check if it is the same table
-            same_table = False
-            last_bounding_region = last_table['boundingRegions'][-1]
-            current_bounding_region = table['boundingRegions'][0]
-            if last_bounding_region['pageNumber'] == current_bounding_region['pageNumber']:
-                if last_bounding_region['polygon'][5] - current_bounding_region['polygon'][1] < MERGE_TABLES_THRESHOLD:
-                    same_table = True
-            if same_table:
-                # merge tables
-                merged_table = last_table.copy()
-                merged_table['rowCount'] = merged_table['rowCount'] + table['rowCount']
-                merged_table['columnCount'] = max(merged_table['columnCount'],table['columnCount'])              
-
-                # adjust current table cells before merge them
-                for cell in table['cells']:
-                    cell['rowIndex'] = cell['rowIndex'] + last_table['rowCount']
-                    if 'kind' in cell: cell['kind'] = 'content' # changing current table headers to content
+        start = bisect.bisect_right(boundaries, cell_span['offset']) - 1
+        end = bisect.bisect_left(boundaries, cell_span['offset'] + max(cell_span['length'], 1))
+        for active in style_index['active_styles'][max(start, 0):end]:
+            numbers.update(active)
+    return [style_index['attributes'][number].copy() for number in sorted(numbers)]
+
+''' x range (left, right) of each table column, from its single column cells bounding regions (None when a column has no geometry) '''
+def get_column_positions(table):
+    positions = {}
+    for cell in table['cells']:
+        if cell.get('columnSpan', 1) != 1 or 'boundingRegions' not in cell or len(cell['boundingRegions']) == 0:
+            continue
+        polygon = cell['boundingRegions'][0]['polygon']
+        left, right = min(polygon[0], polygon[6]), max(polygon[2], polygon[4])
+        position = positions.get(cell['columnIndex'])
+        positions[cell['columnIndex']] = (left, right) if position is None else (min(position[0], left), max(position[1], right))
+    if any(column not in positions for column in range(table['columnCount'])):
+        return None
+    return positions
+
+''' map the columns of a table to the reference table columns with the same left and right edges (None when they are not aligned) '''
+def align_columns(positions, reference):
+    if positions is None or reference is None:
+        return None
+    mapping = {}
+    last = -1
+    for column in sorted(positions):
+        left, right = positions[column]
+        distances = [(max(abs(left - ref_left), abs(right - ref_right)), ref_column) for ref_column, (ref_left, ref_right) in reference.items()]
+        distance, ref_column = min(distances)
+        if distance > COLUMN_ALIGN_THRESHOLD or ref_column <= last:
+            return None
+        mapping[column] = ref_column
+        last = ref_column
+    return mapping
+
+''' vertical extent (top, bottom) of the text lines of each page, by page number '''
+def get_page_extents(pages):
+    if hasattr(pages, 'text_extents'): # compact document (document_utils), read from its arrays
+        return pages.text_extents()
+    extents = {}
+    for page in pages:
+        polygons = [line['polygon'] for line in page['lines'] if len(line['polygon']) >= 8]
+        if len(polygons) > 0:
+            extents[page['pageNumber']] = (min(polygon[1] for polygon in polygons), max(polygon[5] for polygon in polygons))
+    return extents
+
+''' the last table ends the text of its page and the next table starts the text of the next page (only headers and footers may be between them) '''
+def is_page_break(last_bounding_region, current_bounding_region, page_extents):
+    if current_bounding_region['pageNumber'] != last_bounding_region['pageNumber'] + 1:
+        return False
+    last_extent = page_extents.get(last_bounding_region['pageNumber'])
+    current_extent = page_extents.get(current_bounding_region['pageNumber'])
+    if last_extent is None or current_extent is None:
+        return False
+    return last_extent[1] - last_bounding_region['polygon'][5] <= PAGE_EDGE_THRESHOLD and \
+        current_bounding_region['polygon'][1] - current_extent[0] <= PAGE_EDGE_THRESHOLD
 
+''' the narrower table columns are aligned to the wider table columns '''
+def is_aligned(group_positions, positions):
+    if positions is None or group_positions is None:
+        return False
+    if len(positions) <= len(group_positions):
+        return align_columns(positions, group_positions) is not None
+    return align_columns(group_positions, positions) is not None
+
+''' check if a table continues the last table of a group (same page and close, or across a page break with aligned columns) '''
+def is_continuation(group_positions, last_table, table, positions, page_extents):
+    last_bounding_region = last_table['boundingRegions'][-1]
+    current_bounding_region = table['boundingRegions'][0]
+    if last_bounding_region['pageNumber'] == current_bounding_region['pageNumber']:
+        return last_bounding_region['polygon'][5] - current_bounding_region['polygon'][1] < MERGE_TABLES_THRESHOLD
+    return MERGE_PAGES and is_page_break(last_bounding_region, current_bounding_region, page_extents) and is_aligned(group_positions, positions)
+
+''' contents of the leading column header rows of a table '''
+def get_header_rows(table):
+    rows = {}
+    for cell in table['cells']:
+        rows.setdefault(cell['rowIndex'], []).append(cell)
+    header_rows = []
+    for rowIndex in sorted(rows):
+        if not all(cell.get('kind') == 'columnHeader' for cell in rows[rowIndex]):
+            break
+        header_rows.append(sorted(cell['content'] for cell in rows[rowIndex]))
+    return header_rows
+
+''' merge a group of table fragments into a single table (the fragment cells are copied, not changed) '''
+def stitch_tables(group):
+    first_table = group[0][0]
+    merged_table = first_table.copy()
+    merged_table['cells'] = []
+    merged_table['boundingRegions'] = []
+    if 'spans' in first_table:
+        merged_table['spans'] = []
+    merged_table['columnCount'] = max(table['columnCount'] for table, _ in group)
+    # columns are aligned to the widest fragment columns (the first one when they have the same width)
+    reference = next(positions for table, positions in group if table['columnCount'] == merged_table['columnCount'])
+    first_header_rows = get_header_rows(first_table) if len(group) > 1 else []
+    rowOffset = 0
+    for fragment_index, (table, positions) in enumerate(group):
+        mapping = align_columns(positions, reference)
+        difference = merged_table['columnCount'] - table['columnCount']
+        # continuation fragments on a new page usually repeat the header rows
+        skipped_rows = 0
+        if fragment_index > 0 and table['boundingRegions'][0]['pageNumber'] != group[fragment_index-1][0]['boundingRegions'][-1]['pageNumber']:
+            header_rows = get_header_rows(table)
+            if len(header_rows) > 0 and header_rows == first_header_rows[:len(header_rows)]:
+                skipped_rows = len(header_rows)
+        for cell in table['cells']:
+            if cell['rowIndex'] < skipped_rows:
+                continue
+            cell = cell.copy()
+            if fragment_index > 0:
+                cell['rowIndex'] = cell['rowIndex'] - skipped_rows + rowOffset
+                if 'kind' in cell: cell['kind'] = 'content' # changing current table headers to content
+            if mapping is not None:
+                # align the cell to the reference columns by x position (the first column is kept for the row items)
+                last_column = mapping[min(cell['columnIndex'] + cell.get('columnSpan', 1) - 1, max(mapping))]
+                columnIndex = 0 if cell['columnIndex'] == 0 else mapping[cell['columnIndex']]
+                if 'columnSpan' in cell or last_column != columnIndex:
+                    cell['columnSpan'] = last_column - columnIndex + 1
+                cell['columnIndex'] = columnIndex
+            elif difference > 0:
                 # if column count is different add column span to the first cell and add 1 to the other cells
-                difference = merged_table['columnCount'] - table['columnCount']
-                if difference > 0:
-                    # add to current table
-                    for cell in table['cells']:
-                        if cell['columnIndex'] == 0:
-                            if 'columnSpan' in cell: 
-                                cell['columnSpan'] = cell['columnSpan'] + abs(difference)
-                            else:
-                                cell['columnSpan'] = 1 + abs(difference)
-                        else:
-                            cell['columnIndex'] = cell['columnIndex'] + abs(difference)
-                elif difference < 0:
-                    # add to merged (last) table
-                    for cell in merged_table['cells']:
-                        if cell['columnIndex'] == 0:
-                            if 'columnSpan' in cell: 
-                                cell['columnSpan'] = cell['columnSpan'] + abs(difference)
-                            else:
-                                cell['columnSpan'] = 1 + abs(difference)
-                        else:
-                            cell['columnIndex'] = cell['columnIndex'] + abs(difference)
-                merged_table['cells'] = merged_table['cells'] + table['cells']
-                #TODO: adjust bounding regions, pages and spans
-                _tables[-1] = merged_table
-            else:
-                _tables.append(table)
-
-    return _tables
+                if cell['columnIndex'] == 0:
+                    cell['columnSpan'] = cell.get('columnSpan', 1) + difference
+                else:
+                    cell['columnIndex'] = cell['columnIndex'] + difference
+            merged_table['cells'].append(cell)
+        rowOffset += table['rowCount'] - skipped_rows
+        merged_table['boundingRegions'].extend(table['boundingRegions'])
+        if 'spans' in merged_table:
+            merged_table['spans'].extend(table['spans'] if 'spans' in table else [])
+    merged_table['rowCount'] = rowOffset
+    return merged_table
+
+''' this function returns all document tables when tables are next to each other, they are merged into a single table
+    (tables are only merged across pages when the document pages are given) '''
+@metrics_utils.timed("load_tables")
+def load_tables(tables, pages=None):
+    page_extents = get_page_extents(pages) if MERGE_PAGES and pages is not None else {}
+    groups = []
+    for table in tables:
+        positions = get_column_positions(table)
+        if len(groups) > 0 and is_continuation(groups[-1]['positions'], groups[-1]['fragments'][-1][0], table, positions, page_extents):
+            group = groups[-1]
+            group['fragments'].append((table, positions))
+            if table['columnCount'] > group['columnCount']:
+                group['columnCount'] = table['columnCount']
+                group['positions'] = positions
+        else:
+            groups.append({'fragments': [(table, positions)], 'positions': positions, 'columnCount': table['columnCount']})
+    return [stitch_tables(group['fragments']) for group in groups]
 
 
 
-''' parse the json result and create the tree structure '''
-def parse_json_result(data):
-    trees = [] 
-    tables = load_tables(data['tables'])
-    pages = data['pages']
-    for idx, table in enumerate(tables):
-        logger.debug(f"Parsing table {str(idx+1).zfill(3)}")
-        table = rename_duplicate_headers(table)
-        nodes = []
-        headers = []
-        parents_with_invalid_nodes = []
-        for cell in table['cells']:
-            content = cell['content']
-            rowIndex = cell['rowIndex']
-            columnIndex = cell['columnIndex']
-            kind = cell['kind'] if 'kind' in cell else 'content' # (default)
-            # identify headers to populate attributes later
-            if kind == 'columnHeader':
-                header = {
-                    'content': content,
-                    'rowIndex': rowIndex,
-                    'columnIndex': columnIndex
-                }
-                headers.append(header)
-            # identify content nodes               
-            elif cell['columnIndex'] == 0 and len(cell['spans']) > 0 and not contains(cell['content'], IGNORE_ITEMS_LIST):
-                node = {}
-                node['content'] = cell['content']
-                node['rowIndex'] = rowIndex
-                node['span_offset'] = cell['spans'][0]['offset']
-                node['span_length'] = cell['spans'][0]['length']
-                node['styles'] = get_node_styles(cell, data['styles']) if 'styles' in data else []
-                node['children'] = []
-
-                # create new headers when needed to avoid tables with no header issue
-                headers = add_missing_headers(table['cells'], headers, rowIndex, columnIndex)
-
+''' get the column 0 nodes of a table with their values, and whether each one is valid (all valid when validate is False) '''
+def get_table_nodes(table, style_index, validate=True):
+    grid = get_cell_grid(table['cells'])
+    table_nodes = []
+    headers = []
+    header_map = None
+    for cell in table['cells']:
+        content = cell['content']
+        rowIndex = cell['rowIndex']
+        columnIndex = cell['columnIndex']
+        kind = cell['kind'] if 'kind' in cell else 'content' # (default)
+        # identify headers to populate attributes later
+        if kind == 'columnHeader':
+            header = {
+                'content': content,
+                'rowIndex': rowIndex,
+                'columnIndex': columnIndex
+            }
+            headers.append(header)
+            header_map = None
+        # identify content nodes               
+        elif cell['columnIndex'] == 0 and len(cell['spans']) > 0 and not contains(cell['content'], IGNORE_ITEMS_LIST):
+            node = {}
+            node['content'] = cell['content']
+            node['rowIndex'] = rowIndex
+            node['span_offset'] = cell['spans'][0]['offset']
+            node['span_length'] = cell['spans'][0]['length']
+            node['styles'] = get_node_styles(cell, style_index) if style_index is not None else []
+            node['children'] = []
+
+            # create new headers when needed to avoid tables with no header issue
+            row_cells = grid.get(rowIndex, {})
+            if add_missing_headers(row_cells, headers) > 0:
+                header_map = None
+
+            if header_map is None:
                 # sometimes FR results are coming with header row with its first cell with no content.
                 # other times they come with ordinal numbers like 1, 2, 3.
                 # this behavior creates an issue when adding values to the node so need to fix it.
                 headers = fix_header_cells(headers)
+                header_map = get_header_map(headers)
+
+            # populate nodes values 
+            add_values(row_cells, rowIndex, header_map, node)
+            table_nodes.append(node)
+
+    # validate nodes before adding them to the tree
+    valid_nodes = validate_nodes(table_nodes) if validate else [True] * len(table_nodes)
+    return table_nodes, valid_nodes
+
+''' build the tree of a table attaching each valid node to its parent (the nodes children lists are filled) '''
+def build_tree(table_nodes, valid_nodes, parents):
+    nodes_by_id = {}
+    nodes = []
+    for node, valid_node in zip(table_nodes, valid_nodes):
+        node_id = get_node_id(node['content'], node['rowIndex'], node['span_offset'], node['span_length'])
+        parent_id = parents[node_id]
+        if (valid_node):
+            if parent_id is None:
+                # root node
+                nodes.append(node)
+                nodes_by_id[node_id] = node
+            elif parent_id in nodes_by_id:
+                nodes_by_id[parent_id]['children'].append(node)
+                nodes_by_id[node_id] = node
+    return nodes
+
+''' parse the json result and yield the tree structure of each table as soon as it is parsed '''
+def iter_trees(data):
+    tables = load_tables(data['tables'], data['pages'])
+    line_index = get_line_index(data['pages'])
+    style_index = get_style_index(data['styles']) if 'styles' in data else None
+    for idx, table in enumerate(tables):
+        logger.debug(f"Parsing table {str(idx+1).zfill(3)}")
+        table = rename_duplicate_headers(table)
+        parents = get_parents(get_indents(line_index, table))
+        table_nodes, valid_nodes = get_table_nodes(table, style_index)
+        yield build_tree(table_nodes, valid_nodes, parents)
 
-                # populate nodes values 
-                add_values(table['cells'], rowIndex, headers, node)
-                
-                # validate node before adding it to the tree
-                valid_node = is_a_valid_node(node)
-
-                parent = get_parent(pages, table, node['content'], node['rowIndex'], node['span_offset'], node['span_length'])
-                if (valid_node):
-                    if parent['content'] == 'Has no parent':
-                        # root node
-                        nodes.append(node)
-                    else:
-                        add_child(nodes, parent, node)
-                elif parent['content'] != 'Has no parent':
-                    parents_with_invalid_nodes.append(parent)
-
-        trees.append(nodes)
-
-    return trees
+''' parse the json result and create the tree structure '''
+def parse_json_result(data):
+    return list(iter_trees(data))
 
 ### Functions to convert tree structure to a dataframe ###
 
@@ -363,28 +698,38 @@ def get_height(nodes):
             max_path = max(max_path, get_height(node['children']))
     return max_path + 1
 
-''' convert the tree structure to a list of items '''
-def get_items_list(tree, curr_level, prefilled_item, levels, value_columns):
-    list = []
-    for node in tree:
-        item = prefilled_item.copy()
-        item[levels[curr_level]] = node['content']
-        # add current item to the list (leaf node)
-        for column in value_columns:
-            try:
-                item[column] = node[column]
-            except KeyError:
-                item[column] = ''
+''' flatten the tree (depth first) yielding the (level contents, values) of the rows with values '''
+def iter_items(tree, levels, value_columns):
+    value_indexes = {column: idx for idx, column in enumerate(value_columns)}
+    path = [] # contents of the ancestors of the current nodes
+    stack = [iter(tree)]
+    while len(stack) > 0:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            if len(path) > 0:
+                path.pop()
+            continue
+        contents = path + [node['content']]
+        values = [get_item_value(node, column) for column in value_columns]
         # check if it isn't an empty row and has required columns
-        if any(get_item_value(item, column) != '' for column in value_columns) and \
-            all(get_item_value(item, column) != '' for column in MUST_HAVE_COLUMNS):
-                list.append(item)
+        if any(value != '' for value in values) and \
+            all(get_row_value(column, contents, values, levels, value_indexes) != '' for column in MUST_HAVE_COLUMNS):
+                yield contents, values
         else:
             logger.debug(f"Removing node '{truncate(node['content'],30)}'. It has no values")
         # process children
         if len(node['children']) > 0:
-            list = list + get_items_list(node['children'], curr_level+1, item, levels, value_columns)
-    return list
+            path.append(node['content'])
+            stack.append(iter(node['children']))
+
+''' get a column value of a flattened row '''
+def get_row_value(column, contents, values, levels, value_indexes):
+    if column in value_indexes:
+        return values[value_indexes[column]]
+    if column in levels and levels.index(column) < len(contents):
+        return contents[levels.index(column)]
+    return ''
 
 ''' get tree first column name '''
 def get_first_column_name(tree):
@@ -396,57 +741,130 @@ def get_first_column_name(tree):
             break
     return first_column_name
 
+''' render the dataframe rows as markdown table lines '''
+def markdown_rows(df):
+    if len(df) == 0 or len(df.columns) == 0:
+        return ""
+    values = [df.iloc[:, idx].astype(object).where(df.iloc[:, idx].notna(), '').astype(str) for idx in range(len(df.columns))]
+    rows = values[0].str.cat(values[1:], sep="|") if len(values) > 1 else values[0]
+    return "".join("|" + rows + "|\n")
+
 def markdown_table(df):
-    table = ""
-    table = table + "|" + "|".join(df.columns) + "|\n"
-    table = table + "|" + "|".join(["---" for _ in df.columns]) + "|\n"
-    for i, row in df.iterrows():
-        table = table + "|" + "|".join([str(val) for val in row]) + "|\n"
+    columns = [str(column) for column in df.columns]
+    table = "|" + "|".join(columns) + "|\n"
+    table = table + "|" + "|".join(["---" for _ in columns]) + "|\n"
+    return table + markdown_rows(df)
+
+''' positions of count rows evenly spaced in a table of size rows (first and last included) '''
+def get_sample_positions(size, count):
+    return np.unique(np.linspace(0, size - 1, count).round().astype(int))
+
+''' markdown table with evenly spaced rows of the dataframe, as many as fit in max_tokens '''
+def sample_markdown_table(df, max_tokens):
+    table = markdown_table(df.iloc[0:0])
+    available_tokens = max_tokens - openai_utils.count_tokens(table)
+    if len(df) == 0 or available_tokens <= 0:
+        return table
+    # estimate the row size from a sample of rows, then check the exact size of the chosen rows
+    positions = get_sample_positions(len(df), min(len(df), TABLE_SAMPLE_ROWS))
+    sample_tokens = max(openai_utils.count_tokens(markdown_rows(df.iloc[positions])), 1)
+    count = min(len(df), int(available_tokens * len(positions) / sample_tokens))
+    while count > 0:
+        rows = markdown_rows(df.iloc[get_sample_positions(len(df), count)])
+        rows_tokens = openai_utils.count_tokens(rows)
+        if rows_tokens <= available_tokens:
+            if count < len(df):
+                logger.debug(f"Sampled {count} of {len(df)} table rows to fit the prompt")
+            return table + rows
+        count = min(count - 1, int(count * available_tokens / rows_tokens))
     return table
 
-def infer_column_name(column, df):
-    column_name = ""
-    column_name = openai_utils.complete(INFER_COLUMN_NAME_PROMPT, {'column_name': column, 'table': markdown_table(df)}).strip() 
-    if column_name != "":
-        logger.debug(f"Inferred '{column}' name as '{column_name}'")
-    else:
-        logger.debug(f"Could not infer '{column}' column name")        
-        column_name = "Could not infer"   
-    return column_name
+''' parse the column names answer, returns the new name of each column found '''
+def parse_column_names_answer(answer, columns):
+    names = {}
+    for line in answer.splitlines():
+        match = re.match(r'^\s*(.+?)\s*:\s*(.*?)\s*$', line)
+        if match is not None and match.group(1) in columns:
+            name = match.group(2).strip('"\'').strip()
+            if name != '':
+                names[match.group(1)] = name
+    return names
+
+''' infer the names of the columns in a single completion, returns the unique new name of each column '''
+@metrics_utils.timed("infer_column_names")
+def infer_column_names(columns, df):
+    column_names = "\n".join(columns)
+    max_tokens = COLUMN_NAME_ANSWER_TOKENS * len(columns)
+    prompt_tokens = openai_utils.count_tokens(get_prompt(INFER_COLUMN_NAMES_PROMPT).replace("{column_names}", column_names))
+    table = sample_markdown_table(df, openai_utils.get_prompt_limit() - max_tokens - prompt_tokens)
+    answer = openai_utils.complete(get_prompt(INFER_COLUMN_NAMES_PROMPT), {'column_names': column_names, 'table': table}, max_tokens=max_tokens)
+    names = parse_column_names_answer(answer, columns)
+    # the table can not have duplicated column names
+    used_names = set(str(column) for column in df.columns if column not in columns)
+    new_names = {}
+    for column in columns:
+        if column in names:
+            logger.debug(f"Inferred '{column}' name as '{names[column]}'")
+        else:
+            logger.debug(f"Could not infer '{column}' column name")
+        column_name = names.get(column, "Could not infer")
+        unique_name = column_name
+        count = 2
+        while unique_name in used_names:
+            unique_name = f"{column_name} {count}"
+            count += 1
+        used_names.add(unique_name)
+        new_names[column] = unique_name
+    return new_names
 
 ''' this function remove columns that have no vale in a dataframe'''
 def remove_empty_columns(df, columns):
-    dataframe = df.copy()
-    for column in dataframe.columns:
-        if (column in columns or column.startswith('TBD')):
-            remove = True            
-            for dado in dataframe[column]: 
-                if dado != None and str(dado).strip() != '':
-                    remove = False
-            if remove:
-                logger.debug(f"Removing column '{column}'. It has no values")
-                dataframe.drop(column, axis=1, inplace=True)
-    return dataframe
+    candidates = [column in columns or str(column).startswith('TBD') for column in df.columns]
+    subset = df.loc[:, candidates]
+    empty = (subset.isna() | subset.astype(str).apply(lambda values: values.str.strip() == '')).all(axis=0).to_numpy()
+    remove = [False] * len(candidates)
+    position = 0
+    for idx, candidate in enumerate(candidates):
+        if candidate:
+            remove[idx] = bool(empty[position])
+            position += 1
+            if remove[idx]:
+                logger.debug(f"Removing column '{df.columns[idx]}'. It has no values")
+    return df.loc[:, [not value for value in remove]].copy()
+
+''' level columns (item contents by depth) and value columns of a tree '''
+def get_columns(tree):
+    first_column_name = get_first_column_name(tree)
+    levels = [first_column_name] + [first_column_name + str(i+1) for i in range(0, get_height(tree)-1)]
+    value_columns = [column for column in tree[0].keys() if column not in levels + RESERVED_ATTRIBUTES]
+    return levels, value_columns
 
 ''' convert a tree to a dataframe '''	
+@metrics_utils.timed("dataframe")
 def get_dataframe(tree):
+    import pandas as pd
     if len(tree) == 0: return pd.DataFrame()
     
     # create dataframe
-    first_column_name = get_first_column_name(tree)
-    levels = [first_column_name] + [first_column_name + str(i+1) for i in range(0, get_height(tree)-1)]
-    value_columns = [column for column in tree[0].keys() if column not in levels + RESERVED_ATTRIBUTES]
+    levels, value_columns = get_columns(tree)
     columns = levels + value_columns
-    items_list = get_items_list(tree, 0, {}, levels, value_columns)
-    df = pd.DataFrame(items_list, columns=columns)
+    # append the rows straight into the column lists (missing levels are None)
+    level_lists = [[] for _ in levels]
+    value_lists = [[] for _ in value_columns]
+    for contents, values in iter_items(tree, levels, value_columns):
+        for idx, level_list in enumerate(level_lists):
+            level_list.append(contents[idx] if idx < len(contents) else None)
+        for value_list, value in zip(value_lists, values):
+            value_list.append(value)
+    df = pd.DataFrame(dict(enumerate(level_lists + value_lists)))
+    df.columns = columns
 
     # clean levels and TBD columns with no value (may be generated by empty/invalid nodes)
     df = remove_empty_columns(df, levels)
 
     # infer TBD column names
-    for column in columns:
-        if column.startswith('TBD '):
-            column_name = infer_column_name(column, df)
-            df = df.rename(columns={column: column_name})
+    tbd_columns = [column for column in df.columns if str(column).startswith('TBD ')]
+    if len(tbd_columns) > 0:
+        df = df.rename(columns=infer_column_names(tbd_columns, df))
     
     return df
\ No newline at end of file
@@ -0,0 +1,104 @@
+"""
+Title: Queue Utils
+Author: Paulo Lacerda
+Description: Persistent job queue stored in a local SQLite file, shared by the worker daemon and the commands that add jobs or report their status
+
+"""
+import os
+import sqlite3
+import threading
+import time
+
+STATUSES = ['queued', 'running', 'done', 'failed']
+
+class JobQueue:
+    def __init__(self, path) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = None
+        self.pid = None
+
+    ''' open the queue file (a new connection is needed after forking a process) '''
+    def connect(self):
+        if self.connection is None or self.pid != os.getpid():
+            folder = os.path.dirname(self.path)
+            if folder != '':
+                os.makedirs(folder, exist_ok=True)
+            self.connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT, file TEXT, modified REAL, status TEXT, attempts INTEGER DEFAULT 0,
+                tables INTEGER, error TEXT, submitted REAL, started REAL, finished REAL, UNIQUE (file, modified))""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            self.connection.commit()
+            self.pid = os.getpid()
+        return self.connection
+
+    ''' queue a file, returns the job id or None when this version of the file (same modification time) was already queued '''
+    def add(self, file):
+        modified = os.path.getmtime(file)
+        with self.lock:
+            connection = self.connect()
+            cursor = connection.execute("INSERT OR IGNORE INTO jobs (file, modified, status, submitted) VALUES (?, ?, 'queued', ?)", (file, modified, time.time()))
+            connection.commit()
+            return cursor.lastrowid if cursor.rowcount > 0 else None
+
+    ''' take the oldest queued job and mark it as running, returns (job id, file) or None when the queue is empty '''
+    def claim(self):
+        with self.lock:
+            connection = self.connect()
+            # the write lock is taken before reading, so workers sharing the queue never claim the same job
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT id, file FROM jobs WHERE status = 'queued' ORDER BY id LIMIT 1").fetchone()
+            if row is not None:
+                connection.execute("UPDATE jobs SET status = 'running', started = ?, attempts = attempts + 1 WHERE id = ?", (time.time(), row[0]))
+            connection.commit()
+            return row
+
+    def finish(self, job_id, tables):
+        self.update(job_id, 'done', tables=tables)
+
+    def fail(self, job_id, error):
+        self.update(job_id, 'failed', error=str(error))
+
+    def update(self, job_id, status, tables=None, error=None):
+        with self.lock:
+            connection = self.connect()
+            connection.execute("UPDATE jobs SET status = ?, tables = ?, error = ?, finished = ? WHERE id = ?", (status, tables, error, time.time(), job_id))
+            connection.commit()
+
+    ''' queue again the jobs with these statuses (e.g. running jobs of a stopped worker, or failed jobs), returns the number of jobs queued '''
+    def requeue(self, statuses):
+        with self.lock:
+            connection = self.connect()
+            cursor = connection.execute(f"UPDATE jobs SET status = 'queued', error = NULL WHERE status IN ({','.join('?' * len(statuses))})", list(statuses))
+            connection.commit()
+            return cursor.rowcount
+
+    ''' number of jobs by status '''
+    def counts(self):
+        with self.lock:
+            connection = self.connect()
+            counts = dict(connection.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in STATUSES}
+
+    ''' most recent jobs (as dictionaries), optionally with a given status '''
+    def jobs(self, limit=20, status=None):
+        query = "SELECT id, file, status, attempts, tables, error, submitted, started, finished FROM jobs"
+        parameters = []
+        if status is not None:
+            query += " WHERE status = ?"
+            parameters.append(status)
+        query += " ORDER BY id DESC LIMIT ?"
+        parameters.append(limit)
+        with self.lock:
+            connection = self.connect()
+            cursor = connection.execute(query, parameters)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,126 @@
+"""
+Title: Shard Utils
+Author: Paulo Lacerda
+Description: Split large PDFs in page range shards, analyze the shards in parallel and stitch their results back into a single result.
+             Rebasing and stitching work on result dictionaries (Document.to_dict or rest api format), so they can be checked offline with recorded results.
+
+"""
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import formrec_utils as fr
+from document_utils import Document
+from general_utils import logger
+
+PAGES_PER_SHARD = 50 # Pages of each shard when splitting a PDF.
+MAX_CONCURRENT_SHARDS = 4 # Max shards of a document analyzed at the same time.
+SHARD_RETRIES = 2 # Retries of a failed shard analysis (the other shards are not analyzed again).
+
+''' number of pages of a pdf file '''
+def get_page_count(filepath):
+    # pypdf is only needed when sharding
+    from pypdf import PdfReader
+    return len(PdfReader(filepath).pages)
+
+''' split a pdf file in shards of pages_per_shard pages saved in folder, returns the (shard path, first page number) of each shard '''
+def split_pdf(filepath, pages_per_shard, folder):
+    from pypdf import PdfReader, PdfWriter
+    reader = PdfReader(filepath)
+    name = os.path.splitext(os.path.basename(filepath))[0]
+    shards = []
+    for first in range(0, len(reader.pages), pages_per_shard):
+        last = min(first + pages_per_shard, len(reader.pages))
+        writer = PdfWriter()
+        for page in reader.pages[first:last]:
+            writer.add_page(page)
+        shard_path = os.path.join(folder, f"{name} pages {first+1}-{last}.pdf")
+        with open(shard_path, "wb") as f:
+            writer.write(f)
+        shards.append((shard_path, first + 1))
+    return shards
+
+''' end of the last span of a result (its content length when the content is not available) '''
+def get_content_length(value):
+    if isinstance(value, dict):
+        if 'content' in value and 'pages' in value:
+            return len(value['content'])
+        length = 0
+        for key, item in value.items():
+            if key == 'spans' and isinstance(item, list):
+                length = max([length] + [span['offset'] + span['length'] for span in item])
+            elif key == 'span' and isinstance(item, dict):
+                length = max(length, item['offset'] + item['length'])
+            else:
+                length = max(length, get_content_length(item))
+        return length
+    if isinstance(value, list):
+        return max([0] + [get_content_length(item) for item in value])
+    return 0
+
+''' copy of a shard result with its page numbers and span offsets moved to their position in the whole document '''
+def rebase_result(value, page_offset, span_offset):
+    if isinstance(value, dict):
+        rebased = {}
+        for key, item in value.items():
+            if key == 'pageNumber':
+                rebased[key] = item + page_offset
+            elif key == 'spans' and isinstance(item, list):
+                rebased[key] = [dict(span, offset=span['offset'] + span_offset) for span in item]
+            elif key == 'span' and isinstance(item, dict):
+                rebased[key] = dict(item, offset=item['offset'] + span_offset)
+            else:
+                rebased[key] = rebase_result(item, page_offset, span_offset)
+        return rebased
+    if isinstance(value, list):
+        return [rebase_result(item, page_offset, span_offset) for item in value]
+    return value
+
+''' stitch the shard results (dictionaries) in a single result, first_pages are the shards first page numbers '''
+def stitch_results(results, first_pages):
+    stitched = {}
+    span_offset = 0
+    for result, first_page in zip(results, first_pages):
+        rebased = rebase_result(result, first_page - 1, span_offset)
+        for key, item in rebased.items():
+            if isinstance(item, list):
+                stitched.setdefault(key, []).extend(item)
+            elif key == 'content':
+                stitched[key] = stitched[key] + "\n" + item if key in stitched else item
+            else:
+                stitched.setdefault(key, item)
+        # the next shard starts after this shard content and a separator
+        span_offset += get_content_length(result) + 1
+    return stitched
+
+''' analyze a shard, retrying when it fails '''
+def analyze_shard(shard_path, model, refresh=False):
+    for attempt in range(SHARD_RETRIES + 1):
+        try:
+            return fr.analyze_document_sdk(shard_path, model, refresh=refresh).to_dict()
+        except Exception as e:
+            if attempt == SHARD_RETRIES:
+                raise
+            logger.error(f"Error analyzing {os.path.basename(shard_path)}, retrying for the {attempt+1} time: {e}")
+
+''' analyze a pdf in page range shards analyzed in parallel, returns a single Document as analyze_document_sdk '''
+def analyze_document_sharded(filepath, model, pages_per_shard=PAGES_PER_SHARD, max_workers=MAX_CONCURRENT_SHARDS, refresh=False):
+    if not filepath.lower().endswith(".pdf") or get_page_count(filepath) <= pages_per_shard:
+        return fr.analyze_document_sdk(filepath, model, refresh=refresh)
+
+    # the stitched result is cached by shard size (the shards are also cached, so a failed shard is the only one analyzed again)
+    cache_key = fr.get_analysis_key(filepath, model, [f"pages_per_shard={pages_per_shard}"], "sdk-document")
+    if not refresh:
+        result = fr.get_cached_analysis(cache_key)
+        if result is not None:
+            logger.debug(f"Using cached analysis of {filepath}")
+            return Document.from_columns(result)
+
+    with tempfile.TemporaryDirectory() as folder:
+        shards = split_pdf(filepath, pages_per_shard, folder)
+        logger.info(f"Analyzing {filepath} in {len(shards)} shards of {pages_per_shard} pages")
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(lambda shard: analyze_shard(shard[0], model, refresh), shards))
+
+    document = Document.from_dict(stitch_results(results, [first_page for _, first_page in shards]))
+    fr.set_cached_analysis(cache_key, document.to_columns())
+    return document
@@ -0,0 +1,206 @@
+"""
+Title: Sweep
+Author: Paulo Lacerda
+Description: Parameter sweep of the table parsing heuristics (PARENT_INDENT_THRESHOLD and MERGE_TABLES_THRESHOLD) over a single analysis result,
+             scoring each setting against an optional ground truth csv. The analysis, line and style indexes, table adjacency and indents are computed once.
+
+"""
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+import argparse
+import csv
+import json
+import os
+import re
+from collections import Counter
+import numpy as np
+import parse_tables_utils
+from general_utils import logger
+
+DEFAULT_INDENT_THRESHOLDS = ["0:0.2:0.005"] # PARENT_INDENT_THRESHOLD values (start:stop:step ranges include the stop value)
+DEFAULT_MERGE_THRESHOLDS = ["0:2:0.25"] # MERGE_TABLES_THRESHOLD values
+
+''' threshold values of specs like 0.045 or 0:0.2:0.005 (sorted, without duplicates) '''
+def get_thresholds(specs):
+    values = []
+    for spec in specs:
+        for part in str(spec).split(","):
+            if ":" in part:
+                start, stop, step = (float(value) for value in part.split(":"))
+                values.extend(np.arange(start, stop + step / 2, step).tolist())
+            elif part.strip() != "":
+                values.append(float(part))
+    return sorted(set(round(value, 6) for value in values))
+
+class Sweep:
+    def __init__(self, result, validate=True) -> None:
+        self.tables = list(result['tables'])
+        self.line_index = parse_tables_utils.get_line_index(result['pages'])
+        self.style_index = parse_tables_utils.get_style_index(result['styles']) if 'styles' in result else None
+        self.validate = validate # validate the nodes with completions (once per distinct stitched table)
+        self.positions = [parse_tables_utils.get_column_positions(table) for table in self.tables]
+        # adjacency of each table with the previous one: same page vertical gap (nan on other pages) and page break flag
+        page_extents = parse_tables_utils.get_page_extents(result['pages'])
+        first_regions = [table['boundingRegions'][0] for table in self.tables]
+        last_regions = [table['boundingRegions'][-1] for table in self.tables]
+        self.gaps = np.full(len(self.tables), np.nan)
+        self.page_breaks = np.zeros(len(self.tables), dtype=bool)
+        for idx in range(1, len(self.tables)):
+            previous, current = last_regions[idx-1], first_regions[idx]
+            if previous['pageNumber'] == current['pageNumber']:
+                self.gaps[idx] = previous['polygon'][5] - current['polygon'][1]
+            else:
+                self.page_breaks[idx] = parse_tables_utils.is_page_break(previous, current, page_extents)
+        self.alignments = {} # (group reference table, table) -> columns aligned
+        self.parsed = {} # group (table indexes) -> parsed table
+        self.indent_thresholds = None
+
+    ''' the columns of a table on the next page are aligned to the group reference (widest fragment) columns, as in is_continuation '''
+    def is_aligned(self, reference, idx):
+        key = (reference, idx)
+        if key not in self.alignments:
+            self.alignments[key] = parse_tables_utils.is_aligned(self.positions[reference], self.positions[idx])
+        return self.alignments[key]
+
+    ''' group the tables as load_tables does with a given merge threshold, returns the table indexes of each group '''
+    def group_tables(self, merge_threshold):
+        merged = self.gaps < merge_threshold # nan gaps (other pages) are never merged by distance
+        groups = []
+        for idx, table in enumerate(self.tables):
+            if len(groups) > 0 and (merged[idx] or (parse_tables_utils.MERGE_PAGES and self.page_breaks[idx] and self.is_aligned(groups[-1]['reference'], idx))):
+                group = groups[-1]
+                group['tables'].append(idx)
+                if table['columnCount'] > self.tables[group['reference']]['columnCount']:
+                    group['reference'] = idx
+            else:
+                groups.append({'tables': [idx], 'reference': idx})
+        return [tuple(group['tables']) for group in groups]
+
+    ''' stitch, index and validate a group of tables once, with its parents for every indent threshold '''
+    def parse(self, group):
+        if group not in self.parsed:
+            table = parse_tables_utils.stitch_tables([(self.tables[idx], self.positions[idx]) for idx in group])
+            table = parse_tables_utils.rename_duplicate_headers(table)
+            candidates = parse_tables_utils.get_parent_candidates(parse_tables_utils.get_indents(self.line_index, table))
+            table_nodes, valid_nodes = parse_tables_utils.get_table_nodes(table, self.style_index, self.validate)
+            self.parsed[group] = {
+                'nodes': table_nodes,
+                'valid_nodes': valid_nodes,
+                'parents': parse_tables_utils.get_parents_for_thresholds(candidates, self.indent_thresholds)
+            }
+        return self.parsed[group]
+
+    ''' evaluate every setting, returns a result row per (indent threshold, merge threshold) '''
+    def run(self, indent_thresholds, merge_thresholds, truth=None):
+        if self.indent_thresholds != list(indent_thresholds):
+            self.indent_thresholds = list(indent_thresholds)
+            self.parsed = {}
+        results = []
+        for merge_threshold in merge_thresholds:
+            groups = self.group_tables(merge_threshold)
+            parsed = [self.parse(group) for group in groups]
+            for idx, indent_threshold in enumerate(self.indent_thresholds):
+                trees = []
+                for table in parsed:
+                    # build_tree fills the children lists, each setting gets its own copy of the nodes
+                    nodes = [dict(node, children=[]) for node in table['nodes']]
+                    trees.append(parse_tables_utils.build_tree(nodes, table['valid_nodes'], table['parents'][idx]))
+                paths = get_paths(trees)
+                row = {
+                    'indent_threshold': indent_threshold,
+                    'merge_threshold': merge_threshold,
+                    'tables': len(groups),
+                    'items': len(paths),
+                    'depth': max((len(path) for path in paths), default=0)
+                }
+                if truth is not None:
+                    row.update(score(paths, truth))
+                results.append(row)
+        logger.info(f"Evaluated {len(results)} settings parsing {len(self.parsed)} distinct tables")
+        return results
+
+''' level paths (stripped contents of the item and its ancestors) of the rows the trees would produce '''
+def get_paths(trees):
+    paths = []
+    for tree in trees:
+        if len(tree) == 0:
+            continue
+        levels, value_columns = parse_tables_utils.get_columns(tree)
+        for contents, values in parse_tables_utils.iter_items(tree, levels, value_columns):
+            paths.append(tuple(content.strip() for content in contents if content.strip() != ''))
+    return paths
+
+''' level paths of ground truth csv files (tables in the parse_tables csv output format, the first column and its numbered columns are the levels) '''
+def load_truth(files):
+    paths = []
+    for file in files:
+        with open(file, newline='', encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        if len(rows) == 0:
+            continue
+        header = rows[0]
+        levels = [0] + [idx for idx, column in enumerate(header) if idx > 0 and re.fullmatch(re.escape(header[0]) + r"\d+", column)]
+        for row in rows[1:]:
+            path = tuple(row[idx].strip() for idx in levels if idx < len(row) and row[idx].strip() != '')
+            if len(path) > 0:
+                paths.append(path)
+    return paths
+
+''' precision, recall and f1 of the parsed level paths (multisets, repeated items count) '''
+def score(paths, truth):
+    matches = sum((Counter(paths) & Counter(truth)).values())
+    precision = matches / len(paths) if len(paths) > 0 else 0.0
+    recall = matches / len(truth) if len(truth) > 0 else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+    return {'precision': precision, 'recall': recall, 'f1': f1}
+
+''' analysis result of a json file (Document.to_dict output or rest api response) or of a document analyzed with the parser model (cached) '''
+def load_result(file, refresh=False):
+    if file.lower().endswith('.json'):
+        with open(file, encoding='utf-8') as f:
+            data = json.load(f)
+        return data.get('analyzeResult', data)
+    import parse_tables
+    return parse_tables.Parser(refresh).analyze(file)
+
+''' best setting: highest f1 (ties go to the settings closest to the current thresholds) '''
+def get_best(results):
+    def distance(row):
+        return abs(row['indent_threshold'] - parse_tables_utils.PARENT_INDENT_THRESHOLD) + abs(row['merge_threshold'] - parse_tables_utils.MERGE_TABLES_THRESHOLD)
+    return max(results, key=lambda row: (row['f1'], -distance(row)))
+
+def save_results(results, output):
+    folder = os.path.dirname(output)
+    if folder != '':
+        os.makedirs(folder, exist_ok=True)
+    with open(output, "w", newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+def main(file, indent_thresholds, merge_thresholds, truth_files=None, output=None, validate=True, refresh=False):
+    sweep = Sweep(load_result(file, refresh), validate)
+    truth = load_truth(truth_files) if truth_files else None
+    results = sweep.run(indent_thresholds, merge_thresholds, truth)
+    for row in results:
+        scores = f" precision {row['precision']:.3f} recall {row['recall']:.3f} f1 {row['f1']:.3f}" if truth is not None else ""
+        print(f"indent {row['indent_threshold']:<8} merge {row['merge_threshold']:<6} tables {row['tables']:>4} items {row['items']:>6} depth {row['depth']:>2}{scores}")
+    if output is not None and len(results) > 0:
+        save_results(results, output)
+        print(f"Results saved to {output}")
+    if truth is not None and len(results) > 0:
+        best = get_best(results)
+        print(f"BEST PARENT_INDENT_THRESHOLD = {best['indent_threshold']} MERGE_TABLES_THRESHOLD = {best['merge_threshold']} (f1 {best['f1']:.3f})")
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sweep the table parsing thresholds over a single analysis result')
+    parser.add_argument('file', type=str, help='document to analyze (cached) or analysis result json file')
+    parser.add_argument('--indent', nargs='+', default=DEFAULT_INDENT_THRESHOLDS, help='PARENT_INDENT_THRESHOLD values or start:stop:step ranges')
+    parser.add_argument('--merge', nargs='+', default=DEFAULT_MERGE_THRESHOLDS, help='MERGE_TABLES_THRESHOLD values or start:stop:step ranges')
+    parser.add_argument('--truth', nargs='+', default=None, help='ground truth csv files (expected tables in the parse_tables csv format)')
+    parser.add_argument('--output', type=str, default=None, help='save the results of every setting to this csv file')
+    parser.add_argument('--skip-validation', action='store_true', help='keep every node (no validation completions)')
+    parser.add_argument('--refresh', action='store_true', help='analyze the document again even when its result is cached')
+    args = parser.parse_args()
+    main(args.file, get_thresholds(args.indent), get_thresholds(args.merge), args.truth, args.output, not args.skip_validation, args.refresh)
@@ -0,0 +1,123 @@
+"""
+Title: Synthetic Utils
+Author: Paulo Lacerda
+Description: Generate synthetic analysis results in the Document.to_dict format (pages, lines, tables and styles),
+             with hierarchical (indented) table items, to benchmark the table parsing without calling Azure.
+
+"""
+import random
+
+PAGE_WIDTH = 8.5 # inches
+INDENT_WIDTH = 0.25 # x distance (inches) between the items of two hierarchy levels
+LINE_HEIGHT = 0.2 # inches
+HEADERS = ['Fee', 'Volume', 'Unit Price', 'Minimum', 'Maximum', 'Frequency', 'Notes']
+SERVICES = ['Account Maintenance', 'ACH Debit', 'ACH Credit', 'Wire Transfer', 'Check Deposit', 'Lockbox', 'Positive Pay', 'Balance Report']
+
+''' line polygon (4 points, flat list) '''
+def get_polygon(x0, y0, x1, y1):
+    return [x0, y0, x1, y0, x1, y1, x0, y1]
+
+''' x ranges of the table columns (consecutive tables alternate their column edges 0.5 inches apart, more than COLUMN_ALIGN_THRESHOLD, so they are never aligned) '''
+def get_columns(table_index, columns):
+    left = 0.5 + (table_index % 2) * 0.5
+    first_width = 3.0
+    width = (PAGE_WIDTH - 0.5 - left - first_width) / max(columns - 1, 1)
+    ranges = [(left, left + first_width)]
+    for column in range(1, columns):
+        ranges.append((left + first_width + (column - 1) * width, left + first_width + column * width))
+    return ranges
+
+''' item levels following a random walk, so items have children up to depth levels '''
+def get_levels(generator, rows, depth):
+    levels = []
+    level = 0
+    for _ in range(rows):
+        levels.append(level)
+        level = max(0, min(depth - 1, level + generator.choice([-1, 0, 1, 1]) if level > 0 else generator.choice([0, 1])))
+    return levels
+
+class DocumentGenerator:
+    def __init__(self, seed) -> None:
+        self.random = random.Random(seed)
+        self.offset = 0
+        self.pages = []
+
+    ''' add a line to the current page, returns its span '''
+    def add_line(self, content, x0, y0, x1):
+        span = {'offset': self.offset, 'length': len(content)}
+        self.pages[-1]['lines'].append({'content': content, 'spans': [span], 'polygon': get_polygon(x0, y0, x1, y0 + LINE_HEIGHT)})
+        self.offset += len(content) + 1
+        return span
+
+    def add_table(self, table_index, rows, columns, depth, y):
+        page_number = self.pages[-1]['pageNumber']
+        table_start = self.offset
+        ranges = get_columns(table_index, columns)
+        cells = []
+        # header row
+        for column, (x0, x1) in enumerate(ranges):
+            content = "Service" if column == 0 else HEADERS[(column - 1) % len(HEADERS)]
+            span = self.add_line(content, x0, y, x1)
+            cells.append({'rowIndex': 0, 'columnIndex': column, 'rowSpan': 1, 'columnSpan': 1, 'content': content, 'kind': 'columnHeader', 'spans': [span],
+                          'boundingRegions': [{'pageNumber': page_number, 'polygon': get_polygon(x0, y, x1, y + LINE_HEIGHT)}]})
+        # item rows, indented by their level
+        for row, level in enumerate(get_levels(self.random, rows - 1, depth), start=1):
+            row_y = y + row * LINE_HEIGHT
+            for column, (x0, x1) in enumerate(ranges):
+                if column == 0:
+                    content = f"{self.random.choice(SERVICES)} {table_index+1}.{row}"
+                    x0 = x0 + level * INDENT_WIDTH
+                elif self.random.random() < 0.15:
+                    content = ""
+                else:
+                    content = f"${self.random.randint(0, 5000) / 100:.2f}"
+                span = self.add_line(content, x0, row_y, x1) if content != "" else None
+                cells.append({'rowIndex': row, 'columnIndex': column, 'rowSpan': 1, 'columnSpan': 1, 'content': content, 'kind': 'content', 'spans': [span] if span else [],
+                              'boundingRegions': [{'pageNumber': page_number, 'polygon': get_polygon(x0, row_y, ranges[column][1], row_y + LINE_HEIGHT)}]})
+        bottom = y + rows * LINE_HEIGHT
+        return {
+            'rowCount': rows,
+            'columnCount': columns,
+            'cells': cells,
+            'boundingRegions': [{'pageNumber': page_number, 'polygon': get_polygon(ranges[0][0], y, ranges[-1][1], bottom)}],
+            'spans': [{'offset': table_start, 'length': self.offset - table_start}]
+        }
+
+    def add_styles(self, tables, styles):
+        result = []
+        item_spans = [cell['spans'][0] for table in tables for cell in table['cells'] if cell['columnIndex'] == 0 and len(cell['spans']) > 0]
+        line_spans = [line['spans'][0] for page in self.pages for line in page['lines']]
+        for number in range(styles):
+            # bold items and font styles covering random lines
+            if number % 2 == 0 and len(item_spans) > 0:
+                spans = self.random.sample(item_spans, max(1, len(item_spans) // max(styles, 1)))
+                style = {'fontWeight': 'bold', 'confidence': 1.0}
+            else:
+                spans = self.random.sample(line_spans, max(1, len(line_spans) // max(styles, 1)))
+                style = {'similarFontFamily': 'Arial', 'fontStyle': 'normal', 'confidence': 1.0}
+            style['spans'] = [dict(span) for span in sorted(spans, key=lambda span: span['offset'])]
+            result.append(style)
+        return result
+
+''' generate an analysis result in the Document.to_dict format
+    pages: number of pages, lines: text lines per page (besides the table lines), tables: number of tables (spread over the pages),
+    rows: rows per table (header included), columns: columns per table, depth: max hierarchy levels of the items, styles: number of document styles
+    load_tables keeps the tables apart when there is at most one table per page: the text lines above each table and the alternating column edges prevent merges across pages '''
+def generate_result(pages=10, lines=40, tables=5, rows=30, columns=4, depth=3, styles=10, seed=0):
+    generator = DocumentGenerator(seed)
+    result_tables = []
+    tables_per_page = [0] * pages
+    for table_index in range(tables):
+        tables_per_page[table_index * pages // max(tables, 1)] += 1
+    table_index = 0
+    for page_number in range(1, pages + 1):
+        generator.pages.append({'pageNumber': page_number, 'lines': []})
+        y = 0.5
+        for line in range(lines):
+            generator.add_line(f"Synthetic text line {line+1} of page {page_number}", 0.5, y, 8.0)
+            y += LINE_HEIGHT
+        for _ in range(tables_per_page[page_number - 1]):
+            result_tables.append(generator.add_table(table_index, rows, columns, depth, y + LINE_HEIGHT))
+            y += (rows + 2) * LINE_HEIGHT
+            table_index += 1
+    return {'pages': generator.pages, 'tables': result_tables, 'styles': generator.add_styles(result_tables, styles)}
@@ -0,0 +1,165 @@
+"""
+Title: Worker
+Author: Paulo Lacerda
+Description: Long running worker parsing the tables of the files added to a job queue (or found in a watched folder),
+             keeping the service clients, tokenizer and caches warm between documents.
+
+"""
+from dotenv import load_dotenv, find_dotenv
+load_dotenv(find_dotenv())
+import argparse
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import formrec_utils as fr
+import openai_utils
+import output_utils
+import metrics_utils
+import parse_tables
+from queue_utils import JobQueue
+from general_utils import logger
+
+QUEUE_FILE = os.getenv("WORKER_QUEUE_FILE", ".cache/jobs.sqlite")
+WATCH_EXTENSIONS = ('.pdf', '.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff') # files queued from the watched folder
+POLL_INTERVAL = 2.0 # Seconds between watched folder scans (and queue checks when the worker is idle).
+
+class Worker:
+    def __init__(self, queue, parser, concurrency=4, watch=None, poll_interval=POLL_INTERVAL, prometheus_file=None) -> None:
+        self.queue = queue
+        self.parser = parser
+        self.concurrency = concurrency # documents processed at the same time
+        self.watch = watch # folder scanned for new files
+        self.poll_interval = poll_interval
+        self.prometheus_file = prometheus_file
+        self.sink_lock = threading.Lock() # the sinks are not thread safe
+        self.sizes = {} # watched files size in the previous scan
+        self.stop_event = threading.Event()
+
+    ''' create the clients, tokenizer and caches once, so the first document does not pay for them '''
+    def warm_up(self):
+        if fr.endpoint:
+            fr.get_client()
+        fr.get_analysis_cache()
+        openai_utils.get_completion_cache()
+        try:
+            for model in set(openai_utils.deployment_model.values()):
+                openai_utils.get_encoder(model)
+        except Exception as e:
+            logger.warning(f"Could not load the tokenizer: {e}")
+
+    ''' queue the new files of the watched folder, once their size is stable (they are not being copied) '''
+    def scan(self):
+        sizes = {}
+        for entry in os.scandir(self.watch):
+            if entry.is_file() and entry.name.lower().endswith(WATCH_EXTENSIONS):
+                sizes[entry.path] = entry.stat().st_size
+        for file, size in sizes.items():
+            if self.sizes.get(file) == size and self.queue.add(file) is not None:
+                logger.info(f"Queued {file}")
+        self.sizes = sizes
+
+    def process(self, job_id, file):
+        logger.info(f"PROCESSING {file} (job {job_id})")
+        try:
+            with metrics_utils.span("job"):
+                result = self.parser.analyze(file)
+                dataframes = parse_tables.get_dataframes(result)
+                with self.sink_lock:
+                    tables = self.parser.save(file, dataframes)
+            self.queue.finish(job_id, tables)
+            metrics_utils.increment("jobs", status="done")
+            logger.info(f"DONE {file} ({tables} tables)")
+        except Exception as e:
+            self.queue.fail(job_id, e)
+            metrics_utils.increment("jobs", status="failed")
+            logger.error(f"FAILED {file}: {e}")
+
+    def stop(self, *args):
+        logger.info("Stopping the worker after the running jobs")
+        self.stop_event.set()
+
+    ''' process queued jobs until stopped, keeping up to concurrency jobs running (until the queue is empty when once is True) '''
+    def run(self, once=False):
+        self.warm_up()
+        logger.info(f"Worker started (concurrency {self.concurrency}{', watching ' + self.watch if self.watch else ''})")
+        running = set()
+        last_scan = 0
+        scans = 0
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            while not self.stop_event.is_set():
+                if self.watch and time.monotonic() - last_scan >= self.poll_interval:
+                    self.scan()
+                    last_scan = time.monotonic()
+                    scans += 1
+                while len(running) < self.concurrency:
+                    job = self.queue.claim()
+                    if job is None:
+                        break
+                    running.add(pool.submit(self.process, *job))
+                if len(running) == 0:
+                    # watched files are queued in their second scan
+                    if once and (not self.watch or scans >= 2):
+                        break
+                    self.stop_event.wait(self.poll_interval)
+                    continue
+                done, running = wait(running, timeout=self.poll_interval, return_when=FIRST_COMPLETED)
+                if len(done) > 0 and self.prometheus_file:
+                    metrics_utils.write_prometheus(self.prometheus_file)
+        self.parser.sink.close()
+        if self.prometheus_file:
+            metrics_utils.write_prometheus(self.prometheus_file)
+
+def print_status(queue, limit=20, status=None):
+    counts = queue.counts()
+    print(" ".join(f"{key}: {value}" for key, value in counts.items()))
+    for job in queue.jobs(limit, status):
+        end = job['finished'] if job['status'] in ('done', 'failed') else time.time()
+        duration = f"{end - job['started']:.1f}s" if job['started'] else ""
+        details = job['error'] if job['status'] == 'failed' else (f"{job['tables']} tables" if job['status'] == 'done' else "")
+        print(f"{job['id']:>6} {job['status']:<8} {duration:>8} {job['file']} {details}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Parse tables of queued files with a long running worker')
+    parser.add_argument('--queue', type=str, default=QUEUE_FILE, help='job queue file')
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help='run the worker')
+    run_parser.add_argument('--watch', type=str, default=None, help='queue the new files of this folder')
+    run_parser.add_argument('--concurrency', type=int, default=4, help='number of files processed at the same time')
+    run_parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='seconds between folder scans and queue checks')
+    run_parser.add_argument('--once', action='store_true', help='stop when the queue is empty')
+    run_parser.add_argument('--recover', action='store_true', help='queue again the jobs left running by a stopped worker (only one worker uses the queue)')
+    run_parser.add_argument('--refresh', action='store_true', help='analyze the files again even when their results are cached')
+    run_parser.add_argument('--format', choices=list(output_utils.SINKS), default='csv', help='output file format')
+    run_parser.add_argument('--consolidate', choices=output_utils.SCOPES, default='table', help='write one file per table, per document or a single file for all files')
+    run_parser.add_argument('--output', type=str, default=None, help='output file when consolidating a batch (default: tables.<format>)')
+    run_parser.add_argument('--pages-per-shard', type=int, default=None, help='split PDFs with more pages in shards of this size analyzed in parallel')
+    run_parser.add_argument('--metrics-prom', type=str, default=None, help='Prometheus textfile updated as jobs finish')
+    add_parser = commands.add_parser('add', help='queue files')
+    add_parser.add_argument('files', type=str, nargs='+', help='files to parse')
+    status_parser = commands.add_parser('status', help='show the jobs status')
+    status_parser.add_argument('--limit', type=int, default=20, help='number of recent jobs shown')
+    status_parser.add_argument('--status', choices=['queued', 'running', 'done', 'failed'], default=None, help='only show jobs with this status')
+    commands.add_parser('retry', help='queue the failed jobs again')
+    args = parser.parse_args()
+
+    queue = JobQueue(args.queue)
+    if args.command == 'add':
+        for file in args.files:
+            job_id = queue.add(file)
+            print(f"Queued {file} (job {job_id})" if job_id is not None else f"Skipped {file} (already queued)")
+    elif args.command == 'status':
+        print_status(queue, args.limit, args.status)
+    elif args.command == 'retry':
+        print(f"Queued {queue.requeue(['failed'])} failed jobs")
+    else:
+        if args.recover:
+            logger.info(f"Queued {queue.requeue(['running'])} jobs left running")
+        if args.metrics_prom:
+            metrics_utils.enable()
+        sink = output_utils.get_sink(args.format, args.consolidate, args.output)
+        worker = Worker(queue, parse_tables.Parser(args.refresh, sink, args.pages_per_shard), args.concurrency, args.watch, args.poll_interval, args.metrics_prom)
+        signal.signal(signal.SIGTERM, worker.stop)
+        signal.signal(signal.SIGINT, worker.stop)
+        worker.run(args.once)
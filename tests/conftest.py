@@ -0,0 +1,14 @@
+import os
+import re
+import sys
+
+# the source modules import each other by name (they run as scripts from the source folder)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "source"))
+
+class WordEncoder:
+    ''' offline stand-in of the tiktoken encoders: one token per word, punctuation mark or whitespace run '''
+    def encode(self, text):
+        return re.findall(r"\w+|[^\w\s]|\s+", text)
+
+    def encode_batch(self, texts):
+        return [self.encode(text) for text in texts]
@@ -0,0 +1,6 @@
+import benchmark
+
+def test_parse_tables_imports_within_budget_without_lazy_modules():
+    seconds, modules = benchmark.measure_import("parse_tables")
+    assert seconds < benchmark.IMPORT_TIME_BUDGET
+    assert modules == []
@@ -0,0 +1,13 @@
+from cache_utils import Cache
+
+def test_size_limit_counts_utf8_bytes(tmp_path):
+    cache = Cache(str(tmp_path / "cache.sqlite"), max_bytes=10)
+    cache.set("ascii", "12345")
+    assert cache.stats()['bytes'] == 5
+    # 4 characters, 8 bytes
+    cache.set("accents", "éééé")
+    assert cache.stats()['bytes'] == 8
+    assert cache.get("ascii") is None # evicted, 13 bytes do not fit
+    # 6 characters but 12 bytes, larger than the cache
+    cache.set("large", "éééééé")
+    assert cache.get("large") is None
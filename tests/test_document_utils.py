@@ -0,0 +1,57 @@
+import json
+from collections import namedtuple
+from types import SimpleNamespace
+import numpy as np
+from document_utils import Document, STYLE_ATTRIBUTES
+from synthetic_utils import generate_result
+
+Point = namedtuple('Point', ['x', 'y'])
+
+def get_result():
+    result = generate_result(pages=3, lines=4, tables=2, rows=6, columns=3, styles=5)
+    # a page without lines and a line with two spans
+    result['pages'].append({'pageNumber': 4, 'lines': []})
+    result['pages'][0]['lines'][0]['spans'].append({'offset': 500, 'length': 2})
+    return result
+
+def test_from_dict_keeps_the_result():
+    result = get_result()
+    assert Document.from_dict(result).to_dict() == json.loads(json.dumps(result))
+
+def test_columns_round_trip_is_lossless():
+    document = Document.from_dict(get_result())
+    # the analysis cache stores the columns as json
+    restored = Document.from_columns(json.loads(json.dumps(document.to_columns())))
+    assert restored.to_dict() == document.to_dict()
+    for name in Document.ARRAYS:
+        assert getattr(restored, name).dtype == getattr(document, name).dtype
+        assert np.array_equal(getattr(restored, name), getattr(document, name))
+
+def test_columns_round_trip_without_styles():
+    result = get_result()
+    del result['styles']
+    document = Document.from_columns(json.loads(json.dumps(Document.from_dict(result).to_columns())))
+    assert 'styles' not in document
+    assert document.to_dict() == json.loads(json.dumps(result))
+
+''' sdk objects with the fields of a result dictionary (polygons as points) '''
+def get_sdk_result(result):
+    def spans(items):
+        return [SimpleNamespace(offset=span['offset'], length=span['length']) for span in items]
+    def regions(items):
+        return [SimpleNamespace(page_number=region['pageNumber'], polygon=[Point(*region['polygon'][idx:idx+2]) for idx in range(0, 8, 2)]) for region in items]
+    pages = [SimpleNamespace(page_number=page['pageNumber'], lines=[
+        SimpleNamespace(content=line['content'], polygon=[Point(*line['polygon'][idx:idx+2]) for idx in range(0, 8, 2)], spans=spans(line['spans'])) for line in page['lines']
+    ]) for page in result['pages']]
+    tables = [SimpleNamespace(row_count=table['rowCount'], column_count=table['columnCount'], bounding_regions=regions(table['boundingRegions']), spans=spans(table['spans']), cells=[
+        SimpleNamespace(row_index=cell['rowIndex'], column_index=cell['columnIndex'], row_span=cell['rowSpan'], column_span=cell['columnSpan'],
+                        content=cell['content'], kind=cell['kind'], spans=spans(cell['spans']), bounding_regions=regions(cell['boundingRegions'])) for cell in table['cells']
+    ]) for table in result['tables']]
+    styles = [SimpleNamespace(spans=spans(style['spans']), **{attribute: style.get(key) for key, attribute in STYLE_ATTRIBUTES.items()}) for style in result['styles']]
+    return SimpleNamespace(pages=pages, tables=tables, styles=styles)
+
+def test_from_sdk_result_matches_from_dict():
+    result = get_result()
+    document = Document.from_sdk_result(get_sdk_result(result))
+    assert document.to_dict() == Document.from_dict(result).to_dict()
+    assert Document.from_columns(document.to_columns()).to_dict() == document.to_dict()
@@ -0,0 +1,97 @@
+import asyncio
+import time
+import pytest
+import formrec_utils as fr
+import mock_services
+from mock_services import MockServices
+
+class RateLimitedOnce(MockServices):
+    ''' rate limits the first request only '''
+    def chance(self, rate):
+        with self.lock:
+            return rate == self.rate_limit_rate and self.stats['rate_limited'] == 0
+
+@pytest.fixture
+def serve(monkeypatch):
+    servers = []
+    def serve(services):
+        server = mock_services.start(services)
+        servers.append(server)
+        monkeypatch.setattr(fr, "endpoint", server.url)
+        return server
+    monkeypatch.setattr(fr, "api_key", "mock")
+    monkeypatch.setattr(fr, "FORM_RECOGNIZER_CACHE_FILE", "")
+    monkeypatch.setattr(fr, "analysis_cache", None)
+    monkeypatch.setattr(fr, "POLL_INTERVAL", 0.01)
+    monkeypatch.setattr(fr, "POLL_MAX_INTERVAL", 0.05)
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def files(tmp_path):
+    paths = []
+    for number in range(5):
+        path = tmp_path / f"document {number}.pdf"
+        path.write_bytes(f"document {number}".encode("utf-8"))
+        paths.append(str(path))
+    return paths
+
+def analyze(files, max_in_flight=16):
+    async def collect():
+        return [item async for item in fr.analyze_documents_rest(files, 'prebuilt-document', max_in_flight=max_in_flight)]
+    return {filepath: (result, error) for filepath, result, error in asyncio.run(collect())}
+
+''' analyze the files one by one with the blocking client '''
+def analyze_sync(files):
+    results = {}
+    for filepath in files:
+        try:
+            results[filepath] = (fr.analyze_document_rest(filepath, 'prebuilt-document'), None)
+        except Exception as e:
+            results[filepath] = (None, e)
+    return results
+
+# the blocking and asyncio clients share the request and polling steps, they must handle the responses alike
+analyzers = pytest.mark.parametrize("analyze", [analyze, analyze_sync], ids=["async", "sync"])
+
+def test_polls_analyses_in_flight(serve, files):
+    services = MockServices(analysis_latency=0.3, jitter=0, poll_interval=0)
+    serve(services)
+    results = analyze(files, max_in_flight=len(files))
+    assert sorted(results) == sorted(files)
+    for result, error in results.values():
+        assert error is None
+        assert len(result['tables']) == mock_services.SYNTHETIC_RESULT['tables']
+    # the analyses ran at the same time and were polled until they finished
+    assert services.stats['max_running_analyses'] == len(files)
+    assert services.stats['polls'] > len(files)
+
+@analyzers
+def test_waits_retry_after_when_rate_limited(serve, files, analyze):
+    services = RateLimitedOnce(analysis_latency=0, jitter=0, rate_limit_rate=1.0, retry_after=1, poll_interval=0)
+    serve(services)
+    started = time.monotonic()
+    results = analyze(files[:1])
+    assert results[files[0]][1] is None
+    assert services.stats['rate_limited'] == 1
+    # Retry-After (1 sec) is longer than the client backoff
+    assert time.monotonic() - started >= 1.0
+
+@analyzers
+def test_reports_failed_analyses(serve, files, analyze):
+    serve(MockServices(analysis_latency=0, jitter=0, failure_rate=1.0, poll_interval=0))
+    results = analyze(files[:2])
+    for result, error in results.values():
+        assert result is None
+        assert isinstance(error, fr.AnalysisFailedError)
+
+@analyzers
+def test_reports_error_responses(serve, files, monkeypatch, analyze):
+    server = serve(MockServices(analysis_latency=0, jitter=0, poll_interval=0))
+    monkeypatch.setattr(fr, "endpoint", server.url + "missing/")
+    result, error = analyze(files[:1])[files[0]]
+    assert result is None
+    assert isinstance(error, fr.AnalysisRequestError)
+    assert error.status_code == 404
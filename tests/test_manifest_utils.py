@@ -0,0 +1,35 @@
+import manifest_utils
+import output_utils
+
+def get_fingerprints(pages_per_shard=None, sink=None):
+    sink = sink or output_utils.get_sink('csv', 'table')
+    return manifest_utils.get_fingerprints("input hash", "prebuilt-document", pages_per_shard, {'PARENT_INDENT_THRESHOLD': 0.045}, sink)
+
+def test_pages_per_shard_changes_every_stage():
+    fingerprints = get_fingerprints()
+    sharded = get_fingerprints(pages_per_shard=50)
+    assert all(fingerprints[stage] != sharded[stage] for stage in manifest_utils.STAGES)
+    assert sharded == get_fingerprints(pages_per_shard=50)
+
+def test_batch_output_path_changes_the_write_stage():
+    first = get_fingerprints(sink=output_utils.get_sink('csv', 'batch', 'first.csv'))
+    second = get_fingerprints(sink=output_utils.get_sink('csv', 'batch', 'second.csv'))
+    assert first['parse'] == second['parse']
+    assert first['write'] != second['write']
+
+def test_changing_pages_per_shard_analyzes_again(tmp_path):
+    file = tmp_path / "document.pdf"
+    file.write_bytes(b"document")
+    sink = output_utils.get_sink('csv', 'table')
+    manifest = manifest_utils.Manifest(str(file), "prebuilt-document", sink)
+    manifest.set_outputs([])
+    manifest.stages['analyze'] = {'fingerprint': manifest.fingerprints['analyze']}
+    manifest.save()
+    assert manifest_utils.Manifest(str(file), "prebuilt-document", sink).is_current('analyze')
+    sharded = manifest_utils.Manifest(str(file), "prebuilt-document", sink, pages_per_shard=50)
+    assert not sharded.is_current('analyze')
+    assert sharded.get_first_stage() == ('analyze', "model or pages per shard changed")
+
+def test_manifest_path_replaces_the_extension():
+    assert manifest_utils.get_manifest_path("data/scan.jpeg") == "data/scan.manifest.json"
+    assert manifest_utils.get_manifest_path("data/Sample 4.pdf") == "data/Sample 4.manifest.json"
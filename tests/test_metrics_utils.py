@@ -0,0 +1,65 @@
+import pytest
+import metrics_utils
+
+@pytest.fixture
+def metrics():
+    metrics_utils.reset()
+    metrics_utils.enable()
+    yield metrics_utils
+    metrics_utils.disable()
+    metrics_utils.reset()
+
+''' metrics recorded by a worker process for one file '''
+def get_worker_snapshot(seconds, tokens):
+    for value in seconds:
+        metrics_utils.observe("stage_seconds", value, stage="parse_table")
+    metrics_utils.increment("tokens", tokens, kind="prompt")
+    metrics_utils.increment("files")
+    return metrics_utils.collect()
+
+def test_merges_worker_snapshots(metrics):
+    first = get_worker_snapshot([0.003, 0.2], 100)
+    second = get_worker_snapshot([0.2, 400.0], 50)
+    # collect clears the worker metrics, so each snapshot is only sent once
+    assert metrics.snapshot() == {'counters': [], 'histograms': []}
+    metrics.increment("files")
+    metrics.merge(first)
+    metrics.merge(second)
+
+    report = metrics.get_report()
+    assert report['counters'] == {'files': {'': 3}, 'tokens': {'kind=prompt': 150}}
+    histogram = report['histograms']['stage_seconds']['stage=parse_table']
+    assert histogram['count'] == 4
+    assert histogram['sum'] == pytest.approx(400.403)
+    assert (histogram['min'], histogram['max']) == (0.003, 400.0)
+    assert (histogram['p50'], histogram['p99']) == (0.25, 400.0)
+
+def test_prometheus_text_of_merged_snapshots(metrics):
+    metrics.merge(get_worker_snapshot([0.003, 0.2], 100))
+    metrics.merge(get_worker_snapshot([0.2, 400.0], 50))
+    metrics.increment("cache_hits", cache='say "hi"\n')
+
+    lines = metrics.get_prometheus_text().splitlines()
+    assert lines[:7] == [
+        "# TYPE formrec_cache_hits_total counter",
+        'formrec_cache_hits_total{cache="say \\"hi\\"\\n"} 1',
+        "# TYPE formrec_files_total counter",
+        "formrec_files_total 2",
+        "# TYPE formrec_tokens_total counter",
+        'formrec_tokens_total{kind="prompt"} 150',
+        "# TYPE formrec_stage_seconds histogram"
+    ]
+    # cumulative buckets, then the values above the last bucket in +Inf
+    buckets = {line.split('le="')[1].split('"')[0]: int(line.split()[-1]) for line in lines if line.startswith("formrec_stage_seconds_bucket")}
+    assert len(buckets) == len(metrics_utils.LATENCY_BUCKETS) + 1
+    assert (buckets['0.001'], buckets['0.005'], buckets['0.1'], buckets['0.25'], buckets['300.0'], buckets['+Inf']) == (0, 1, 1, 3, 3, 4)
+    assert 'formrec_stage_seconds_bucket{stage="parse_table",le="0.25"} 3' in lines
+    assert lines[-2].startswith('formrec_stage_seconds_sum{stage="parse_table"} 400.40')
+    assert lines[-1] == 'formrec_stage_seconds_count{stage="parse_table"} 4'
+
+def test_merge_is_a_no_op_when_disabled(metrics):
+    values = get_worker_snapshot([0.1], 10)
+    metrics.disable()
+    metrics.merge(values)
+    metrics.increment("files")
+    assert metrics.snapshot() == {'counters': [], 'histograms': []}
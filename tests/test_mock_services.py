@@ -0,0 +1,82 @@
+import time
+import pytest
+import requests
+import mock_services
+from mock_services import MockServices, API_VERSION
+
+@pytest.fixture
+def serve():
+    servers = []
+    def serve(services):
+        server = mock_services.start(services)
+        servers.append(server)
+        return server
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def analyze(server, content=b"document"):
+    return requests.post(f"{server.url}formrecognizer/documentModels/prebuilt-layout:analyze", params={'api-version': API_VERSION}, data=content)
+
+def complete(server, prompt="Value: $1.00"):
+    return requests.post(f"{server.url}openai/deployments/davinci/completions", json={'prompt': prompt, 'max_tokens': 10})
+
+def get_stats(server):
+    return requests.get(f"{server.url}stats").json()
+
+def test_rate_limited_requests_send_retry_after(serve):
+    server = serve(MockServices(analysis_latency=0, completion_latency=0, rate_limit_rate=1.0, retry_after=7, seed=1))
+    for response in [analyze(server), complete(server)]:
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "7"
+        assert response.json()['error']['code'] == '429'
+    stats = get_stats(server)
+    assert (stats['analyze_requests'], stats['completions'], stats['rate_limited'], stats['running_analyses']) == (1, 1, 2, 0)
+
+def test_rate_limited_polls_send_retry_after(serve):
+    services = MockServices(analysis_latency=0, completion_latency=0, retry_after=3, seed=1)
+    server = serve(services)
+    location = analyze(server).headers["Operation-Location"]
+    services.rate_limit_rate = 1.0
+    response = requests.get(location)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "3"
+    services.rate_limit_rate = 0.0
+    assert requests.get(location).json()['status'] == 'succeeded'
+
+def test_analysis_runs_then_succeeds(serve):
+    server = serve(MockServices(analysis_latency=0.2, jitter=0, poll_interval=2, seed=1))
+    response = analyze(server)
+    assert response.status_code == 202
+    assert response.headers["Retry-After"] == "2"
+    running = requests.get(response.headers["Operation-Location"])
+    assert running.json()['status'] == 'running'
+    assert running.headers["Retry-After"] == "2"
+    time.sleep(0.25)
+    result = requests.get(response.headers["Operation-Location"]).json()
+    assert result['status'] == 'succeeded'
+    assert len(result['analyzeResult']['tables']) > 0
+
+def test_failed_operations(serve):
+    server = serve(MockServices(analysis_latency=0, completion_latency=0, failure_rate=1.0, seed=1))
+    response = analyze(server)
+    # the analysis is accepted, then its operation fails
+    assert response.status_code == 202
+    result = requests.get(response.headers["Operation-Location"]).json()
+    assert result['status'] == 'failed'
+    assert result['error']['code'] == 'InternalServerError'
+    assert 'analyzeResult' not in result
+    completion = complete(server)
+    assert completion.status_code == 500
+    assert completion.json()['error']['code'] == 'InternalServerError'
+    stats = get_stats(server)
+    assert (stats['failures'], stats['running_analyses'], stats['rate_limited']) == (2, 0, 0)
+
+def test_completions_answer_and_unknown_operations(serve):
+    server = serve(MockServices(completion_latency=0, seed=1))
+    response = complete(server)
+    assert response.status_code == 200
+    assert response.json()['choices'][0]['text'] == "valid"
+    missing = requests.get(f"{server.url}formrecognizer/documentModels/prebuilt-layout/analyzeResults/missing", params={'api-version': API_VERSION})
+    assert missing.status_code == 404
@@ -0,0 +1,153 @@
+import asyncio
+from types import SimpleNamespace
+import pytest
+import openai_utils
+from cache_utils import Cache
+from conftest import WordEncoder
+
+class RateLimitError(Exception):
+    def __init__(self, headers=None) -> None:
+        super().__init__("rate limited")
+        self.headers = headers or {}
+
+class FakeService:
+    ''' completions of prompts ending with a value: "limited" values are rate limited once, "broken" values fail '''
+    error = SimpleNamespace(RateLimitError=RateLimitError)
+
+    def __init__(self) -> None:
+        self.calls = {}
+        self.running = 0
+        self.max_running = 0
+        self.Completion = SimpleNamespace(create=self.create, acreate=self.acreate)
+
+    def answer(self, prompt):
+        value = prompt.split()[-1]
+        self.calls[value] = self.calls.get(value, 0) + 1
+        if value.startswith("broken"):
+            raise ValueError("server error")
+        if value.startswith("limited") and self.calls[value] == 1:
+            raise RateLimitError({'Retry-After': '0'})
+        return SimpleNamespace(choices=[SimpleNamespace(text=f"answer {value}")])
+
+    def create(self, engine, prompt, **parameters):
+        return self.answer(prompt)
+
+    async def acreate(self, engine, prompt, **parameters):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        # the first prompts take longer, so they finish last
+        await asyncio.sleep(0.01 / (1 + len(self.calls)))
+        self.running -= 1
+        return self.answer(prompt)
+
+@pytest.fixture
+def service(monkeypatch):
+    service = FakeService()
+    monkeypatch.setattr(openai_utils, "get_openai", lambda: service)
+    monkeypatch.setattr(openai_utils, "get_encoder", lambda model: WordEncoder())
+    monkeypatch.setattr(openai_utils, "get_retry_delay", lambda attempt, error=None: 0.0)
+    monkeypatch.setattr(openai_utils, "completion_cache", None)
+    monkeypatch.setattr(openai_utils, "AZURE_OPENAI_CACHE_FILE", "")
+    monkeypatch.setattr(openai_utils, "rate_limiters", {})
+    return service
+
+def test_completion_cache_key_includes_truncation_mode(tmp_path, monkeypatch):
+    monkeypatch.setattr(openai_utils, "completion_cache", Cache(str(tmp_path / "completions.sqlite"), 1024 * 1024))
+    variables = {'column_name': 'Fee', 'value': '$1.00'}
+    openai_utils.set_cached_completion("prompt {value}", variables, "head answer", truncate="head")
+    assert openai_utils.get_cached_completion("prompt {value}", variables, truncate="head") == "head answer"
+    assert openai_utils.get_cached_completion("prompt {value}", variables, truncate="middle") is None
+
+def test_token_bucket_waits_for_refill():
+    bucket = openai_utils.TokenBucket(60) # one token per second
+    assert bucket.take(60) == 0
+    assert bucket.take(1) == pytest.approx(1.0, abs=0.01)
+    bucket.updated -= 30
+    assert bucket.take(30) == 0
+    assert bucket.take(1) > 0
+    # requests larger than the bucket take the whole bucket
+    assert openai_utils.TokenBucket(60).take(100) == 0
+
+def test_retry_delay_backs_off_and_honors_retry_after(monkeypatch):
+    monkeypatch.setattr(openai_utils.random, "uniform", lambda low, high: high)
+    assert openai_utils.get_retry_delay(0) == openai_utils.RETRY_BASE_DELAY
+    assert openai_utils.get_retry_delay(3) == openai_utils.RETRY_BASE_DELAY * 8
+    assert openai_utils.get_retry_delay(20) == openai_utils.RETRY_MAX_DELAY
+    assert openai_utils.get_retry_delay(0, RateLimitError({'Retry-After': '5'})) == 5.0
+    assert openai_utils.get_retry_delay(0, RateLimitError({'retry-after-ms': '2500'})) == 2.5
+    # http dates are ignored, the backoff is used
+    assert openai_utils.get_retry_delay(0, RateLimitError({'Retry-After': 'Wed, 21 Oct 2026 07:28:00 GMT'})) == openai_utils.RETRY_BASE_DELAY
+    monkeypatch.setattr(openai_utils.random, "uniform", lambda low, high: low)
+    assert openai_utils.get_retry_delay(0, RateLimitError({'Retry-After': '5'})) == 5.0
+
+def test_complete_many_keeps_the_order(service):
+    values = [f"value{number}" for number in range(6)]
+    answers = asyncio.run(openai_utils.complete_many("Complete {value}", [{'value': value} for value in values], concurrency=2))
+    assert answers == [f"answer {value}" for value in values]
+    assert service.max_running == 2
+
+def test_complete_many_retries_rate_limits_and_reports_errors(service):
+    answers = asyncio.run(openai_utils.complete_many("Complete {value}", [{'value': value} for value in ["ok", "limited", "broken"]]))
+    assert answers == ["answer ok", "answer limited", "error"]
+    assert service.calls == {'ok': 1, 'limited': 2, 'broken': 1}
+
+def test_complete_and_acomplete_handle_errors_alike(service, monkeypatch):
+    monkeypatch.setattr(openai_utils, "MAX_RETRIES", 0)
+    for value, answer in [("ok", "answer ok"), ("limited", ""), ("broken", "error")]:
+        assert openai_utils.complete("Complete {value}", {'value': value}) == answer
+        service.calls.clear()
+        assert asyncio.run(openai_utils.acomplete("Complete {value}", {'value': value})) == answer
+
+def test_complete_all_in_a_running_loop_warns(service, caplog):
+    async def run():
+        return openai_utils.complete_all("Complete {value}", [{'value': "ok"}, {'value': "other"}])
+    with caplog.at_level("WARNING", logger="formrec-utils"):
+        assert asyncio.run(run()) == ["answer ok", "answer other"]
+    assert "running event loop" in caplog.text
+
+LINES = [f"row {number}: Wire Transfer, $1.{number}" for number in range(20)]
+
+def count(text):
+    return len(WordEncoder().encode(text))
+
+''' smallest block of lines to remove (from the head or centered in the middle) so the prompt fits max_length, by brute force '''
+def get_expected_prompt(lines, max_length, truncate):
+    for size in range(len(lines) + 1):
+        start = max(0, min(len(lines) - size, len(lines) // 2 - size // 2)) if truncate == "middle" else 0
+        prompt = "\n".join(lines[:start] + lines[start+size:])
+        if count(prompt) <= max_length:
+            return prompt
+
+def test_truncate_prompt_at_the_limit_keeps_the_prompt():
+    prompt = "\n".join(LINES)
+    for truncate in ["head", "middle"]:
+        assert openai_utils.truncate_prompt(prompt, WordEncoder(), count(prompt), truncate) == (prompt, count(prompt))
+
+def test_truncate_prompt_one_token_over_removes_one_line():
+    prompt = "\n".join(LINES)
+    truncated, num_tokens = openai_utils.truncate_prompt(prompt, WordEncoder(), count(prompt) - 1, "head")
+    assert truncated == "\n".join(LINES[1:])
+    assert num_tokens == count(truncated)
+    truncated, num_tokens = openai_utils.truncate_prompt(prompt, WordEncoder(), count(prompt) - 1, "middle")
+    assert truncated == "\n".join(LINES[:10] + LINES[11:])
+
+def test_truncate_prompt_removes_the_smallest_block():
+    prompt = "\n".join(LINES)
+    for max_length in [count(prompt) - 25, count(prompt) // 2, 12, 0]:
+        for truncate in ["head", "middle"]:
+            truncated, num_tokens = openai_utils.truncate_prompt(prompt, WordEncoder(), max_length, truncate)
+            assert truncated == get_expected_prompt(LINES, max_length, truncate)
+            assert num_tokens == count(truncated) and num_tokens <= max_length
+
+def test_truncate_prompt_middle_keeps_the_head_and_tail():
+    prompt = "\n".join(LINES)
+    truncated, _ = openai_utils.truncate_prompt(prompt, WordEncoder(), count(prompt) // 2, "middle")
+    lines = truncated.split("\n")
+    assert lines[0] == LINES[0] and lines[-1] == LINES[-1]
+    assert len(lines) < len(LINES)
+
+def test_prepare_prompt_fits_the_model_limit(service, monkeypatch):
+    monkeypatch.setitem(openai_utils.prompt_limit, "text-davinci-003", 100)
+    prompt, num_tokens = openai_utils.prepare_prompt("Rows:\n{rows}\nAnswer:", {'rows': "\n".join(LINES)}, "davinci", max_tokens=40, truncate="middle")
+    assert num_tokens <= 60 and num_tokens == count(prompt)
+    assert prompt.startswith("Rows:\n") and prompt.endswith("\nAnswer:")
@@ -0,0 +1,91 @@
+import json
+import os
+import pandas as pd
+import pytest
+import output_utils
+from output_utils import Sink, LONG_COLUMNS
+
+TABLES = [
+    pd.DataFrame({'Service': ['Wire Transfer', 'ACH'], 'Fee': ['$1.00', None]}),
+    pd.DataFrame({'Item': ['Lockbox'], 'Volume': ['5'], 'Fee': ['$2.00']})
+]
+
+def write_tables(sink, files):
+    for file in files:
+        for table_index, df in enumerate(TABLES, start=1):
+            sink.write(file, table_index, df)
+        sink.end_document(file)
+    sink.close()
+
+def test_sink_is_abstract():
+    with pytest.raises(TypeError):
+        Sink()
+    class TableSink(Sink):
+        extension = 'txt'
+        def write_table(self, path, df):
+            pass
+    # a sink must also write consolidated files
+    with pytest.raises(TypeError):
+        TableSink()
+
+def test_sink_subclass_writes_each_scope():
+    class RecordingSink(Sink):
+        extension = 'txt'
+        def __init__(self, scope='table', output=None) -> None:
+            super().__init__(scope, output)
+            self.calls = []
+        def write_table(self, path, df):
+            self.calls.append(('write_table', path, len(df)))
+        def open(self, path):
+            self.calls.append(('open', path))
+            return self
+        def append(self, writer, file, table_index, df):
+            self.calls.append(('append', writer.scope, file, table_index))
+        def close_writer(self, writer):
+            self.calls.append(('close',))
+    sink = RecordingSink('table')
+    write_tables(sink, ["data/a.pdf"])
+    assert sink.calls == [('write_table', "data/a 001.txt", 2), ('write_table', "data/a 002.txt", 1)]
+    sink = RecordingSink('document')
+    write_tables(sink, ["data/a.pdf", "data/b.pdf"])
+    assert sink.calls == [('open', "data/a.txt"), ('append', 'document', "data/a.pdf", 1), ('append', 'document', "data/a.pdf", 2), ('close',),
+                          ('open', "data/b.txt"), ('append', 'document', "data/b.pdf", 1), ('append', 'document', "data/b.pdf", 2), ('close',)]
+    sink = RecordingSink('batch', "all.txt")
+    write_tables(sink, ["data/a.pdf", "data/b.pdf"])
+    assert [call[0] for call in sink.calls] == ['open'] + ['append'] * 4 + ['close']
+    assert sink.get_outputs("data/a.pdf", 2) == ["all.txt"]
+
+@pytest.mark.parametrize("format", list(output_utils.SINKS))
+def test_sinks_write_tables(tmp_path, format):
+    files = [str(tmp_path / "a.pdf"), str(tmp_path / "b.pdf")]
+    sink = output_utils.get_sink(format, 'table')
+    write_tables(sink, files)
+    outputs = [output for file in files for output in sink.get_outputs(file, len(TABLES))]
+    assert [os.path.basename(output) for output in outputs] == [f"a 001.{format}", f"a 002.{format}", f"b 001.{format}", f"b 002.{format}"]
+    if format == 'csv':
+        assert pd.read_csv(outputs[0], keep_default_na=False).to_dict(orient='list') == {'Service': ['Wire Transfer', 'ACH'], 'Fee': ['$1.00', '']}
+    if format == 'jsonl':
+        with open(outputs[0], encoding="utf-8") as f:
+            assert [json.loads(line) for line in f] == [{'Service': 'Wire Transfer', 'Fee': '$1.00'}, {'Service': 'ACH', 'Fee': None}]
+    if format == 'parquet':
+        assert pd.read_parquet(outputs[1]).to_dict(orient='list') == {'Item': ['Lockbox'], 'Volume': ['5'], 'Fee': ['$2.00']}
+
+@pytest.mark.parametrize("format", ['csv', 'parquet'])
+def test_consolidated_files_use_the_long_format(tmp_path, format):
+    files = [str(tmp_path / "a.pdf"), str(tmp_path / "b.pdf")]
+    output = str(tmp_path / f"tables.{format}")
+    write_tables(output_utils.get_sink(format, 'batch', output), files)
+    df = pd.read_csv(output, keep_default_na=False) if format == 'csv' else pd.read_parquet(output)
+    assert list(df.columns) == LONG_COLUMNS
+    # one row per cell of each table of each file
+    assert len(df) == 2 * (4 + 3)
+    assert df.iloc[3].tolist()[1:5] == [1, 1, 1, 'Fee']
+    # missing values are empty csv fields and parquet nulls
+    assert (df.iloc[3]['value'] == '') if format == 'csv' else pd.isna(df.iloc[3]['value'])
+    assert df.iloc[-1].tolist() == [files[1], 2, 0, 2, 'Fee', '$2.00']
+
+def test_invalid_sink_options():
+    with pytest.raises(ValueError):
+        output_utils.get_sink('xlsx')
+    with pytest.raises(ValueError):
+        output_utils.get_sink('csv', 'page')
@@ -0,0 +1,107 @@
+import time
+import formrec_utils as fr
+import mock_services
+import output_utils
+import parse_tables
+from mock_services import MockServices
+from parse_tables import get_dataframes_and_metrics
+
+ANALYSIS_SECONDS = {'slow.pdf': 2.0, 'fast.pdf': 0.0}
+
+class RecordingSink:
+    extension = 'csv'
+    scope = 'table'
+
+    def __init__(self) -> None:
+        self.written = {}
+
+    def write(self, file, table_index, df):
+        self.written[file] = time.monotonic()
+
+    def end_document(self, file):
+        pass
+
+    def close(self):
+        pass
+
+class DelayedParser(parse_tables.Parser):
+    def __init__(self, sink) -> None:
+        super().__init__(sink=sink)
+        self.analyzed = {}
+
+    def prepare(self, file):
+        time.sleep(ANALYSIS_SECONDS[file])
+        self.analyzed[file] = time.monotonic()
+        return None, None, file
+
+''' parsing task of the worker processes (one table per file) '''
+def get_tables(result):
+    if result == 'broken.pdf':
+        raise ValueError("cannot parse")
+    return [[result]], None
+
+def test_batch_writes_each_file_as_soon_as_it_is_parsed(monkeypatch):
+    monkeypatch.setattr(parse_tables, "get_dataframes_and_metrics", get_tables)
+    sink = RecordingSink()
+    parser = DelayedParser(sink)
+    failures = parser.parse_batch(['slow.pdf', 'fast.pdf'], concurrency=2, workers=1)
+    assert failures == {}
+    # the fast file is written while the slow file is still being analyzed
+    assert sink.written['fast.pdf'] < parser.analyzed['slow.pdf']
+    assert sink.written['slow.pdf'] > parser.analyzed['slow.pdf']
+
+def test_batch_reports_parse_failures_without_aborting(monkeypatch):
+    monkeypatch.setattr(parse_tables, "get_dataframes_and_metrics", get_tables)
+    monkeypatch.setitem(ANALYSIS_SECONDS, 'broken.pdf', 0.0)
+    parser = DelayedParser(RecordingSink())
+    failures = parser.parse_batch(['slow.pdf', 'broken.pdf'], concurrency=2, workers=1)
+    assert list(failures) == ['broken.pdf']
+    assert 'slow.pdf' in parser.analyzed
+
+''' parsing task of the spawned worker processes, with an offline tokenizer '''
+def get_dataframes_offline(result):
+    import openai_utils
+    from conftest import WordEncoder
+    openai_utils.get_encoder = lambda model: WordEncoder()
+    return get_dataframes_and_metrics(result)
+
+def test_batch_parses_fresh_and_cached_files_in_worker_processes(tmp_path, monkeypatch):
+    services = MockServices(analysis_latency=0.2, completion_latency=0, jitter=0, poll_interval=0)
+    server = mock_services.start(services)
+    try:
+        # the analyses run in the test process, the completions in the spawned workers (configured by their environment)
+        monkeypatch.setattr(fr, "endpoint", server.url)
+        monkeypatch.setattr(fr, "api_key", "mock")
+        monkeypatch.setattr(fr, "FORM_RECOGNIZER_CACHE_FILE", str(tmp_path / "analysis.sqlite"))
+        monkeypatch.setattr(fr, "analysis_cache", None)
+        for key, value in mock_services.get_environment(server.url).items():
+            if key.startswith("AZURE_OPENAI"):
+                monkeypatch.setenv(key, value)
+        monkeypatch.setenv("AZURE_OPENAI_CACHE_FILE", str(tmp_path / "completions.sqlite"))
+        monkeypatch.setattr(parse_tables, "get_dataframes_and_metrics", get_dataframes_offline)
+        files = []
+        for number in range(3):
+            path = tmp_path / f"document {number}.pdf"
+            path.write_bytes(f"document {number}".encode("utf-8"))
+            files.append(str(path))
+        tables = mock_services.SYNTHETIC_RESULT['tables']
+
+        failures = parse_tables.Parser(sink=output_utils.get_sink()).parse_batch(files, concurrency=3, workers=2)
+        assert failures == {}
+        outputs = {path.name: path.read_text(encoding="utf-8") for path in tmp_path.glob("*.csv")}
+        assert len(outputs) == len(files) * tables
+        analyses, completions = services.stats['analyze_requests'], services.stats['completions']
+        assert analyses == len(files)
+        assert completions > 0
+
+        # cached analyses and completions, the same tables
+        for path in tmp_path.glob("*.csv"):
+            path.unlink()
+        failures = parse_tables.Parser(sink=output_utils.get_sink()).parse_batch(files, concurrency=3, workers=2)
+        assert failures == {}
+        assert {path.name: path.read_text(encoding="utf-8") for path in tmp_path.glob("*.csv")} == outputs
+        assert services.stats['analyze_requests'] == analyses
+        assert services.stats['completions'] == completions
+    finally:
+        server.shutdown()
+        server.server_close()
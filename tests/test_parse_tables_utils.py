@@ -0,0 +1,480 @@
+import random
+import types
+import pandas as pd
+import parse_tables_utils
+from document_utils import Document
+from synthetic_utils import generate_result, INDENT_WIDTH
+from conftest import WordEncoder
+
+LINE_HEIGHT = 0.2
+
+def get_polygon(x0, y0, x1, y1):
+    return [x0, y0, x1, y0, x1, y1, x0, y1]
+
+''' a single page table (header row and item rows) with its lines, columns are (left, right) x ranges '''
+def make_table(page, offset, y, columns, items, header='Service'):
+    lines = []
+    cells = []
+    rows = [[header] + [f"Column {column}" for column in range(1, len(columns))]] + [[item] + [f"${row}.{column}" for column in range(1, len(columns))] for row, item in enumerate(items)]
+    for rowIndex, row in enumerate(rows):
+        row_y = y + rowIndex * LINE_HEIGHT
+        for columnIndex, (content, (left, right)) in enumerate(zip(row, columns)):
+            span = {'offset': offset, 'length': len(content)}
+            offset += len(content) + 1
+            lines.append({'content': content, 'spans': [span], 'polygon': get_polygon(left, row_y, right, row_y + LINE_HEIGHT)})
+            cells.append({'rowIndex': rowIndex, 'columnIndex': columnIndex, 'rowSpan': 1, 'columnSpan': 1, 'content': content, 'spans': [span],
+                          'kind': 'columnHeader' if rowIndex == 0 else 'content',
+                          'boundingRegions': [{'pageNumber': page, 'polygon': get_polygon(left, row_y, right, row_y + LINE_HEIGHT)}]})
+    bottom = y + len(rows) * LINE_HEIGHT
+    table = {'rowCount': len(rows), 'columnCount': len(columns), 'cells': cells, 'spans': [{'offset': lines[0]['spans'][0]['offset'], 'length': offset - lines[0]['spans'][0]['offset']}],
+             'boundingRegions': [{'pageNumber': page, 'polygon': get_polygon(columns[0][0], y, columns[-1][1], bottom)}]}
+    return table, lines, offset
+
+''' two pages with a table each, text_lines of text above the second table '''
+def make_result(first_columns, second_columns, text_lines=0):
+    first, first_lines, offset = make_table(1, 0, 8.0, first_columns, ['Wire Transfer', 'ACH Debit'])
+    text = []
+    for line in range(text_lines):
+        content = f"Text line {line}"
+        text.append({'content': content, 'spans': [{'offset': offset, 'length': len(content)}], 'polygon': get_polygon(0.5, 0.5 + line * LINE_HEIGHT, 8.0, 0.7 + line * LINE_HEIGHT)})
+        offset += len(content) + 1
+    second, second_lines, offset = make_table(2, offset, 0.5 + text_lines * LINE_HEIGHT, second_columns, ['Lockbox', 'Positive Pay'])
+    pages = [{'pageNumber': 1, 'lines': first_lines}, {'pageNumber': 2, 'lines': text + second_lines}]
+    return {'pages': pages, 'tables': [first, second]}
+
+COLUMNS = [(0.5, 3.5), (3.5, 5.0), (5.0, 6.5)]
+SHIFTED_COLUMNS = [(left + 0.5, right + 0.5) for left, right in COLUMNS] # center of each column still inside the other table column
+
+def test_merges_table_continued_on_next_page():
+    result = make_result(COLUMNS, COLUMNS)
+    tables = parse_tables_utils.load_tables(result['tables'], result['pages'])
+    assert len(tables) == 1
+    assert tables[0]['rowCount'] == 5 # the repeated header row is skipped
+    assert [cell['content'] for cell in tables[0]['cells'] if cell['columnIndex'] == 0] == ['Service', 'Wire Transfer', 'ACH Debit', 'Lockbox', 'Positive Pay']
+
+def test_merges_table_continued_on_next_page_of_compact_document():
+    result = make_result(COLUMNS, COLUMNS)
+    document = Document.from_dict(result)
+    assert len(parse_tables_utils.load_tables(document['tables'], document['pages'])) == 1
+
+def test_does_not_merge_shifted_tables_on_consecutive_pages():
+    result = make_result(COLUMNS, SHIFTED_COLUMNS)
+    assert len(parse_tables_utils.load_tables(result['tables'], result['pages'])) == 2
+
+def test_does_not_merge_tables_with_text_between_them():
+    result = make_result(COLUMNS, COLUMNS, text_lines=10)
+    assert len(parse_tables_utils.load_tables(result['tables'], result['pages'])) == 2
+
+def test_does_not_merge_across_pages_without_pages():
+    result = make_result(COLUMNS, COLUMNS)
+    assert len(parse_tables_utils.load_tables(result['tables'])) == 2
+
+def test_align_columns_compares_edges():
+    assert parse_tables_utils.align_columns(dict(enumerate(COLUMNS)), dict(enumerate(COLUMNS))) == {0: 0, 1: 1, 2: 2}
+    assert parse_tables_utils.align_columns(dict(enumerate(SHIFTED_COLUMNS)), dict(enumerate(COLUMNS))) is None
+    # a narrower table missing a column keeps the other columns mapping
+    assert parse_tables_utils.align_columns({0: COLUMNS[0], 1: COLUMNS[2]}, dict(enumerate(COLUMNS))) == {0: 0, 1: 2}
+
+def test_batch_validation_caches_the_judged_values(monkeypatch):
+    import openai_utils
+    cache = {}
+    prompts = []
+    def complete_all(prompt, variables_list, **kwargs):
+        prompts.extend(variables_list)
+        return ["\n".join(f"{number+1}: invalid" for number in range(variables['items'].count("\n") + 1)) for variables in variables_list]
+    monkeypatch.setattr(openai_utils, "complete_all", complete_all)
+    monkeypatch.setattr(openai_utils, "count_tokens", lambda text, deployment="davinci": len(text) // 4 + 1)
+    monkeypatch.setattr(openai_utils, "get_cached_completion", lambda prompt, variables, **kwargs: cache.get((variables['column_name'], variables['value'])))
+    monkeypatch.setattr(openai_utils, "set_cached_completion", lambda prompt, variables, result, **kwargs: cache.update({(variables['column_name'], variables['value']): result}))
+    long_value = "x" * 500
+    attributes = [('Fee', long_value), ('Fee', '$1.00')]
+    assert parse_tables_utils.validate_attributes(attributes) == {attribute: 'invalid' for attribute in attributes}
+    # the verdicts are cached under the values sent in the prompt
+    truncated = parse_tables_utils.truncate(long_value, parse_tables_utils.VALIDATION_MAX_CHARS)
+    assert truncated in prompts[0]['items']
+    assert set(cache) == {('Fee', truncated), ('Fee', '$1.00')}
+    # and found again without completions
+    prompts.clear()
+    assert parse_tables_utils.validate_attributes(attributes) == {attribute: 'invalid' for attribute in attributes}
+    assert prompts == []
+
+''' parent of a column 0 cell as found by the original parser: the content cell of the closest row above indented more than the threshold (linear scans of the lines and cells) '''
+def get_parent_reference(pages, table, cell, threshold):
+    def get_x(content, span_offset):
+        x = 0
+        for page in pages:
+            for line in page['lines']:
+                if line['content'] in content and line['spans'][0]['offset'] == span_offset:
+                    x = line['polygon'][0]
+                    break
+        return x
+    child_x = get_x(cell['content'], cell['spans'][0]['offset'])
+    parent = None
+    for candidate in table['cells']:
+        if candidate['columnIndex'] == 0 and candidate.get('kind', 'content') == 'content' and len(candidate['spans']) > 0:
+            if child_x - get_x(candidate['content'], candidate['spans'][0]['offset']) > threshold:
+                if cell['rowIndex'] > candidate['rowIndex'] and (parent is None or parent['rowIndex'] < candidate['rowIndex']):
+                    parent = candidate
+    if parent is None:
+        return None
+    return parse_tables_utils.get_node_id(parent['content'], parent['rowIndex'], parent['spans'][0]['offset'], parent['spans'][0]['length'])
+
+''' the original tree insertion: search the parent in the whole tree '''
+def add_child_reference(items, parent_id, node):
+    for item in items:
+        if parse_tables_utils.get_node_id(item['content'], item['rowIndex'], item['span_offset'], item['span_length']) == parent_id:
+            item['children'].append(node)
+            break
+        else:
+            add_child_reference(item['children'], parent_id, node)
+
+def get_parents_reference(pages, table, threshold):
+    return {parse_tables_utils.get_node_id(cell['content'], cell['rowIndex'], cell['spans'][0]['offset'], cell['spans'][0]['length']): get_parent_reference(pages, table, cell, threshold)
+            for cell in table['cells'] if cell['columnIndex'] == 0 and len(cell['spans']) > 0}
+
+def build_tree_reference(table_nodes, valid_nodes, parents):
+    nodes = []
+    for node, valid_node in zip(table_nodes, valid_nodes):
+        if not valid_node:
+            continue
+        parent_id = parents[parse_tables_utils.get_node_id(node['content'], node['rowIndex'], node['span_offset'], node['span_length'])]
+        if parent_id is None:
+            nodes.append(node)
+        else:
+            add_child_reference(nodes, parent_id, node)
+    return nodes
+
+''' the synthetic tables, with their items indented INDENT_WIDTH per level '''
+def get_synthetic_tables(seed):
+    result = generate_result(pages=3, lines=5, tables=3, rows=25, columns=3, depth=4, styles=0, seed=seed)
+    tables = [parse_tables_utils.rename_duplicate_headers(table) for table in parse_tables_utils.load_tables(result['tables'], result['pages'])]
+    return result, tables
+
+# 0.0, the default, a gap equal to the synthetic indents (ties are not parents) and a threshold larger than any indent
+THRESHOLDS = [0.0, parse_tables_utils.PARENT_INDENT_THRESHOLD, INDENT_WIDTH, 2.0]
+
+def test_parents_match_the_original_parent_search():
+    for seed in range(3):
+        result, tables = get_synthetic_tables(seed)
+        line_index = parse_tables_utils.get_line_index(result['pages'])
+        for table in tables:
+            indents = parse_tables_utils.get_indents(line_index, table)
+            for threshold in THRESHOLDS:
+                assert parse_tables_utils.get_parents(indents, threshold) == get_parents_reference(result['pages'], table, threshold)
+
+def test_trees_match_the_original_tree_insertion():
+    result, tables = get_synthetic_tables(seed=0)
+    line_index = parse_tables_utils.get_line_index(result['pages'])
+    for table in tables:
+        table_nodes, _ = parse_tables_utils.get_table_nodes(table, None, validate=False)
+        # the children of invalid nodes are dropped
+        valid_nodes = [idx % 5 != 3 for idx in range(len(table_nodes))]
+        parents = parse_tables_utils.get_parents(parse_tables_utils.get_indents(line_index, table))
+        tree = parse_tables_utils.build_tree([dict(node, children=[]) for node in table_nodes], valid_nodes, parents)
+        reference = build_tree_reference([dict(node, children=[]) for node in table_nodes], valid_nodes, get_parents_reference(result['pages'], table, parse_tables_utils.PARENT_INDENT_THRESHOLD))
+        assert tree == reference
+        assert parse_tables_utils.get_height(tree) > 1
+
+def test_parents_for_thresholds_match_get_parents():
+    for seed in range(3):
+        result, tables = get_synthetic_tables(seed)
+        line_index = parse_tables_utils.get_line_index(result['pages'])
+        for table in tables:
+            indents = parse_tables_utils.get_indents(line_index, table)
+            candidates = parse_tables_utils.get_parent_candidates(indents)
+            parents = parse_tables_utils.get_parents_for_thresholds(candidates, THRESHOLDS)
+            assert parents == [parse_tables_utils.get_parents(indents, threshold) for threshold in THRESHOLDS]
+
+def test_parents_for_thresholds_without_candidates():
+    candidates = parse_tables_utils.get_parent_candidates([])
+    assert parse_tables_utils.get_parents_for_thresholds(candidates, THRESHOLDS) == [{} for _ in THRESHOLDS]
+    indents = [{'node_id': ('Wire Transfer', 1, 0, 13), 'rowIndex': 1, 'kind': 'content', 'x': 0.5}]
+    candidates = parse_tables_utils.get_parent_candidates(indents)
+    assert parse_tables_utils.get_parents_for_thresholds(candidates, THRESHOLDS) == [{('Wire Transfer', 1, 0, 13): None} for _ in THRESHOLDS]
+
+def test_get_x_finds_lines_by_offset_and_by_content():
+    pages = [{'pageNumber': 1, 'lines': [
+        {'content': 'Wire Transfer', 'spans': [{'offset': 0, 'length': 13}], 'polygon': get_polygon(0.5, 1.0, 3.0, 1.2)},
+        {'content': 'ACH Debit', 'spans': [{'offset': 14, 'length': 9}], 'polygon': get_polygon(0.75, 1.2, 3.0, 1.4)},
+        {'content': 'Lockbox', 'spans': [{'offset': 24, 'length': 7}], 'polygon': get_polygon(1.0, 1.4, 3.0, 1.6)}]}]
+    line_index = parse_tables_utils.get_line_index(pages)
+    assert parse_tables_utils.get_x(line_index, 'ACH Debit', 14, 9) == 0.75
+    # shifted cell spans find the closest line with their content
+    assert parse_tables_utils.get_x(line_index, 'ACH Debit', 12, 9) == 0.75
+    assert parse_tables_utils.get_x(line_index, 'Lockbox', 26, 7) == 1.0
+    # lines at other offsets are confirmed by their content
+    assert parse_tables_utils.get_x(line_index, 'Lockbox', 20, 7) == 1.0
+    # the compact document has the same index
+    assert parse_tables_utils.get_line_index(Document.from_dict({'pages': pages, 'tables': []})['pages']) == line_index
+
+def test_get_x_without_line_warns(caplog):
+    line_index = parse_tables_utils.get_line_index([{'pageNumber': 1, 'lines': []}])
+    with caplog.at_level("WARNING", logger="formrec-utils"):
+        assert parse_tables_utils.get_x(line_index, 'Positive Pay', 40, 12) == 0
+    assert "No line found" in caplog.text
+
+''' linear scan of every style span: the styles with a span overlapping any cell span (empty spans cover their offset), once each, in document order '''
+def get_node_styles_reference(cell, document_styles):
+    numbers = set()
+    for cell_span in cell['spans']:
+        cell_start, cell_end = cell_span['offset'], cell_span['offset'] + max(cell_span['length'], 1)
+        for number, style in enumerate(document_styles):
+            for style_span in style.get('spans', []):
+                if style_span['offset'] < cell_end and cell_start < style_span['offset'] + max(style_span['length'], 1):
+                    numbers.add(number)
+    return [{key: value for key, value in document_styles[number].items() if key != 'spans'} for number in sorted(numbers)]
+
+def test_style_index_matches_linear_scan():
+    generator = random.Random(0)
+    styles = []
+    for number in range(30):
+        # unsorted, overlapping, adjacent and empty spans
+        spans = [{'offset': generator.randrange(0, 200), 'length': generator.choice([0, 1, 3, 10, 40])} for _ in range(generator.randrange(0, 5))]
+        if len(spans) > 0 and generator.random() < 0.3:
+            spans.append({'offset': spans[0]['offset'] + max(spans[0]['length'], 1), 'length': 5})
+        styles.append({'fontWeight': 'bold' if number % 2 == 0 else 'normal', 'confidence': number / 30, 'spans': spans})
+    styles.append({'fontStyle': 'italic', 'confidence': 1.0}) # without spans
+    style_index = parse_tables_utils.get_style_index(styles)
+    for _ in range(500):
+        cell = {'spans': [{'offset': generator.randrange(0, 220), 'length': generator.choice([0, 1, 5, 20])} for _ in range(generator.randrange(1, 3))]}
+        assert parse_tables_utils.get_node_styles(cell, style_index) == get_node_styles_reference(cell, styles)
+
+def test_style_index_boundaries():
+    styles = [
+        {'fontWeight': 'bold', 'spans': [{'offset': 20, 'length': 5}, {'offset': 0, 'length': 10}]},
+        {'color': '#ff0000', 'spans': [{'offset': 5, 'length': 20}]},
+        {'fontStyle': 'italic', 'spans': [{'offset': 10, 'length': 5}]}
+    ]
+    style_index = parse_tables_utils.get_style_index(styles)
+    def get_styles(offset, length):
+        return [list(style)[0] for style in parse_tables_utils.get_node_styles({'spans': [{'offset': offset, 'length': length}]}, style_index)]
+    assert get_styles(0, 5) == ['fontWeight']
+    # the style ending at 10 is adjacent, not overlapping
+    assert get_styles(10, 2) == ['color', 'fontStyle']
+    # overlapping without the same start offset
+    assert get_styles(12, 10) == ['fontWeight', 'color', 'fontStyle']
+    assert get_styles(25, 3) == []
+
+def count_words(text, deployment="davinci"):
+    return len(WordEncoder().encode(text))
+
+def test_parse_column_names_answer():
+    columns = ['Column 1', 'Column 2', 'Column 3']
+    answer = "\n".join([
+        "New column names:",
+        "  Column 1 :  \"Volume\" ",
+        "Column 2:",
+        "Column 4: Unknown",
+        "Fee for Column 3",
+        "Column 3: Unit Price: USD"
+    ])
+    # lines without a listed column or without a name are ignored, names can have colons
+    assert parse_tables_utils.parse_column_names_answer(answer, columns) == {'Column 1': 'Volume', 'Column 3': 'Unit Price: USD'}
+    assert parse_tables_utils.parse_column_names_answer("", columns) == {}
+    assert parse_tables_utils.parse_column_names_answer("Volume\nUnit Price", columns) == {}
+
+def test_sample_markdown_table(monkeypatch):
+    monkeypatch.setattr(parse_tables_utils.openai_utils, "count_tokens", count_words)
+    df = pd.DataFrame({'Service': [f"Item {row}" for row in range(50)], 'Fee': [f"{row}.00" if row % 7 else None for row in range(50)]})
+    header = "|Service|Fee|\n|---|---|\n"
+    assert parse_tables_utils.sample_markdown_table(df, 1000) == header + "".join(f"|Item {row}|{f'{row}.00' if row % 7 else ''}|\n" for row in range(50))
+    assert parse_tables_utils.sample_markdown_table(df, count_words(header)) == header
+    assert parse_tables_utils.sample_markdown_table(df.iloc[0:0], 1000) == header
+    # the sampled rows are evenly spaced, keep the first and last rows and fit the tokens
+    for max_tokens in [50, 100, 250]:
+        table = parse_tables_utils.sample_markdown_table(df, max_tokens)
+        rows = table[len(header):].splitlines()
+        assert count_words(table) <= max_tokens
+        assert 1 < len(rows) < len(df)
+        assert rows[0].startswith("|Item 0|") and rows[-1].startswith("|Item 49|")
+        assert rows == sorted(rows, key=lambda row: int(row.split("|")[1].split()[1]))
+
+def test_infer_column_names_makes_names_unique(monkeypatch):
+    prompts = []
+    def complete(prompt, variables, max_tokens=500, **kwargs):
+        prompts.append(variables)
+        return "Column 1: Fee\nColumn 2: Fee\nColumn 3: Service"
+    monkeypatch.setattr(parse_tables_utils.openai_utils, "complete", complete)
+    monkeypatch.setattr(parse_tables_utils.openai_utils, "count_tokens", count_words)
+    df = pd.DataFrame([['Wire Transfer', '1', '2', '3', '4']], columns=['Service', 'Column 1', 'Column 2', 'Column 3', 'Column 4'])
+    names = parse_tables_utils.infer_column_names(['Column 1', 'Column 2', 'Column 3', 'Column 4'], df)
+    # names already used by the table (or inferred for another column) get a number, missing names a placeholder
+    assert names == {'Column 1': 'Fee', 'Column 2': 'Fee 2', 'Column 3': 'Service 2', 'Column 4': 'Could not infer'}
+    assert len(prompts) == 1
+    assert prompts[0]['column_names'] == "Column 1\nColumn 2\nColumn 3\nColumn 4"
+    assert "|Wire Transfer|1|2|3|4|" in prompts[0]['table']
+
+''' the original node attributes: headers checked against every table cell and the closest header row searched for each node '''
+def add_missing_headers_reference(cells, headers, rowIndex):
+    for cell in cells:
+        if cell['rowIndex'] == rowIndex and not any(header['columnIndex'] == cell['columnIndex'] for header in headers):
+            headers.append({'content': f"TBD {cell['columnIndex']}", 'rowIndex': 0, 'columnIndex': cell['columnIndex']})
+    return headers
+
+def add_values_reference(cells, rowIndex, headers, node):
+    columns = []
+    for column_i in list(set(header['columnIndex'] for header in headers)):
+        current_distance = 1000000
+        headerRowIndex = 0
+        for header in headers:
+            rowDistance = rowIndex - header['rowIndex']
+            if column_i == header['columnIndex'] and 0 < rowDistance < current_distance and header['content'] != '':
+                headerRowIndex = header['rowIndex']
+                current_distance = rowDistance
+        columns += [header for header in headers if column_i == header['columnIndex'] and headerRowIndex == header['rowIndex'] and header['content'] != '']
+    for cell in cells:
+        if cell['rowIndex'] == rowIndex:
+            for column in columns:
+                if column['columnIndex'] == cell['columnIndex']:
+                    node[parse_tables_utils.remove_line_breaks(column['content'])] = cell['content']
+    for column in columns:
+        node.setdefault(parse_tables_utils.remove_line_breaks(column['content']), '')
+
+def get_table_nodes_reference(table):
+    nodes = []
+    headers = []
+    for cell in table['cells']:
+        if cell['kind'] == 'columnHeader':
+            headers.append({'content': cell['content'], 'rowIndex': cell['rowIndex'], 'columnIndex': cell['columnIndex']})
+        elif cell['columnIndex'] == 0:
+            node = {'content': cell['content'], 'rowIndex': cell['rowIndex'], 'span_offset': cell['spans'][0]['offset'],
+                    'span_length': cell['spans'][0]['length'], 'styles': [], 'children': []}
+            headers = parse_tables_utils.fix_header_cells(add_missing_headers_reference(table['cells'], headers, cell['rowIndex']))
+            add_values_reference(table['cells'], cell['rowIndex'], headers, node)
+            nodes.append(node)
+    return nodes
+
+''' a table from its rows of (kind, contents), None contents are missing cells '''
+def make_grid_table(rows):
+    cells = []
+    offset = 0
+    for rowIndex, (kind, contents) in enumerate(rows):
+        for columnIndex, content in enumerate(contents):
+            if content is not None:
+                cells.append({'rowIndex': rowIndex, 'columnIndex': columnIndex, 'content': content, 'kind': kind, 'spans': [{'offset': offset, 'length': len(content)}]})
+                offset += len(content) + 1
+    return {'cells': cells}
+
+GRID_TABLE = [
+    ('columnHeader', ['Service', 'Volume', None]),
+    ('content', ['Wire Transfer', '10', '$1.00']),
+    ('content', ['ACH', None, '$0.10', '$0.20']),
+    ('columnHeader', ['', 'Monthly\nVolume', 'Fee']),
+    ('content', ['Lockbox', '5', '$2.00']),
+    ('columnHeader', ['1', 'Fee', 'Fee']),
+    ('content', ['Positive Pay', '1', '$3.00', '$4.00'])
+]
+
+def test_get_cell_grid():
+    table = make_grid_table(GRID_TABLE)
+    grid = parse_tables_utils.get_cell_grid(table['cells'])
+    assert list(grid) == list(range(len(GRID_TABLE)))
+    assert list(grid[0]) == [0, 1]
+    assert list(grid[2]) == [0, 2, 3]
+    assert grid[4][2]['content'] == '$2.00'
+    assert parse_tables_utils.get_cell_grid([]) == {}
+
+def test_get_header_map():
+    headers = [
+        {'content': 'Service', 'rowIndex': 0, 'columnIndex': 0},
+        {'content': 'Volume', 'rowIndex': 0, 'columnIndex': 1},
+        {'content': '', 'rowIndex': 3, 'columnIndex': 0},
+        {'content': 'Monthly\nVolume', 'rowIndex': 3, 'columnIndex': 1},
+        {'content': 'Fee', 'rowIndex': 5, 'columnIndex': 1},
+        {'content': 'Fee', 'rowIndex': 5, 'columnIndex': 1},
+        {'content': 'TBD 2', 'rowIndex': 0, 'columnIndex': 2}
+    ]
+    assert parse_tables_utils.get_header_map(headers) == {
+        0: {'rows': [0], 'names': {0: ['Service']}},
+        1: {'rows': [0, 3, 5], 'names': {0: ['Volume'], 3: ['Monthly Volume'], 5: ['Fee', 'Fee']}},
+        2: {'rows': [0], 'names': {0: ['TBD 2']}}
+    }
+
+def test_header_row_missing_cells_gets_tbd_headers():
+    table = make_grid_table(GRID_TABLE[:3])
+    table_nodes, _ = parse_tables_utils.get_table_nodes(table, None, validate=False)
+    assert [{key: node[key] for key in node if key not in parse_tables_utils.RESERVED_ATTRIBUTES} for node in table_nodes] == [
+        {'Service': 'Wire Transfer', 'Volume': '10', 'TBD 2': '$1.00'},
+        {'Service': 'ACH', 'Volume': '', 'TBD 2': '$0.10', 'TBD 3': '$0.20'}
+    ]
+
+def test_table_nodes_match_the_original_attributes():
+    tables = [make_grid_table(GRID_TABLE), make_grid_table([row for row in GRID_TABLE if row[0] == 'content'])]
+    tables += get_synthetic_tables(3)[1]
+    for table in tables:
+        table_nodes, valid_nodes = parse_tables_utils.get_table_nodes(table, None, validate=False)
+        assert all(valid_nodes)
+        # same attributes in the same order
+        assert [list(node.items()) for node in table_nodes] == [list(node.items()) for node in get_table_nodes_reference(table)]
+
+''' the original tables parsing: the tree of every table built in a list '''
+def parse_json_result_reference(data):
+    trees = []
+    for table in parse_tables_utils.load_tables(data['tables'], data['pages']):
+        table = parse_tables_utils.rename_duplicate_headers(table)
+        parents = get_parents_reference(data['pages'], table, parse_tables_utils.PARENT_INDENT_THRESHOLD)
+        table_nodes = get_table_nodes_reference(table)
+        trees.append(build_tree_reference(table_nodes, parse_tables_utils.validate_nodes(table_nodes), parents))
+    return trees
+
+''' the original tree flattening: an item dict per row with values, copied from its parent item '''
+def get_items_list_reference(tree, curr_level, prefilled_item, levels, value_columns):
+    items = []
+    for node in tree:
+        item = prefilled_item.copy()
+        item[levels[curr_level]] = node['content']
+        for column in value_columns:
+            item[column] = parse_tables_utils.get_item_value(node, column)
+        if any(item[column] != '' for column in value_columns) and \
+            all(parse_tables_utils.get_item_value(item, column) != '' for column in parse_tables_utils.MUST_HAVE_COLUMNS):
+                items.append(item)
+        if len(node['children']) > 0:
+            items = items + get_items_list_reference(node['children'], curr_level+1, item, levels, value_columns)
+    return items
+
+''' judge every seventh node invalid, counting the validated tables '''
+def stub_validation(monkeypatch):
+    validated = []
+    def validate_nodes(nodes):
+        validated.append(len(nodes))
+        return [idx % 7 != 6 for idx in range(len(nodes))]
+    monkeypatch.setattr(parse_tables_utils, "validate_nodes", validate_nodes)
+    return validated
+
+def test_iter_trees_yields_the_original_trees(monkeypatch):
+    validated = stub_validation(monkeypatch)
+    for seed in range(2):
+        get_result = lambda: generate_result(pages=3, lines=5, tables=3, rows=25, columns=3, depth=4, styles=0, seed=seed)
+        trees = parse_tables_utils.iter_trees(get_result())
+        assert isinstance(trees, types.GeneratorType)
+        # each table is parsed when its tree is requested
+        validated.clear()
+        first = next(trees)
+        assert len(validated) == 1
+        trees = [first] + list(trees)
+        assert trees == parse_json_result_reference(get_result())
+        assert len(trees) == 3 and all(parse_tables_utils.get_height(tree) > 1 for tree in trees)
+
+def test_iter_items_matches_the_original_items_list(monkeypatch):
+    stub_validation(monkeypatch)
+    result = generate_result(pages=2, lines=5, tables=2, rows=30, columns=3, depth=4, styles=0, seed=1)
+    for tree in parse_tables_utils.iter_trees(result):
+        first_column_name = parse_tables_utils.get_first_column_name(tree)
+        levels = [first_column_name] + [first_column_name + str(i+1) for i in range(parse_tables_utils.get_height(tree) - 1)]
+        value_columns = [column for column in tree[0] if column not in levels + parse_tables_utils.RESERVED_ATTRIBUTES]
+        # rows without values are removed, their children are kept
+        stack = list(tree)
+        count = 0
+        while len(stack) > 0:
+            node = stack.pop()
+            count += 1
+            if count % 3 == 0:
+                node.update({column: '' for column in value_columns})
+            elif count % 5 == 0:
+                node[value_columns[0]] = ''
+            stack += node['children']
+        for must_have_columns in [[], [value_columns[0]], [levels[1]]]:
+            monkeypatch.setattr(parse_tables_utils, "MUST_HAVE_COLUMNS", must_have_columns)
+            items = [dict(zip(levels, contents), **dict(zip(value_columns, values))) for contents, values in parse_tables_utils.iter_items(tree, levels, value_columns)]
+            assert items == get_items_list_reference(tree, 0, {}, levels, value_columns)
+            assert 0 < len(items) < count
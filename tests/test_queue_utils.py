@@ -0,0 +1,63 @@
+import os
+from queue_utils import JobQueue
+
+def make_files(tmp_path, names):
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_bytes(name.encode("utf-8"))
+        paths.append(str(path))
+    return paths
+
+def test_claims_jobs_in_order_once(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    first, second = make_files(tmp_path, ["first.pdf", "second.pdf"])
+    first_id = queue.add(first)
+    second_id = queue.add(second)
+    # the same version of a file is only queued once
+    assert queue.add(first) is None
+    assert queue.claim() == (first_id, first)
+    assert queue.claim() == (second_id, second)
+    assert queue.claim() is None
+    assert queue.counts() == {'queued': 0, 'running': 2, 'done': 0, 'failed': 0}
+
+def test_modified_file_is_queued_again(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    file, = make_files(tmp_path, ["document.pdf"])
+    assert queue.add(file) is not None
+    modified = os.path.getmtime(file) + 10
+    os.utime(file, (modified, modified))
+    assert queue.add(file) is not None
+    assert queue.counts()['queued'] == 2
+
+def test_failed_jobs_are_requeued(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    done_file, failed_file = make_files(tmp_path, ["done.pdf", "failed.pdf"])
+    queue.add(done_file)
+    queue.add(failed_file)
+    done_id, _ = queue.claim()
+    failed_id, _ = queue.claim()
+    queue.finish(done_id, 3)
+    queue.fail(failed_id, ValueError("cannot parse"))
+    jobs = {job['id']: job for job in queue.jobs()}
+    assert jobs[done_id]['status'] == 'done' and jobs[done_id]['tables'] == 3
+    assert jobs[failed_id]['status'] == 'failed' and jobs[failed_id]['error'] == "cannot parse"
+    assert [job['id'] for job in queue.jobs(status='failed')] == [failed_id]
+
+    assert queue.requeue(['failed']) == 1
+    assert queue.claim() == (failed_id, failed_file)
+    job = queue.jobs(status='running')[0]
+    assert job['attempts'] == 2 and job['error'] is None
+    assert queue.counts() == {'queued': 0, 'running': 1, 'done': 1, 'failed': 0}
+
+def test_recovers_jobs_left_running(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    queue = JobQueue(path)
+    file, = make_files(tmp_path, ["document.pdf"])
+    job_id = queue.add(file)
+    queue.claim()
+    queue.close()
+    # a new worker queues again the job of the stopped worker
+    queue = JobQueue(path)
+    assert queue.requeue(['running']) == 1
+    assert queue.claim() == (job_id, file)
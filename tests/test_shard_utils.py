@@ -0,0 +1,46 @@
+import copy
+import json
+import os
+import parse_tables_utils
+import shard_utils
+
+DATA_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "shards")
+
+''' recorded results (Document.to_dict format): the whole document and its shards (pages 1-2 and 3-4, analyzed as separate files) '''
+def load(name):
+    with open(os.path.join(DATA_FOLDER, f"{name}.json")) as f:
+        return json.load(f)
+
+def test_stitched_shards_match_the_whole_document():
+    shards = [load("shard pages 1-2"), load("shard pages 3-4")]
+    document = load("document")
+    stitched = shard_utils.stitch_results(shards, [1, 3])
+    assert [page['pageNumber'] for page in stitched['pages']] == [1, 2, 3, 4]
+    assert stitched == document
+
+def test_rebase_does_not_change_the_shard_result():
+    shard = load("shard pages 3-4")
+    original = copy.deepcopy(shard)
+    rebased = shard_utils.rebase_result(shard, 2, 100)
+    assert shard == original
+    assert rebased['pages'][0]['pageNumber'] == 3
+    assert rebased['tables'][0]['spans'][0]['offset'] == shard['tables'][0]['spans'][0]['offset'] + 100
+    assert rebased['tables'][0]['cells'][0]['boundingRegions'][0]['pageNumber'] == 3
+
+def test_table_continued_across_shards_is_merged():
+    stitched = shard_utils.stitch_results([load("shard pages 1-2"), load("shard pages 3-4")], [1, 3])
+    tables = parse_tables_utils.load_tables(stitched['tables'], stitched['pages'])
+    assert len(tables) == 2
+    assert [region['pageNumber'] for region in tables[1]['boundingRegions']] == [2, 3]
+
+def test_split_pdf(tmp_path):
+    from pypdf import PdfWriter
+    writer = PdfWriter()
+    for _ in range(5):
+        writer.add_blank_page(width=612, height=792)
+    path = str(tmp_path / "document.pdf")
+    with open(path, "wb") as f:
+        writer.write(f)
+    shards = shard_utils.split_pdf(path, 2, str(tmp_path))
+    assert [first_page for _, first_page in shards] == [1, 3, 5]
+    assert [shard_utils.get_page_count(shard_path) for shard_path, _ in shards] == [2, 2, 1]
@@ -0,0 +1,13 @@
+import benchmark
+import parse_tables_utils
+from synthetic_utils import generate_result
+
+def test_benchmark_tier_tables_are_not_merged():
+    for tier in ['small', 'medium']:
+        result = generate_result(**benchmark.TIERS[tier])
+        assert len(parse_tables_utils.load_tables(result['tables'], result['pages'])) == benchmark.TIERS[tier]['tables']
+
+def test_consecutive_tables_columns_are_not_aligned():
+    result = generate_result(pages=2, lines=0, tables=2, rows=5, columns=4)
+    positions = [parse_tables_utils.get_column_positions(table) for table in result['tables']]
+    assert not parse_tables_utils.is_aligned(positions[0], positions[1])
@@ -0,0 +1,44 @@
+import pandas as pd
+import output_utils
+import parse_tables
+import worker
+from queue_utils import JobQueue
+
+class StubParser(parse_tables.Parser):
+    ''' analyses without the service, files named broken fail '''
+    def analyze(self, file):
+        if "broken" in file:
+            raise ValueError("cannot analyze")
+        return file
+
+''' one table per analyzed file '''
+def get_dataframes(result):
+    return [pd.DataFrame({'Fee': ['Wire Transfer'], 'Volume': ['1']})]
+
+def create_worker(tmp_path, monkeypatch, watch=None):
+    monkeypatch.setattr(parse_tables, "get_dataframes", get_dataframes)
+    monkeypatch.setattr(worker.Worker, "warm_up", lambda self: None)
+    queue = JobQueue(str(tmp_path / "jobs.sqlite"))
+    return worker.Worker(queue, StubParser(sink=output_utils.get_sink()), concurrency=2, watch=watch, poll_interval=0.01)
+
+def test_runs_queued_jobs_once(tmp_path, monkeypatch):
+    runner = create_worker(tmp_path, monkeypatch)
+    for name in ["receipt.jpeg", "scan.tiff", "broken.pdf"]:
+        (tmp_path / name).write_bytes(name.encode("utf-8"))
+        runner.queue.add(str(tmp_path / name))
+    runner.run(once=True)
+    assert runner.queue.counts() == {'queued': 0, 'running': 0, 'done': 2, 'failed': 1}
+    assert runner.queue.jobs(status='failed')[0]['error'] == "cannot analyze"
+    # the output files replace the whole extension
+    assert sorted(path.name for path in tmp_path.glob("*.csv")) == ["receipt 001.csv", "scan 001.csv"]
+
+def test_queues_watched_files_once(tmp_path, monkeypatch):
+    folder = tmp_path / "incoming"
+    folder.mkdir()
+    for name in ["scan.png", "notes.txt"]:
+        (folder / name).write_bytes(name.encode("utf-8"))
+    runner = create_worker(tmp_path, monkeypatch, watch=str(folder))
+    runner.run(once=True)
+    jobs = runner.queue.jobs()
+    assert [(job['file'], job['status']) for job in jobs] == [(str(folder / "scan.png"), 'done')]
+    assert (folder / "scan 001.csv").exists()